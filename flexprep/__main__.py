@@ -3,12 +3,9 @@
 import argparse
 import logging
 import sys
-from datetime import datetime as dt
-from pathlib import Path
 
+from flexprep import CONFIG, daemon
 from flexprep.domain.data_model import IFSForecast
-from flexprep.domain.db_utils import DB
-from flexprep.domain.processing import Processing
 
 logger = logging.getLogger(__name__)
 
@@ -29,14 +26,8 @@ def parse_arguments():
 def create_forecast_object_from_args(args):
     """Create an IFSForecast object based on the parsed arguments."""
     try:
-        forecast_ref_time_str = f"{args.date}{int(args.time):02d}00"
-        forecast_ref_time = dt.strptime(forecast_ref_time_str, "%Y%m%d%H%M")
-        return IFSForecast(
-            row_id=None,
-            forecast_ref_time=forecast_ref_time,
-            step=int(args.step),
-            key=Path(args.location).name,
-            processed=False,
+        return IFSForecast.from_notification(
+            args.step, args.date, args.time, args.location
         )
     except ValueError as ve:
         logger.error(f"Invalid date or time format: {ve}")
@@ -64,10 +55,15 @@ def process_forecast(args, db):
     # Create the forecast object and insert it into the DB
     ifs_forecast_obj = create_forecast_object_from_args(args)
     insert_forecast_in_db(ifs_forecast_obj, db)
+    # A new forecast starts with its step-0 files, a good time to clean up
+    if ifs_forecast_obj.step == 0:
+        db.prune()
 
-    # Get the processable steps
-    processable_steps = db.get_processable_steps(ifs_forecast_obj.forecast_ref_time)
-    return processable_steps
+    # Get the processable steps not claimed by a concurrent invocation
+    processable_steps = db.get_processable_steps(
+        ifs_forecast_obj.forecast_ref_time, inserted=ifs_forecast_obj
+    )
+    return db.claim_steps(processable_steps)
 
 
 if __name__ == "__main__":
@@ -77,7 +73,17 @@ if __name__ == "__main__":
         f"Time: {args.time}, Location: {args.location}"
     )
 
+    if CONFIG.main.daemon.forward and daemon.is_running():
+        daemon.enqueue(vars(args))
+        logger.info("Forwarded notification to the running daemon.")
+        sys.exit(0)
+
+    # Not needed to forward the notification to the daemon
+    from flexprep.domain.db_utils import DB
+    from flexprep.domain.dispatch_utils import process_steps
+
     db = DB()
     processable_steps = process_forecast(args, db)
-    for to_process in processable_steps:
-        Processing().process(to_process)
+    failed_steps = process_steps(processable_steps)
+    if failed_steps:
+        sys.exit(1)
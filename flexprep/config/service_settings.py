@@ -1,3 +1,5 @@
+import typing
+
 from mch_python_commons.audit.logger import LoggingSettings
 from mch_python_commons.config.base_settings import BaseServiceSettings
 from pydantic import BaseModel
@@ -18,11 +20,148 @@ class TimeSettings(BaseModel):
     tstart: int
 
 
+class CacheSettings(BaseModel):
+    enabled: bool = False
+    path: str = "/src/cache"
+    max_size_gb: float = 10.0
+
+
+class DownloadSettings(BaseModel):
+    max_workers: int = 4
+
+
+class SelectiveDownloadSettings(BaseModel):
+    enabled: bool = False
+    block_size_kb: int = 64
+    index_suffix: str = ".index"
+
+
+class GribIndexSettings(BaseModel):
+    enabled: bool = True
+
+
+class ParallelSettings(BaseModel):
+    max_workers: int = 1
+    worker_memory_gb: float = 4.0
+
+
+class DaemonSettings(BaseModel):
+    forward: bool = False
+    spool_dir: str = "/src/spool"
+    poll_interval: float = 0.5
+    max_attempts: int = 3
+    retry_interval: float = 60.0
+
+
+class MetricsSettings(BaseModel):
+    enabled: bool = False
+    textfile: str | None = None
+    tracemalloc: bool = False
+
+
+class MemorySettings(BaseModel):
+    ceiling_mb: int | None = None
+    bytes_per_value: int = 8
+    overhead: float = 3.0
+    on_exceed: typing.Literal["alone", "defer"] = "alone"
+
+
+class InputSettings(BaseModel):
+    mode: typing.Literal["disk", "memory"] = "disk"
+    max_memory_mb: int = 512
+    shm_dir: str | None = None
+
+
+class PackingSpec(BaseModel):
+    packing_type: str | None = None
+    bits_per_value: int | None = None
+    ccsds_block_size: int | None = None
+    ccsds_rsi: int | None = None
+    ccsds_flags: int | None = None
+
+    def grib_keys(self) -> dict[str, typing.Any]:
+        """GRIB keys of the packing, in the order they must be set."""
+        keys = {
+            "packingType": self.packing_type,
+            "bitsPerValue": self.bits_per_value,
+            "ccsdsBlockSize": self.ccsds_block_size,
+            "ccsdsRsi": self.ccsds_rsi,
+            "ccsdsFlags": self.ccsds_flags,
+        }
+        return {key: value for key, value in keys.items() if value is not None}
+
+
+class PackingSettings(BaseModel):
+    default: PackingSpec = PackingSpec()
+    fields: dict[str, PackingSpec] = {}
+
+    def grib_keys(self, short_name: str) -> dict[str, typing.Any]:
+        """GRIB packing keys of an output field, empty to keep its packing."""
+        return self.fields.get(short_name, self.default).grib_keys()
+
+
+class StateSettings(BaseModel):
+    enabled: bool = False
+    path: str = "/src/state"
+    dtype: typing.Literal["float32", "float64"] = "float64"
+    keep_forecasts: int = 2
+
+
+class FieldStoreSettings(BaseModel):
+    enabled: bool = False
+    path: str = "/src/fields"
+    max_size_gb: float = 4.0
+    keep_forecasts: int = 2
+
+
+class ValidationSettings(BaseModel):
+    headers: bool = False
+
+
+class FlexpartSettings(BaseModel):
+    rows_per_block: int | None = None
+
+
+class EncodeSettings(BaseModel):
+    max_workers: int = 1
+    eccodes_threads: bool = False
+
+
+class UploadSettings(BaseModel):
+    streaming: bool = False
+    part_size_mb: int = 8
+    max_in_flight: int = 4
+
+
+class DBSettings(BaseModel):
+    busy_timeout_s: float = 30.0
+    lease_seconds: int = 3600
+    retention_days: int | None = None
+    archive: bool = True
+
+
 class AppSettings(BaseModel):
     app_name: str
     db_path: str
     s3_buckets: S3Buckets
     time_settings: TimeSettings
+    db: DBSettings = DBSettings()
+    cache: CacheSettings = CacheSettings()
+    download: DownloadSettings = DownloadSettings()
+    selective_download: SelectiveDownloadSettings = SelectiveDownloadSettings()
+    grib_index: GribIndexSettings = GribIndexSettings()
+    parallel: ParallelSettings = ParallelSettings()
+    daemon: DaemonSettings = DaemonSettings()
+    upload: UploadSettings = UploadSettings()
+    input: InputSettings = InputSettings()
+    validation: ValidationSettings = ValidationSettings()
+    state: StateSettings = StateSettings()
+    field_store: FieldStoreSettings = FieldStoreSettings()
+    flexpart: FlexpartSettings = FlexpartSettings()
+    encode: EncodeSettings = EncodeSettings()
+    packing: PackingSettings = PackingSettings()
+    metrics: MetricsSettings = MetricsSettings()
+    memory: MemorySettings = MemorySettings()
 
 
 class ServiceSettings(BaseServiceSettings):
@@ -0,0 +1,195 @@
+"""Resident worker processing notifications from a spool directory."""
+
+import fcntl
+import json
+import logging
+import os
+import signal
+import time
+import typing
+
+from flexprep import CONFIG
+from flexprep.domain.data_model import IFSForecast
+
+logger = logging.getLogger(__name__)
+
+PID_FILE = "daemon.pid"
+FAILED_DIR = "failed"
+
+
+def _spool_dir() -> str:
+    return CONFIG.main.daemon.spool_dir
+
+
+def is_running() -> bool:
+    """
+    Check whether a daemon is serving the spool directory.
+
+    The daemon holds a lock on its pid file while it runs. Unlike probing
+    the pid, this is not fooled by a reused pid or by a daemon running in
+    another pid namespace.
+    """
+    try:
+        with open(os.path.join(_spool_dir(), PID_FILE)) as f:
+            fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    return False
+
+
+def enqueue(notification: dict[str, typing.Any]) -> str:
+    """
+    Atomically add a notification (step, date, time, location) to the spool.
+
+    Returns:
+        str: Path of the spooled notification.
+    """
+    spool_dir = _spool_dir()
+    os.makedirs(spool_dir, exist_ok=True)
+    path = os.path.join(spool_dir, f"{time.time_ns()}-{os.getpid()}.json")
+    _write(path, notification | {"enqueued_at": time.time()})
+    return path
+
+
+def _write(path: str, notification: dict[str, typing.Any]) -> None:
+    partial_path = os.path.join(
+        os.path.dirname(path), f".{os.path.basename(path)}.partial"
+    )
+    with open(partial_path, "w") as f:
+        json.dump(notification, f)
+    os.replace(partial_path, path)
+
+
+def pending_notifications() -> list[str]:
+    """Return the spooled notifications in arrival order."""
+    spool_dir = _spool_dir()
+    return sorted(
+        os.path.join(spool_dir, name)
+        for name in os.listdir(spool_dir)
+        if name.endswith(".json") and not name.startswith(".")
+    )
+
+
+class Daemon:
+    def __init__(self) -> None:
+        start = time.perf_counter()
+        # Pay for the scientific and S3 imports once, at start-up. The spool
+        # functions above are used by the entry point to forward
+        # notifications and do not need them.
+        from flexprep.domain.db_utils import DB
+        from flexprep.domain.dispatch_utils import process_steps
+        from flexprep.domain.processing import Processing
+
+        os.makedirs(os.path.join(_spool_dir(), FAILED_DIR), exist_ok=True)
+        self.db = DB()
+        self.processing = Processing(db=self.db)
+        self.process_steps = process_steps
+        self.stopped = False
+        logger.info(f"Daemon ready in {time.perf_counter() - start:.2f} s")
+
+    def stop(self, *_: typing.Any) -> None:
+        logger.info("Stopping daemon after the current notification.")
+        self.stopped = True
+
+    def handle(self, path: str) -> None:
+        """
+        Insert a spooled notification and process the steps it unblocks.
+
+        Once inserted, the notification is marked so that a retry after a
+        failed processing does not insert it again.
+        """
+        start = time.perf_counter()
+        with open(path) as f:
+            notification = json.load(f)
+        logger.info(
+            f"Notification received for file - Step: {notification['step']}, "
+            f"Date: {notification['date']}, Time: {notification['time']}, "
+            f"Location: {notification['location']}"
+        )
+
+        ifs_forecast = IFSForecast.from_notification(
+            notification["step"],
+            notification["date"],
+            notification["time"],
+            notification["location"],
+        )
+        if not notification.get("inserted"):
+            self.db.insert_item(ifs_forecast)
+            _write(path, notification | {"inserted": True})
+            if ifs_forecast.step == 0:
+                self.db.prune()
+        processable_steps = self.db.claim_steps(
+            self.db.get_processable_steps(
+                ifs_forecast.forecast_ref_time, inserted=ifs_forecast
+            )
+        )
+        failed_steps = self.process_steps(processable_steps, processing=self.processing)
+        if failed_steps:
+            raise RuntimeError(f"Processing failed for timestep(s): {failed_steps}")
+
+        logger.info(
+            f"Notification handled in {time.perf_counter() - start:.2f} s, "
+            f"{time.time() - notification['enqueued_at']:.2f} s after enqueueing"
+        )
+
+    def retry_later(self, path: str) -> None:
+        """
+        Spool a failed notification again, or move it to the failed directory
+        after ``daemon.max_attempts`` attempts.
+        """
+        try:
+            with open(path) as f:
+                notification = json.load(f)
+        except ValueError:
+            # Unreadable, retrying would not help
+            notification = {"attempts": CONFIG.main.daemon.max_attempts}
+        attempts = notification.get("attempts", 0) + 1
+        if attempts >= CONFIG.main.daemon.max_attempts:
+            logger.error(f"Giving up on notification {path} after {attempts} attempts")
+            os.replace(
+                path, os.path.join(_spool_dir(), FAILED_DIR, os.path.basename(path))
+            )
+            return
+        retry_at = time.time() + CONFIG.main.daemon.retry_interval * attempts
+        _write(path, notification | {"attempts": attempts, "retry_at": retry_at})
+
+    def run(self) -> None:
+        pid_path = os.path.join(_spool_dir(), PID_FILE)
+        # The lock is held for the lifetime of the daemon, see is_running
+        with open(pid_path, "a+") as pid_file:
+            try:
+                fcntl.flock(pid_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise RuntimeError("Another daemon is serving the spool directory.")
+            pid_file.truncate(0)
+            pid_file.write(str(os.getpid()))
+            pid_file.flush()
+            self._serve()
+
+    def _serve(self) -> None:
+        while not self.stopped:
+            handled = 0
+            for path in pending_notifications():
+                try:
+                    with open(path) as f:
+                        if json.load(f).get("retry_at", 0) > time.time():
+                            continue
+                    self.handle(path)
+                    os.unlink(path)
+                except Exception as e:
+                    logger.exception(f"Failed to handle notification {path}: {e}")
+                    self.retry_later(path)
+                handled += 1
+                if self.stopped:
+                    break
+            if not handled:
+                time.sleep(CONFIG.main.daemon.poll_interval)
+
+
+if __name__ == "__main__":
+    daemon = Daemon()
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    daemon.run()
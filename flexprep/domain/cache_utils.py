@@ -0,0 +1,200 @@
+import contextlib
+import fcntl
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import typing
+
+logger = logging.getLogger(__name__)
+
+
+class FileCache:
+    """
+    Content-addressed on-disk cache for S3 objects.
+
+    Entries are keyed by bucket, key and ETag, so a re-uploaded object never
+    serves stale content. Files are published with an atomic rename, so
+    readers never observe a partially written entry.
+
+    Concurrent access from several processes is guarded with ``flock`` on
+    the lock files of ``.locks``, where each entry is assigned one of
+    ``LOCK_SLOTS`` slots by the hash of its name:
+
+    - ``<slot>.fetch.lock`` serialises the download of the objects;
+    - ``<slot>.lock`` is held shared by the processes using the entries, from
+      ``get_or_fetch`` until ``release``. The eviction only removes entries
+      whose lock it can take exclusively without waiting;
+    - ``cache.lock`` serialises the eviction.
+
+    Lock files are never removed, as a process may hold or wait on a lock
+    file that another process unlinked; their number is bounded by the
+    slots instead. Entries sharing a slot may wait for each other's fetch
+    or be kept by each other's use, which only delays an eviction.
+    """
+
+    LOCK_DIR = ".locks"
+    LOCK_SUFFIX = ".lock"
+    FETCH_LOCK_SUFFIX = ".fetch" + LOCK_SUFFIX
+    LOCK_SLOTS = 1024
+    # Files stored next to an entry, counted and removed together with it
+    SIDECAR_SUFFIXES = (".idx",)
+
+    def __init__(self, path: str, max_size_bytes: int) -> None:
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        # Open lock files of the entries in use, by path
+        self._held: dict[str, list[typing.TextIO]] = {}
+        self._held_lock = threading.Lock()
+
+    @staticmethod
+    def entry_name(bucket: str, key: str, etag: str) -> str:
+        """Return the content address of an object version."""
+        digest = hashlib.sha256(f"{bucket}/{key}/{etag}".encode()).hexdigest()
+        return f"{digest}-{os.path.basename(key)}"
+
+    def contains(self, file_path: str) -> bool:
+        """Check whether a path points into the cache directory."""
+        return os.path.dirname(os.path.abspath(file_path)) == os.path.abspath(self.path)
+
+    def _lock_slot(self, name: str) -> str:
+        """Return the name of the lock slot of an entry."""
+        digest = hashlib.sha256(name.encode()).digest()
+        return f"{int.from_bytes(digest[:8], 'big') % self.LOCK_SLOTS:04d}"
+
+    def _open_lock(self, name: str) -> typing.TextIO:
+        lock_dir = os.path.join(self.path, self.LOCK_DIR)
+        os.makedirs(lock_dir, exist_ok=True)
+        return open(os.path.join(lock_dir, name), "a")
+
+    @contextlib.contextmanager
+    def _lock(self, name: str) -> typing.Iterator[None]:
+        with self._open_lock(name) as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def get_or_fetch(
+        self, name: str, fetch: typing.Callable[[str], None]
+    ) -> tuple[str, bool]:
+        """
+        Return the cached path for an entry, calling ``fetch`` on a miss.
+
+        The entry is protected from eviction until it is handed back through
+        ``release``.
+
+        Args:
+            name (str): Content address as returned by ``entry_name``.
+            fetch (Callable[[str], None]): Writes the object to the given path.
+
+        Returns:
+            tuple[str, bool]: The cached file path and whether it was a hit.
+        """
+        entry_path = os.path.join(self.path, name)
+        slot = self._lock_slot(name)
+        use_lock = self._open_lock(slot + self.LOCK_SUFFIX)
+        try:
+            fcntl.flock(use_lock, fcntl.LOCK_SH)
+            with self._lock(slot + self.FETCH_LOCK_SUFFIX):
+                hit = os.path.exists(entry_path)
+                if hit:
+                    # Touch the entry so that it becomes the most recently used
+                    os.utime(entry_path)
+                    self.hits += 1
+                    logger.info(f"Cache hit for {name} (hits={self.hits})")
+                else:
+                    self.misses += 1
+                    logger.info(f"Cache miss for {name} (misses={self.misses})")
+                    self._fetch(entry_path, fetch)
+        except BaseException:
+            use_lock.close()
+            raise
+
+        with self._held_lock:
+            self._held.setdefault(entry_path, []).append(use_lock)
+        if not hit:
+            self.evict()
+        return entry_path, hit
+
+    def _fetch(self, entry_path: str, fetch: typing.Callable[[str], None]) -> None:
+        fd, partial_path = tempfile.mkstemp(dir=self.path, suffix=".partial")
+        os.close(fd)
+        try:
+            fetch(partial_path)
+            os.replace(partial_path, entry_path)
+        except Exception:
+            os.unlink(partial_path)
+            raise
+
+    def release(self, entry_path: str) -> None:
+        """Hand back an entry returned by ``get_or_fetch``."""
+        with self._held_lock:
+            locks = self._held.get(entry_path)
+            if not locks:
+                return
+            lock = locks.pop()
+            if not locks:
+                del self._held[entry_path]
+        # Closing the file releases the lock
+        lock.close()
+
+    def _entry_size(self, name: str) -> int:
+        size = 0
+        for suffix in ("", *self.SIDECAR_SUFFIXES):
+            with contextlib.suppress(FileNotFoundError):
+                size += os.stat(os.path.join(self.path, name + suffix)).st_size
+        return size
+
+    def evict(self) -> None:
+        """
+        Remove least recently used entries until the cache fits its size limit.
+
+        Entries in use by a process, or being fetched, are skipped.
+        """
+        with self._lock("cache" + self.LOCK_SUFFIX):
+            entries = []
+            for entry in os.scandir(self.path):
+                if entry.is_dir() or entry.name.endswith(
+                    (*self.SIDECAR_SUFFIXES, ".partial")
+                ):
+                    continue
+                with contextlib.suppress(FileNotFoundError):
+                    entries.append(
+                        (
+                            entry.stat().st_mtime,
+                            self._entry_size(entry.name),
+                            entry.name,
+                        )
+                    )
+
+            total_size = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total_size <= self.max_size_bytes:
+                    break
+                if self._remove_unused(name):
+                    total_size -= size
+                    logger.debug(f"Evicted {name} from cache")
+
+    def _remove_unused(self, name: str) -> bool:
+        """Remove an entry and its sidecars unless it is in use."""
+        with self._open_lock(self._lock_slot(name) + self.LOCK_SUFFIX) as use_lock:
+            try:
+                fcntl.flock(use_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.debug(f"Not evicting {name}, it is in use")
+                return False
+            try:
+                for suffix in ("", *self.SIDECAR_SUFFIXES):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.unlink(os.path.join(self.path, name + suffix))
+            finally:
+                fcntl.flock(use_lock, fcntl.LOCK_UN)
+        return True
+
+    def log_stats(self) -> None:
+        logger.info(f"File cache statistics: hits={self.hits}, misses={self.misses}")
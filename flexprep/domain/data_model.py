@@ -1,15 +1,74 @@
+import re
 import typing
 from dataclasses import asdict, dataclass
 from datetime import datetime
+from pathlib import Path
+
+# Dissemination file names: P1D, reference time and valid time as
+# MMDDHHMM, and a version digit. Constants files are valid at minute 01.
+KEY_PATTERN = re.compile(r"P1D(?P<ref>\d{8})(?P<valid>\d{8})\d")
 
 
 @dataclass
 class IFSForecast:
-    row_id: int
+    row_id: int | None
     forecast_ref_time: datetime
     step: int
     key: str
     processed: bool
 
+    @property
+    def is_constants(self) -> bool:
+        """Whether this is the step-0 file holding the constant fields."""
+        return self.step == 0 and self.key.endswith("11")
+
     def to_dict(self) -> dict[str, typing.Any]:
         return asdict(self)
+
+    @classmethod
+    def from_notification(
+        cls, step: str, date: str, time: str, location: str
+    ) -> "IFSForecast":
+        """Create an unprocessed forecast from the fields of a notification."""
+        forecast_ref_time = datetime.strptime(f"{date}{int(time):02d}00", "%Y%m%d%H%M")
+        return cls(
+            row_id=None,
+            forecast_ref_time=forecast_ref_time,
+            step=int(step),
+            key=Path(location).name,
+            processed=False,
+        )
+
+    @classmethod
+    def from_key(cls, key: str, forecast_ref_time: datetime) -> "IFSForecast":
+        """
+        Create an unprocessed forecast from the name of an input file.
+
+        File names carry no year, so the valid time is taken in the first year
+        from that of ``forecast_ref_time`` where it exists and does not precede
+        the reference time: a forecast spanning New Year has valid times in
+        the next year, possibly on 29 February.
+
+        Raises:
+            ValueError: If the key is not an input file of this forecast.
+        """
+        match = KEY_PATTERN.fullmatch(key)
+        if match is None or match["ref"] != f"{forecast_ref_time:%m%d%H%M}":
+            raise ValueError(f"{key} is not an input file of {forecast_ref_time}")
+        for year in (forecast_ref_time.year, forecast_ref_time.year + 1):
+            try:
+                valid_time = datetime.strptime(f"{year}{match['valid']}", "%Y%m%d%H%M")
+            except ValueError:
+                # 29 February of a common year
+                continue
+            if valid_time >= forecast_ref_time:
+                break
+        else:
+            raise ValueError(f"{key} is not an input file of {forecast_ref_time}")
+        return cls(
+            row_id=None,
+            forecast_ref_time=forecast_ref_time,
+            step=int((valid_time - forecast_ref_time).total_seconds() // 3600),
+            key=key,
+            processed=False,
+        )
@@ -1,13 +1,72 @@
+import functools
 import logging
+import os
+import socket
 import sqlite3
+import time
 import typing
 from datetime import datetime as dt
+from datetime import timedelta, timezone
 
 from flexprep import CONFIG
 from flexprep.domain.data_model import IFSForecast
 
 logger = logging.getLogger(__name__)
 
+# Schema migrations, applied in order and tracked with PRAGMA user_version
+MIGRATIONS: list[list[str]] = [
+    # 1: leases of steps being processed
+    [
+        "ALTER TABLE uploaded ADD COLUMN lease_owner TEXT",
+        "ALTER TABLE uploaded ADD COLUMN lease_expires REAL",
+    ],
+    # 2: stored constants flag, covering index of the step query, archive
+    [
+        "ALTER TABLE uploaded "
+        "ADD COLUMN is_constants BOOLEAN NOT NULL DEFAULT FALSE",
+        # Constants files are the step-0 files with a key ending in '11'
+        "UPDATE uploaded SET is_constants = (step = 0 AND substr(key, -2) = '11')",
+        "CREATE INDEX idx_uploaded_steps ON uploaded "
+        "(forecast_ref_time, step, processed, is_constants, lease_expires, key)",
+        """
+        CREATE TABLE uploaded_archive (
+            row_id INTEGER PRIMARY KEY,
+            forecast_ref_time TEXT NOT NULL,
+            step INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            processed BOOLEAN NOT NULL,
+            is_constants BOOLEAN NOT NULL,
+            lease_owner TEXT,
+            lease_expires REAL
+        )
+        """,
+    ],
+    # 3: released failed steps, retried by the next notification of a forecast
+    [
+        "ALTER TABLE uploaded ADD COLUMN retry BOOLEAN NOT NULL DEFAULT FALSE",
+        "ALTER TABLE uploaded_archive "
+        "ADD COLUMN retry BOOLEAN NOT NULL DEFAULT FALSE",
+        "CREATE INDEX idx_uploaded_retry ON uploaded (forecast_ref_time, step) "
+        "WHERE retry",
+    ],
+]
+
+# Columns copied from uploaded to uploaded_archive by DB.prune
+ARCHIVE_COLUMNS = (
+    "row_id, forecast_ref_time, step, key, processed, is_constants, "
+    "lease_owner, lease_expires, retry"
+)
+
+
+@functools.lru_cache(maxsize=64)
+def _parse_time(value: str) -> dt:
+    return dt.strptime(value, "%Y-%m-%d %H:%M:%S")
+
+
+def lease_owner() -> str:
+    """Identify the current process as owner of a lease."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
 
 class DB:
     conn: sqlite3.Connection
@@ -16,8 +75,12 @@ class DB:
         try:
             """Establish a database connection."""
             self.db_path = CONFIG.main.db_path
-            self.conn = sqlite3.connect(self.db_path)
+            busy_timeout = CONFIG.main.db.busy_timeout_s
+            self.conn = sqlite3.connect(self.db_path, timeout=busy_timeout)
             self.conn.row_factory = sqlite3.Row
+            # WAL lets readers proceed while another process writes
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(f"PRAGMA busy_timeout={int(busy_timeout * 1000)}")
             logger.debug("Connected to database.")
             self._initialize_db()
         except sqlite3.Error as e:
@@ -42,10 +105,30 @@ class DB:
             with self.conn:
                 self.conn.execute(create_table_query)
                 logger.debug("Table uploaded is ready.")
+            self._migrate()
         except sqlite3.Error as e:
             logger.exception(f"An error occurred while initializing the database: {e}")
             raise
 
+    def _migrate(self) -> None:
+        """Apply pending schema migrations."""
+        # Take the write lock first, so that concurrent processes
+        # do not apply the same migration twice
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+            for number, statements in enumerate(
+                MIGRATIONS[version:], start=version + 1
+            ):
+                for statement in statements:
+                    self.conn.execute(statement)
+                self.conn.execute(f"PRAGMA user_version={number}")
+                logger.info(f"Applied database migration {number}.")
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+
     def insert_item(self, item: IFSForecast) -> None:
         """Insert a single item into the 'uploaded' table and update its row_id."""
         try:
@@ -53,8 +136,9 @@ class DB:
                 # Insert the item and get the newly inserted row_id
                 result = self.conn.execute(
                     """
-                    INSERT INTO uploaded (forecast_ref_time, step, key, processed)
-                    VALUES (?, ?, ?, ?)
+                    INSERT INTO uploaded
+                        (forecast_ref_time, step, key, processed, is_constants)
+                    VALUES (?, ?, ?, ?, ?)
                     RETURNING row_id
                     """,
                     (
@@ -62,6 +146,7 @@ class DB:
                         item.step,
                         item.key,
                         item.processed,
+                        item.is_constants,
                     ),
                 )
 
@@ -73,8 +158,52 @@ class DB:
             logger.exception(f"An error occurred while inserting data: {e}")
             raise
 
+    def insert_items(self, items: typing.Iterable[IFSForecast]) -> int:
+        """
+        Insert items into the 'uploaded' table in a single transaction.
+
+        Items that are already recorded are skipped.
+
+        Returns:
+            int: The number of inserted items.
+        """
+        try:
+            with self.conn:
+                before = self.conn.total_changes
+                self.conn.executemany(
+                    """
+                    INSERT OR IGNORE INTO uploaded
+                        (forecast_ref_time, step, key, processed, is_constants)
+                    VALUES (?, ?, ?, ?, ?)
+                    """,
+                    (
+                        (
+                            item.forecast_ref_time,
+                            item.step,
+                            item.key,
+                            item.processed,
+                            item.is_constants,
+                        )
+                        for item in items
+                    ),
+                )
+                inserted = self.conn.total_changes - before
+            logger.debug(f"Inserted {inserted} item(s).")
+            return inserted
+        except sqlite3.Error as e:
+            logger.exception(f"An error occurred while inserting data: {e}")
+            raise
+
+    def get_keys(self, forecast_ref_time: dt) -> set[str]:
+        """Return the keys recorded for a forecast reference time."""
+        cursor = self.conn.execute(
+            "SELECT key FROM uploaded WHERE forecast_ref_time = ?",
+            (forecast_ref_time,),
+        )
+        return {row["key"] for row in cursor}
+
     def get_processable_steps(
-        self, forecast_ref_time: dt
+        self, forecast_ref_time: dt, inserted: IFSForecast | None = None
     ) -> list[list[dict[str, typing.Any]]]:
         """
         Query the database for unprocessed steps that can be processed, ensuring
@@ -83,6 +212,12 @@ class DB:
 
         Args:
             forecast_ref_time (datetime): The forecast reference time to query for.
+            inserted (IFSForecast | None): The item that was just inserted. If
+                given, only the steps this insert can have unblocked are
+                queried: the inserted step and the step following it, and
+                the steps released for a retry after their processing failed,
+                through their own index. Step-0 inserts can unblock every
+                step and always query all of them.
 
         Returns:
             list[list[dict]]: A list of lists containing IFSForecast objects for
@@ -103,7 +238,20 @@ class DB:
                     return []
 
                 # Fetch the current and previous steps in a single query
-                rows = self._fetch_current_and_previous_steps(forecast_ref_time)
+                if inserted is None or inserted.step == 0:
+                    rows = self._fetch_current_and_previous_steps(forecast_ref_time)
+                else:
+                    tincr = CONFIG.main.time_settings.tincr
+                    rows = self._fetch_current_and_previous_steps(
+                        forecast_ref_time, (inserted.step, inserted.step + tincr)
+                    )
+                    retried = self._fetch_current_and_previous_steps(
+                        forecast_ref_time, retry=True
+                    )
+                    rows = sorted(
+                        {row["cur_row_id"]: row for row in rows + retried}.values(),
+                        key=lambda row: row["cur_step"],
+                    )
 
                 if not rows:
                     logger.info(
@@ -144,12 +292,19 @@ class DB:
         cursor = self.conn.execute(step_zero_query, (forecast_ref_time,))
         return cursor.fetchall()
 
-    def _fetch_current_and_previous_steps(self, forecast_ref_time: dt) -> list:
+    def _fetch_current_and_previous_steps(
+        self,
+        forecast_ref_time: dt,
+        steps: tuple[int, ...] | None = None,
+        retry: bool = False,
+    ) -> list:
         """
         Fetch current steps and their previous steps from the database.
 
         Args:
             forecast_ref_time (datetime): The forecast reference time to query for.
+            steps (tuple[int, ...] | None): Restrict the query to these steps.
+            retry (bool): Restrict the query to the steps released for a retry.
 
         Returns:
             list: A list of rows containing both the current step and its previous step.
@@ -174,24 +329,31 @@ class DB:
         LEFT JOIN
             uploaded prev ON cur.forecast_ref_time = prev.forecast_ref_time
                         AND prev.step = cur.step - ?
-                        -- Skip constants file (key ends in '11')
-                        -- to avoid duplicate cur.step
+                        -- Skip constants file to avoid duplicate cur.step
                         -- as constants file also has prev.step = 0
-                        AND (prev_step != 0 OR RIGHT(prev.key, 2) != '11')
+                        AND NOT prev.is_constants
 
         WHERE
             cur.forecast_ref_time = ? AND
             cur.processed = FALSE AND
+            -- Skip steps leased by another process
+            (cur.lease_expires IS NULL OR cur.lease_expires < ?) AND
             cur.step != 0 AND
             (cur.step - ?) % ? = 0 AND
             prev.step is not NULL
+            {steps_filter}
         ORDER BY
             cur.step;
         """
+        params: tuple = (tincr, forecast_ref_time, time.time(), tstart, tincr)
+        steps_filter = ""
+        if steps is not None:
+            steps_filter = f"AND cur.step IN ({', '.join('?' * len(steps))})"
+            params += tuple(steps)
+        if retry:
+            steps_filter += " AND cur.retry"
 
-        cursor = self.conn.execute(
-            step_query, (tincr, forecast_ref_time, tstart, tincr)
-        )
+        cursor = self.conn.execute(step_query.format(steps_filter=steps_filter), params)
 
         return cursor.fetchall()
 
@@ -213,9 +375,7 @@ class DB:
         step_zero_forecasts = [
             IFSForecast(
                 row_id=zero_row["row_id"],
-                forecast_ref_time=dt.strptime(
-                    zero_row["forecast_ref_time"], "%Y-%m-%d %H:%M:%S"
-                ),
+                forecast_ref_time=_parse_time(zero_row["forecast_ref_time"]),
                 step=int(zero_row["step"]),
                 key=zero_row["key"],
                 processed=zero_row["processed"],
@@ -235,9 +395,7 @@ class DB:
                 processable_list.append(
                     IFSForecast(
                         row_id=row["prev_row_id"],
-                        forecast_ref_time=dt.strptime(
-                            row["prev_forecast_ref_time"], "%Y-%m-%d %H:%M:%S"
-                        ),
+                        forecast_ref_time=_parse_time(row["prev_forecast_ref_time"]),
                         step=int(row["prev_step"]),
                         key=row["prev_key"],
                         processed=row["prev_processed"],
@@ -248,9 +406,7 @@ class DB:
             processable_list.append(
                 IFSForecast(
                     row_id=row["cur_row_id"],
-                    forecast_ref_time=dt.strptime(
-                        row["cur_forecast_ref_time"], "%Y-%m-%d %H:%M:%S"
-                    ),
+                    forecast_ref_time=_parse_time(row["cur_forecast_ref_time"]),
                     step=int(row["cur_step"]),
                     key=row["cur_key"],
                     processed=row["cur_processed"],
@@ -261,6 +417,121 @@ class DB:
 
         return combined_steps
 
+    def claim_item(self, row_id: int, owner: str | None = None) -> bool:
+        """
+        Atomically lease an unprocessed item for processing.
+
+        The claim only succeeds if the item is neither processed nor leased by
+        another process. The lease expires after ``db.lease_seconds``, so that
+        a crashed process does not block the item forever.
+
+        Returns:
+            bool: Whether the item was claimed.
+        """
+        now = time.time()
+        try:
+            with self.conn:
+                result = self.conn.execute(
+                    """
+                    UPDATE uploaded
+                    SET lease_owner = ?, lease_expires = ?
+                    WHERE row_id = ?
+                        AND processed = FALSE
+                        AND (lease_expires IS NULL OR lease_expires < ?)
+                    RETURNING row_id
+                    """,
+                    (
+                        owner or lease_owner(),
+                        now + CONFIG.main.db.lease_seconds,
+                        row_id,
+                        now,
+                    ),
+                )
+                return result.fetchone() is not None
+        except sqlite3.Error as e:
+            logger.exception(f"An error occurred while claiming the item: {e}")
+            raise
+
+    def claim_steps(
+        self, processable_steps: list[list[dict[str, typing.Any]]]
+    ) -> list[list[dict[str, typing.Any]]]:
+        """Claim the steps to process, dropping those claimed by other processes."""
+        owner = lease_owner()
+        claimed = []
+        for file_objs in processable_steps:
+            to_process = max(file_objs, key=lambda obj: int(obj["step"]))
+            if self.claim_item(to_process["row_id"], owner):
+                claimed.append(file_objs)
+            else:
+                logger.info(
+                    f"Timestep {to_process['step']} is claimed by another process."
+                )
+        return claimed
+
+    def release_item(self, row_id: int, retry: bool = True) -> None:
+        """
+        Release the lease of an item, e.g. after its processing failed.
+
+        Args:
+            row_id (int): The item to release.
+            retry (bool): Whether the next notification of the forecast
+                retries the item, which it otherwise only queries if the
+                notified step unblocks it.
+        """
+        try:
+            with self.conn:
+                self.conn.execute(
+                    """
+                    UPDATE uploaded
+                    SET lease_owner = NULL, lease_expires = NULL, retry = ?
+                    WHERE row_id = ?
+                    """,
+                    (retry, row_id),
+                )
+        except sqlite3.Error as e:
+            logger.exception(f"An error occurred while releasing the item: {e}")
+            raise
+
+    def prune(self, now: dt | None = None) -> int:
+        """
+        Remove the forecasts older than the retention period.
+
+        The rows are moved to the ``uploaded_archive`` table when
+        ``db.archive`` is set, and deleted otherwise.
+
+        Args:
+            now (datetime | None): Reference for the retention period, in
+                UTC, the current time by default.
+
+        Returns:
+            int: The number of rows removed from ``uploaded``.
+        """
+        settings = CONFIG.main.db
+        if settings.retention_days is None:
+            return 0
+        # Reference times are stored in UTC, without time zone
+        now = now or dt.now(timezone.utc).replace(tzinfo=None)
+        cutoff = now - timedelta(days=settings.retention_days)
+        try:
+            with self.conn:
+                if settings.archive:
+                    self.conn.execute(
+                        f"INSERT INTO uploaded_archive ({ARCHIVE_COLUMNS}) "
+                        f"SELECT {ARCHIVE_COLUMNS} FROM uploaded "
+                        "WHERE forecast_ref_time < ?",
+                        (cutoff,),
+                    )
+                result = self.conn.execute(
+                    "DELETE FROM uploaded WHERE forecast_ref_time < ?", (cutoff,)
+                )
+        except sqlite3.Error as e:
+            logger.exception(f"An error occurred while pruning the database: {e}")
+            raise
+        if result.rowcount > 0:
+            action = "Archived" if settings.archive else "Deleted"
+            logger.info(f"{action} {result.rowcount} item(s) older than {cutoff}.")
+        return result.rowcount
+
     def update_item_as_processed(self, row_id: int) -> None:
         """Update the 'processed' field of a specific item to True."""
         try:
@@ -268,7 +539,7 @@ class DB:
                 result = self.conn.execute(
                     """
                     UPDATE uploaded
-                    SET processed = 1
+                    SET processed = 1, lease_owner = NULL, lease_expires = NULL
                     WHERE row_id = ?
                     """,
                     (row_id,),
@@ -0,0 +1,272 @@
+import functools
+import logging
+import os
+import typing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from flexprep import CONFIG
+
+logger = logging.getLogger(__name__)
+
+FileObject = dict[str, typing.Any]
+
+CGROUP_MEMORY_LIMITS = (
+    "/sys/fs/cgroup/memory.max",
+    "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+)
+
+
+def _step_of(file_objs: list[FileObject]) -> int:
+    return max(int(obj["step"]) for obj in file_objs)
+
+
+def memory_limit_bytes() -> int:
+    """Return the memory available to the container, or the physical memory."""
+    for path in CGROUP_MEMORY_LIMITS:
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value.isdigit():
+            return int(value)
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def worker_count(n_steps: int, step_bytes: int | None = None) -> int:
+    """
+    Number of workers allowed by the configuration and the memory budget.
+
+    Args:
+        n_steps (int): Number of steps to process.
+        step_bytes (int | None): Estimated footprint of the largest step,
+            bounding the workers by the memory ceiling when both are known.
+    """
+    settings = CONFIG.main.parallel
+    by_memory = int(memory_limit_bytes() // (settings.worker_memory_gb * 1024**3))
+    ceiling = memory_ceiling_bytes()
+    if ceiling is not None and step_bytes:
+        by_memory = min(by_memory, ceiling // step_bytes)
+    return max(1, min(settings.max_workers, by_memory, n_steps))
+
+
+def memory_ceiling_bytes() -> int | None:
+    ceiling_mb = CONFIG.main.memory.ceiling_mb
+    return None if ceiling_mb is None else ceiling_mb * 1024**2
+
+
+def estimate_step_bytes(
+    file_objs: list[FileObject],
+    message_index: typing.Callable[[str], list[typing.Any]],
+) -> int | None:
+    """
+    Estimate the memory needed to process a step from the GRIB headers of its
+    inputs, as grid points x decoded fields x bytes per value x overhead.
+
+    Args:
+        file_objs (list[FileObject]): File objects of the step.
+        message_index (Callable): Returns the GRIB messages of an input key.
+
+    Returns:
+        int | None: The estimate in bytes, or None if the grid size is
+        unknown, e.g. for inputs listed by a sidecar index.
+    """
+    from flexprep.domain.flexpart_utils import CONSTANTS, INPUT_FIELDS
+    from flexprep.domain.grib_utils import select_messages
+
+    settings = CONFIG.main.memory
+    n_fields, n_values = 0, 0
+    for file_obj in file_objs:
+        messages = select_messages(
+            message_index(file_obj["key"]), CONSTANTS | INPUT_FIELDS
+        )
+        n_fields += len(messages)
+        n_values = max([n_values] + [message.n_values or 0 for message in messages])
+    if not n_values:
+        return None
+    return int(n_fields * n_values * settings.bytes_per_value * settings.overhead)
+
+
+@functools.lru_cache(maxsize=None)
+def _warn_unknown_footprint() -> None:
+    logger.warning(
+        "The grid size of the inputs is unknown, e.g. as they are listed by a "
+        "sidecar index: steps are admitted without checking the memory ceiling."
+    )
+
+
+def admit_steps(
+    processable_steps: list[list[FileObject]], processing: typing.Any = None
+) -> tuple[list[list[FileObject]], list[list[FileObject]], int | None]:
+    """
+    Compare the estimated footprint of the steps with the memory ceiling.
+
+    Steps above the ceiling are either returned to be processed one at a
+    time, or released, depending on ``memory.on_exceed``. No retry is
+    scheduled for a released step: it is processed by the next run that
+    finds it processable, a later notification of the forecast or the
+    reconciler, which estimates it again. It is therefore only processed by
+    a run with a higher ceiling.
+
+    Returns:
+        tuple: The admitted steps, the steps to process alone and the largest
+        footprint of the admitted steps, if known.
+    """
+    from flexprep.domain.s3_utils import S3client
+
+    ceiling = typing.cast(int, memory_ceiling_bytes())
+    s3_client = processing.s3_client if processing is not None else S3client()
+    indexes: dict[str, list[typing.Any]] = {}
+
+    def message_index(key: str) -> list[typing.Any]:
+        # Inputs of step 0 and the constants are shared by all steps
+        if key not in indexes:
+            indexes[key] = s3_client.message_index(key)
+        return indexes[key]
+
+    admitted, alone = [], []
+    largest: int | None = None
+    for file_objs in processable_steps:
+        step = _step_of(file_objs)
+        try:
+            step_bytes = estimate_step_bytes(file_objs, message_index)
+        except Exception as e:
+            logger.warning(f"Could not estimate the footprint of timestep {step}: {e}")
+            step_bytes = None
+
+        if step_bytes is None:
+            _warn_unknown_footprint()
+        if step_bytes is None or step_bytes <= ceiling:
+            admitted.append(file_objs)
+            if step_bytes is not None:
+                largest = max(largest or 0, step_bytes)
+            continue
+
+        logger.warning(
+            f"Timestep {step} needs about {step_bytes / 1024**2:.0f} MiB, above "
+            f"the memory ceiling of {ceiling / 1024**2:.0f} MiB"
+        )
+        if CONFIG.main.memory.on_exceed == "alone":
+            alone.append(file_objs)
+        else:
+            _release_steps([file_objs], processing, retry=False)
+            logger.warning(
+                f"Timestep {step} is deferred to a run with a higher memory ceiling"
+            )
+    return admitted, alone, largest
+
+
+def _release_steps(
+    steps: list[list[FileObject]], processing: typing.Any, retry: bool
+) -> None:
+    """Release the lease of steps, so that a later run can process them."""
+    from flexprep.domain.db_utils import DB
+
+    db = getattr(processing, "db", None) or DB()
+    for file_objs in steps:
+        to_process = max(file_objs, key=lambda obj: int(obj["step"]))
+        db.release_item(to_process["row_id"], retry=retry)
+
+
+def chunk_steps(
+    processable_steps: list[list[FileObject]], n_chunks: int
+) -> list[list[list[FileObject]]]:
+    """
+    Split the steps into contiguous chunks of similar size.
+
+    Contiguous chunks let each worker run the sliding window over its share,
+    so that consecutive steps still reuse their decoded inputs.
+    """
+    ordered = sorted(processable_steps, key=_step_of)
+    size, remainder = divmod(len(ordered), n_chunks)
+    chunks, start = [], 0
+    for i in range(n_chunks):
+        end = start + size + (1 if i < remainder else 0)
+        chunks.append(ordered[start:end])
+        start = end
+    return [chunk for chunk in chunks if chunk]
+
+
+def process_chunk(chunk: list[list[FileObject]]) -> list[int]:
+    """Process a chunk of steps and return the steps that failed."""
+    # Imported here so that worker start-up only pays for it when needed
+    from flexprep.domain.processing import Processing
+
+    return Processing().process_window(chunk)
+
+
+def process_steps(
+    processable_steps: list[list[FileObject]], processing: typing.Any = None
+) -> list[int]:
+    """
+    Process independent steps, in parallel when the configuration allows it.
+
+    Each worker processes a contiguous chunk of steps. A failing step, or a
+    crashing worker, is reported per step without aborting the other chunks.
+    The leases of the steps of a crashed worker are released, so that the
+    next notification can retry them without waiting for the leases to expire.
+
+    Args:
+        processable_steps (list[list[FileObject]]): File objects per step.
+        processing (Processing | None): Instance to reuse when the steps are
+            processed in this process, e.g. by the daemon.
+
+    Returns:
+        list[int]: The steps that failed.
+    """
+    if not processable_steps:
+        return []
+
+    alone: list[list[FileObject]] = []
+    step_bytes = None
+    if memory_ceiling_bytes() is not None:
+        processable_steps, alone, step_bytes = admit_steps(
+            processable_steps, processing
+        )
+
+    failed_steps = _process_admitted(processable_steps, step_bytes, processing)
+    for file_objs in alone:
+        # Nothing else is held in memory while a large step is processed
+        logger.info(f"Processing timestep {_step_of(file_objs)} alone")
+        failed_steps.extend(_process_window([file_objs], processing))
+
+    for step in sorted(failed_steps):
+        logger.error(f"Timestep {step} failed")
+    return sorted(failed_steps)
+
+
+def _process_window(chunk: list[list[FileObject]], processing: typing.Any) -> list[int]:
+    if processing is not None:
+        return processing.process_window(chunk)
+    return process_chunk(chunk)
+
+
+def _process_admitted(
+    processable_steps: list[list[FileObject]],
+    step_bytes: int | None,
+    processing: typing.Any,
+) -> list[int]:
+    if not processable_steps:
+        return []
+
+    n_workers = worker_count(len(processable_steps), step_bytes)
+    chunks = chunk_steps(processable_steps, n_workers)
+    if n_workers == 1:
+        failed_steps = _process_window(chunks[0], processing)
+    else:
+        logger.info(
+            f"Processing {len(processable_steps)} timestep(s) with {n_workers} workers"
+        )
+        failed_steps = []
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = {executor.submit(process_chunk, chunk): chunk for chunk in chunks}
+            for future in as_completed(futures):
+                steps = [_step_of(file_objs) for file_objs in futures[future]]
+                try:
+                    failed_steps.extend(future.result())
+                except Exception as e:
+                    # e.g. BrokenProcessPool, the worker could not release them
+                    logger.error(f"Worker for timesteps {steps} failed: {e}")
+                    failed_steps.extend(steps)
+                    _release_steps(futures[future], processing, retry=True)
+    return failed_steps
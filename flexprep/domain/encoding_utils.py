@@ -0,0 +1,126 @@
+import collections
+import functools
+import io
+import logging
+import typing
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import eccodes
+from meteodatalab import grib_decoder, metadata
+
+from flexprep import CONFIG
+
+Packing = dict[str, typing.Any] | None
+
+
+class BinaryWriter(typing.Protocol):
+    """Destination of the encoded messages: a file or an upload stream."""
+
+    def write(self, data: bytes) -> int: ...
+
+    def tell(self) -> int: ...
+
+    def flush(self) -> None: ...
+
+
+# Default of grib_decoder.save
+DEFAULT_BITS_PER_VALUE = 16
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def eccodes_thread_safe() -> bool:
+    """
+    Check whether eccodes is built with thread safety (ECCODES_THREADS).
+
+    Versions without ``codes_get_features`` cannot tell, the build is then
+    taken as thread-safe only if ``encode.eccodes_threads`` declares it.
+    """
+    try:
+        features = eccodes.codes_get_features(eccodes.CODES_FEATURES_ENABLED)
+    except (AttributeError, eccodes.GribInternalError):
+        thread_safe = CONFIG.main.encode.eccodes_threads
+        if not thread_safe:
+            logger.warning(
+                "eccodes cannot tell whether it is built thread-safe, encoding "
+                "in one thread. Set encode.eccodes_threads if it is."
+            )
+        return thread_safe
+    thread_safe = bool(
+        {"ECCODES_THREADS", "ECCODES_OMP_THREADS"} & set(features.split())
+    )
+    if not thread_safe:
+        logger.warning("eccodes is not built thread-safe, encoding in one thread.")
+    return thread_safe
+
+
+def encode_field(field: typing.Any, packing: Packing = None) -> bytes:
+    """
+    Encode a field to GRIB in memory.
+
+    The packing keys other than bitsPerValue are set on the template of the
+    field, a single message, so that the values are packed once, from the
+    field, with the requested packing.
+
+    Args:
+        field: The field to encode, or its GRIB encoding, returned as is.
+        packing (dict | None): GRIB packing keys to apply to the encoding.
+    """
+    if isinstance(field, bytes):
+        return field
+    keys = dict(packing or {})
+    bits_per_value = keys.pop("bitsPerValue", DEFAULT_BITS_PER_VALUE)
+    if keys:
+        field = field.assign_attrs(metadata.override(field.message, **keys))
+    buffer = io.BytesIO()
+    grib_decoder.save(field, buffer, bits_per_value)
+    return buffer.getvalue()
+
+
+def write_fields(
+    fields: list[typing.Any],
+    output_file: BinaryWriter,
+    max_workers: int = 1,
+    packing: list[Packing] | None = None,
+) -> None:
+    """
+    Encode fields to GRIB and write them to a binary file object.
+
+    Items of ``fields`` that are already encoded (bytes) are written as is.
+
+    With several workers, the fields are encoded concurrently in threads,
+    each to its own buffer, since eccodes releases the GIL while packing.
+    The buffers are written in the order of ``fields``, so the output is
+    identical to the serial encoding. At most twice as many fields as
+    workers are encoded ahead of the one being written, which bounds the
+    memory held by the buffers. If eccodes is not built thread-safe, the
+    fields are encoded in one thread.
+
+    Args:
+        fields (list): Fields to encode, with their GRIB metadata set, or
+            their GRIB encoding.
+        output_file (BinaryWriter): Destination of the encoded messages.
+        max_workers (int): Number of fields encoded concurrently.
+        packing (list[dict | None] | None): GRIB packing keys per field.
+    """
+    packing = packing or [None] * len(fields)
+    if max_workers > 1 and not eccodes_thread_safe():
+        max_workers = 1
+    if max_workers <= 1:
+        for field, keys in zip(fields, packing):
+            if isinstance(field, bytes) or keys:
+                output_file.write(encode_field(field, keys))
+            else:
+                # save only writes to the file and flushes it
+                grib_decoder.save(field, typing.cast(io.BytesIO, output_file))
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight: collections.deque[Future[bytes]] = collections.deque()
+        for field, keys in zip(fields, packing):
+            if len(in_flight) >= 2 * max_workers:
+                output_file.write(in_flight.popleft().result())
+            in_flight.append(executor.submit(encode_field, field, keys))
+        while in_flight:
+            output_file.write(in_flight.popleft().result())
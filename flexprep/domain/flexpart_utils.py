@@ -2,6 +2,9 @@ import logging
 import typing
 from typing import Any
 
+import numpy as np
+import xarray as xr
+
 logger = logging.getLogger(__name__)
 
 FileObject = dict[str, Any]
@@ -28,6 +31,10 @@ INPUT_FIELDS = {
     "ewss",
     "nsss",
 }
+# Fields on model levels, the bulk of the inputs
+MODEL_LEVEL_FIELDS = {"u", "v", "etadot", "t", "q"}
+# Fields accumulated since the start of the forecast
+ACCUMULATED_FIELDS = {"cp", "lsp", "ssr", "sshf", "ewss", "nsss"}
 
 
 def prepare_output(
@@ -54,3 +61,101 @@ def prepare_output(
     ds_out["cp"] = (ds_out["cp"] * 1000).assign_attrs(ds_out["cp"].attrs)
 
     ds_out["lsp"] = (ds_out["lsp"] * 100).assign_attrs(ds_out["lsp"].attrs)
+
+
+def combine_lead_times(*datasets: dict[str, typing.Any]) -> dict[str, typing.Any]:
+    """
+    Combine datasets decoded from separate input files along lead_time.
+
+    The datasets must be given in ascending lead_time order. Fields present in
+    a single dataset only (e.g. the constants) are passed through unchanged.
+    The attributes of a combined field, its GRIB message included, are those
+    of the latest lead time, as when the files are decoded together with the
+    current step first.
+    """
+    names = dict.fromkeys(name for ds in datasets for name in ds)
+    combined = {}
+    for name in names:
+        arrays = [ds[name] for ds in datasets if name in ds]
+        if len(arrays) == 1:
+            combined[name] = arrays[0]
+            continue
+        combined[name] = xr.concat(arrays, dim="lead_time", combine_attrs="drop")
+        combined[name].attrs = dict(arrays[-1].attrs)
+    return combined
+
+
+def n_rows(ds: dict[str, typing.Any], dim: str = "y") -> int:
+    """Number of grid rows of a dataset."""
+    return max(array.sizes.get(dim, 0) for array in ds.values())
+
+
+def row_blocks(
+    ds: dict[str, typing.Any], rows_per_block: int, dim: str = "y"
+) -> typing.Iterator[dict[str, typing.Any]]:
+    """
+    Split a dataset into blocks of grid rows.
+
+    The blocks are views of the arrays of ``ds``. Fields without the ``dim``
+    dimension, e.g. the hybrid level coefficients, are part of every block.
+    """
+    for start in range(0, n_rows(ds, dim), rows_per_block):
+        rows = slice(start, start + rows_per_block)
+        yield {
+            name: array.isel({dim: rows}) if dim in array.dims else array
+            for name, array in ds.items()
+        }
+
+
+def _allocate_rows(array: xr.DataArray, rows: int, dim: str) -> xr.DataArray:
+    """Allocate ``array`` with ``rows`` rows, the coordinates along ``dim`` too."""
+
+    def empty(variable: xr.Variable) -> xr.Variable:
+        shape = [rows if d == dim else size for d, size in variable.sizes.items()]
+        return xr.Variable(
+            variable.dims, np.empty(shape, variable.dtype), variable.attrs
+        )
+
+    coords = {
+        name: empty(coord.variable) if dim in coord.dims else coord.variable
+        for name, coord in array.coords.items()
+        if name != dim
+    }
+    return xr.DataArray(
+        empty(array.variable), coords=coords, name=array.name, attrs=array.attrs
+    )
+
+
+def concat_rows(
+    blocks: typing.Iterable[dict[str, typing.Any]], rows: int, dim: str = "y"
+) -> dict[str, typing.Any]:
+    """
+    Join blocks of grid rows, as split by ``row_blocks``, as they are produced.
+
+    Each field is allocated with all ``rows`` when it first appears and the
+    rows of every block are copied into it, so that a block is freed before
+    the next one is computed and the output is never held twice.
+    """
+    combined: dict[str, typing.Any] = {}
+    index_coords: dict[str, list[xr.DataArray]] = {}
+    start = 0
+    for block in blocks:
+        size = 0
+        for name, array in block.items():
+            if dim not in array.dims:
+                combined.setdefault(name, array)
+                continue
+            if name not in combined:
+                combined[name] = _allocate_rows(array, rows, dim)
+            size = array.sizes[dim]
+            target = {dim: slice(start, start + size)}
+            combined[name].variable[target] = array.variable
+            for coord_name, coord in array.coords.items():
+                if coord_name == dim:
+                    index_coords.setdefault(name, []).append(coord)
+                elif dim in coord.dims:
+                    combined[name].coords[coord_name].variable[target] = coord.variable
+        start += size
+    for name, coords in index_coords.items():
+        combined[name] = combined[name].assign_coords({dim: xr.concat(coords, dim)})
+    return combined
@@ -0,0 +1,418 @@
+import functools
+import json
+import logging
+import os
+import tempfile
+import typing
+from dataclasses import asdict, dataclass
+from datetime import datetime
+
+import eccodes
+
+logger = logging.getLogger(__name__)
+
+# Number of hours per unit of time range (GRIB code table 4.4 / GRIB1 table 4)
+TIME_UNIT_HOURS = {0: 1 / 60, 1: 1, 2: 24, 10: 3, 11: 6, 12: 12, 13: 1 / 3600}
+GRIB1_TIME_UNIT_HOURS = TIME_UNIT_HOURS | {13: 1 / 4, 14: 1 / 2, 254: 1 / 3600}
+
+INDEX_SUFFIX = ".idx"
+SECTION0_LENGTH = 16
+MISSING_U8 = 0xFF
+MISSING_U32 = 0xFFFFFFFF
+
+
+class IncompleteHeader(Exception):
+    """Raised when a buffer ends before the message header does."""
+
+    def __init__(self, needed: int) -> None:
+        super().__init__(f"Header requires {needed} bytes")
+        self.needed = needed
+
+
+@dataclass
+class GribMessage:
+    offset: int
+    length: int
+    edition: int
+    short_name: str
+    level: float | None
+    step: int
+    ref_time: datetime
+    # Number of grid points, unknown for messages of a sidecar index
+    n_values: int | None = None
+
+    def to_dict(self) -> dict[str, typing.Any]:
+        return asdict(self) | {"ref_time": self.ref_time.isoformat()}
+
+    @classmethod
+    def from_dict(cls, values: dict[str, typing.Any]) -> "GribMessage":
+        return cls(**values | {"ref_time": datetime.fromisoformat(values["ref_time"])})
+
+
+def _uint(buf: bytes, start: int, size: int) -> int:
+    end = start + size
+    if end > len(buf):
+        raise IncompleteHeader(end)
+    return int.from_bytes(buf[start:end], "big")
+
+
+def _int8(value: int) -> int:
+    """Decode a GRIB sign-and-magnitude single byte integer."""
+    return -(value & 0x7F) if value & 0x80 else value
+
+
+@functools.lru_cache(maxsize=None)
+def _resolve_short_name(sample: str, keys: tuple[tuple[str, int | None], ...]) -> str:
+    """
+    Resolve the shortName of a header by setting its keys on an eccodes sample.
+
+    This reuses the concept tables of eccodes instead of maintaining a
+    parameter table here. Keys are set in order, so that template numbers are
+    applied before the keys they define.
+    """
+    handle = eccodes.codes_grib_new_from_samples(sample)
+    try:
+        for key, value in keys:
+            if value is None:
+                eccodes.codes_set_missing(handle, key)
+            else:
+                eccodes.codes_set(handle, key, value)
+        return eccodes.codes_get(handle, "shortName")
+    finally:
+        eccodes.codes_release(handle)
+
+
+def _hours(value: float) -> int:
+    return int(round(value))
+
+
+def _parse_grib1(buf: bytes, offset: int) -> GribMessage:
+    length = _uint(buf, 4, 3)
+    if length & 0x800000:
+        raise ValueError("Large GRIB1 messages are not supported by the header scan")
+
+    pds = 8
+    pds_length = _uint(buf, pds, 3)
+    _uint(buf, pds, 28)
+    centre = buf[pds + 4]
+    level_type = buf[pds + 9]
+    level = _uint(buf, pds + 10, 2)
+    time_range_indicator = buf[pds + 20]
+    p1, p2 = buf[pds + 18], buf[pds + 19]
+    unit = GRIB1_TIME_UNIT_HOURS[buf[pds + 17]]
+    if time_range_indicator == 10:
+        step = (p1 << 8 | p2) * unit
+    elif time_range_indicator in (2, 3, 4, 5):
+        step = p2 * unit
+    elif time_range_indicator == 1:
+        step = 0
+    else:
+        step = p1 * unit
+
+    short_name = _resolve_short_name(
+        "GRIB1",
+        (
+            ("centre", centre),
+            ("table2Version", buf[pds + 3]),
+            ("indicatorOfParameter", buf[pds + 8]),
+            ("indicatorOfTypeOfLevel", level_type),
+            ("level", level),
+        ),
+    )
+    ref_time = datetime(
+        (buf[pds + 24] - 1) * 100 + buf[pds + 12],
+        buf[pds + 13],
+        buf[pds + 14],
+        buf[pds + 15],
+        buf[pds + 16],
+    )
+
+    n_values = None
+    if buf[pds + 7] & 0x80:
+        # Regular and Gaussian grids of the grid description section
+        gds = pds + pds_length
+        _uint(buf, gds, 10)
+        ni, nj = _uint(buf, gds + 6, 2), _uint(buf, gds + 8, 2)
+        if buf[gds + 5] in (0, 4) and ni != 0xFFFF:
+            n_values = ni * nj
+    return GribMessage(
+        offset, length, 1, short_name, level, _hours(step), ref_time, n_values
+    )
+
+
+def _parse_grib2(buf: bytes, offset: int) -> GribMessage:
+    discipline = buf[6]
+    length = _uint(buf, 8, 8)
+    identification: list[tuple[str, int | None]] = []
+    ref_time = None
+    n_values = None
+
+    pos = SECTION0_LENGTH
+    while True:
+        section_length = _uint(buf, pos, 4)
+        section_number = _uint(buf, pos + 4, 1)
+        if section_number == 1:
+            _uint(buf, pos, 21)
+            identification = [
+                ("centre", _uint(buf, pos + 5, 2)),
+                ("tablesVersion", buf[pos + 9]),
+                ("localTablesVersion", buf[pos + 10]),
+            ]
+            ref_time = datetime(
+                _uint(buf, pos + 12, 2),
+                buf[pos + 14],
+                buf[pos + 15],
+                buf[pos + 16],
+                buf[pos + 17],
+            )
+        elif section_number == 3:
+            n_values = _uint(buf, pos + 6, 4)
+        elif section_number == 4:
+            break
+        elif section_number > 4 or section_length == 0:
+            raise ValueError(f"No product definition section at offset {offset}")
+        pos += section_length
+
+    template = _uint(buf, pos + 7, 2)
+    _uint(buf, pos, 34)
+    unit = TIME_UNIT_HOURS[buf[pos + 17]]
+    step = _uint(buf, pos + 18, 4) * unit
+    scale_factor = buf[pos + 23]
+    scaled_value = _uint(buf, pos + 24, 4)
+
+    keys = identification + [
+        ("productDefinitionTemplateNumber", template),
+        ("discipline", discipline),
+        ("parameterCategory", buf[pos + 9]),
+        ("parameterNumber", buf[pos + 10]),
+        ("typeOfFirstFixedSurface", buf[pos + 22]),
+        (
+            "scaleFactorOfFirstFixedSurface",
+            None if scale_factor == MISSING_U8 else _int8(scale_factor),
+        ),
+        (
+            "scaledValueOfFirstFixedSurface",
+            None if scaled_value == MISSING_U32 else scaled_value,
+        ),
+        ("typeOfSecondFixedSurface", buf[pos + 28]),
+    ]
+    if template == 8:
+        _uint(buf, pos, 53)
+        keys.append(("typeOfStatisticalProcessing", buf[pos + 46]))
+        step += _uint(buf, pos + 49, 4) * TIME_UNIT_HOURS[buf[pos + 48]]
+
+    level = (
+        None
+        if MISSING_U32 == scaled_value or scale_factor == MISSING_U8
+        else scaled_value / 10 ** _int8(scale_factor)
+    )
+    short_name = _resolve_short_name("GRIB2", tuple(keys))
+    return GribMessage(
+        offset,
+        length,
+        2,
+        short_name,
+        level,
+        _hours(step),
+        typing.cast(datetime, ref_time),
+        n_values,
+    )
+
+
+def parse_header(buf: bytes, offset: int = 0) -> GribMessage:
+    """
+    Parse the identifying keys of a GRIB message from its leading bytes.
+
+    Args:
+        buf (bytes): Bytes starting at the beginning of the message.
+        offset (int): Offset of the message in its file.
+
+    Raises:
+        IncompleteHeader: If ``buf`` ends before the product definition.
+        ValueError: If ``buf`` does not start with a supported GRIB message.
+    """
+    if len(buf) < SECTION0_LENGTH:
+        raise IncompleteHeader(SECTION0_LENGTH)
+    if buf[:4] != b"GRIB":
+        raise ValueError(f"No GRIB message found at offset {offset}")
+    edition = buf[7]
+    if edition == 1:
+        return _parse_grib1(buf, offset)
+    if edition == 2:
+        return _parse_grib2(buf, offset)
+    raise ValueError(f"Unsupported GRIB edition {edition} at offset {offset}")
+
+
+def scan_messages(
+    read: typing.Callable[[int, int], bytes], size: int, block_size: int = 65536
+) -> list[GribMessage]:
+    """
+    List the messages of a GRIB file by reading its section headers only.
+
+    Args:
+        read (Callable[[int, int], bytes]): Returns the bytes in [start, end).
+        size (int): Total size of the file in bytes.
+        block_size (int): Minimum number of bytes fetched per read, so that
+            the headers of several small messages are served by a single read.
+
+    Returns:
+        list[GribMessage]: The messages in file order.
+    """
+    messages = []
+    window_start, window = 0, b""
+    offset = 0
+    needed = SECTION0_LENGTH
+    while offset < size:
+        end = min(offset + needed, size)
+        if offset < window_start or end > window_start + len(window):
+            window_start = offset
+            window = read(offset, min(offset + max(needed, block_size), size))
+        try:
+            start = offset - window_start
+            message = parse_header(window[start:], offset)
+        except IncompleteHeader as e:
+            if offset + e.needed > size:
+                raise ValueError(f"Truncated GRIB message at offset {offset}") from e
+            needed = e.needed
+            continue
+        if offset + message.length > size:
+            raise ValueError(f"Truncated GRIB message at offset {offset}")
+        messages.append(message)
+        offset += message.length
+        needed = SECTION0_LENGTH
+    return messages
+
+
+def select_messages(
+    messages: list[GribMessage], params: typing.Collection[str]
+) -> list[GribMessage]:
+    return [message for message in messages if message.short_name in params]
+
+
+def coalesce_ranges(messages: list[GribMessage]) -> list[tuple[int, int]]:
+    """Merge the byte ranges of adjacent messages into [start, end) ranges."""
+    ranges: list[tuple[int, int]] = []
+    for message in sorted(messages, key=lambda m: m.offset):
+        start, end = message.offset, message.offset + message.length
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+def _short_name_from_param(param: str) -> str:
+    """
+    Return the shortName of a MARS ``param``.
+
+    The param is either a shortName, a paramId or a parameter number and
+    table in the ``<number>.<table>`` notation, e.g. ``130.128``.
+    """
+    number, _, table = param.partition(".")
+    if not number.isdigit() or not (table == "" or table.isdigit()):
+        return param
+    param_id = int(number)
+    if table not in ("", "128"):
+        param_id += int(table) * 1000
+    try:
+        return _resolve_short_name("GRIB2", (("paramId", param_id),))
+    except eccodes.GribInternalError as e:
+        raise ValueError(f"Unknown parameter {param} in the index") from e
+
+
+def parse_sidecar_index(lines: typing.Iterable[str]) -> list[GribMessage]:
+    """
+    Parse a sidecar index in the ECMWF JSON-lines format.
+
+    Each line describes one message with its ``_offset`` and ``_length`` and
+    the MARS keys ``param``, ``levelist``, ``step``, ``date`` and ``time``.
+    """
+    messages = []
+    for line in lines:
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        levelist = entry.get("levelist")
+        messages.append(
+            GribMessage(
+                offset=int(entry["_offset"]),
+                length=int(entry["_length"]),
+                edition=int(entry.get("edition", 0)),
+                short_name=_short_name_from_param(str(entry["param"])),
+                level=float(levelist) if levelist not in (None, "") else None,
+                step=int(entry.get("step", 0)),
+                ref_time=datetime.strptime(
+                    f"{entry['date']}{int(entry['time']):04d}", "%Y%m%d%H%M"
+                ),
+            )
+        )
+    return messages
+
+
+def write_index(index_path: str, messages: list[GribMessage]) -> None:
+    """
+    Atomically write a message index as JSON lines.
+
+    The index is written aside with a ``.partial`` suffix, which the file
+    cache ignores, so that it is never taken for a cache entry.
+    """
+    fd, partial_path = tempfile.mkstemp(
+        dir=os.path.dirname(index_path) or ".", suffix=".partial"
+    )
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.writelines(json.dumps(message.to_dict()) + "\n" for message in messages)
+        os.replace(partial_path, index_path)
+    except Exception:
+        os.unlink(partial_path)
+        raise
+
+
+def read_index(index_path: str) -> list[GribMessage]:
+    with open(index_path) as f:
+        return [GribMessage.from_dict(json.loads(line)) for line in f]
+
+
+def index_file(path: str) -> list[GribMessage]:
+    """
+    Return the message index of a local GRIB file.
+
+    The index is built on first use and persisted next to the file as
+    ``<path>.idx``. Files are never modified in place (cache entries are
+    content-addressed), so an existing index is always valid.
+    """
+    index_path = path + INDEX_SUFFIX
+    if os.path.exists(index_path):
+        return read_index(index_path)
+
+    with open(path, "rb") as f:
+
+        def read(start: int, end: int) -> bytes:
+            f.seek(start)
+            return f.read(end - start)
+
+        messages = scan_messages(read, os.path.getsize(path))
+
+    write_index(index_path, messages)
+    logger.debug(f"Indexed {len(messages)} messages of {path}")
+    return messages
+
+
+def index_buffer(data: bytes) -> list[GribMessage]:
+    """Return the message index of GRIB data held in memory."""
+    return scan_messages(lambda start, end: data[start:end], len(data))
+
+
+def extract_buffer(data: bytes, messages: list[GribMessage]) -> bytes:
+    """Return the given messages of GRIB data held in memory."""
+    return b"".join(data[start:end] for start, end in coalesce_ranges(messages))
+
+
+def extract_messages(
+    path: str, messages: list[GribMessage], out: typing.BinaryIO
+) -> None:
+    """Copy the given messages of a local GRIB file to ``out``."""
+    with open(path, "rb") as f:
+        for start, end in coalesce_ranges(messages):
+            f.seek(start)
+            out.write(f.read(end - start))
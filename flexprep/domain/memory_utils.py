@@ -0,0 +1,36 @@
+import dataclasses as dc
+import typing
+
+import earthkit.data as ekd  # type: ignore
+from meteodatalab import data_source
+
+
+@dc.dataclass
+class MemoryDataSource(data_source.DataSource):
+    """
+    Data source reading GRIB messages from local files and memory buffers.
+
+    The buffers are decoded in place, without writing them to disk first.
+    ``parts`` maps local files to the (offset, length) byte ranges of the
+    messages to read, so that only these messages are read from the files.
+
+    Only the ``_retrieve`` extension point of ``DataSource`` is implemented,
+    as by the data sources of meteodatalab, so that this does not depend on
+    the internals of ``FileDataSource``.
+    """
+
+    datafiles: list[str] = dc.field(default_factory=list)
+    buffers: list[bytes] = dc.field(default_factory=list)
+    parts: dict[str, list[tuple[int, int]]] = dc.field(default_factory=dict)
+
+    def _retrieve(self, request: dict) -> typing.Iterator:
+        req_kwargs = self.request_template | request
+        selection = {f"metadata.{k}": v for k, v in req_kwargs.items()}
+        sources = [ekd.from_source("file", path) for path in self.datafiles]
+        sources += [
+            ekd.from_source("file", path, parts=parts)
+            for path, parts in self.parts.items()
+        ]
+        sources += [ekd.from_source("memory", buffer) for buffer in self.buffers]
+        for source in sources:
+            yield from source.to_fieldlist().sel(selection)
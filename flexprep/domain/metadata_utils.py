@@ -0,0 +1,138 @@
+import logging
+import typing
+from datetime import datetime
+
+import numpy as np
+from meteodatalab import config, metadata
+
+from flexprep.domain.encoding_utils import encode_field
+
+logger = logging.getLogger(__name__)
+
+REF_KEYS = "editionNumber", "productDefinitionTemplateNumber"
+REF_VALUES = 2, 0
+
+
+def _step_hours(field: typing.Any) -> int:
+    return int(field["lead_time"].values[-1] // np.timedelta64(1, "h"))
+
+
+class MetadataCache:
+    """
+    GRIB metadata shared by all steps of a forecast.
+
+    Holds the reference message of the output, the metadata templates
+    derived from it by ``metadata.override``, the hybrid level coefficients
+    of the input and the encoded constant fields. Keys depending on the step
+    (forecastTime, dataDate, dataTime) are set by the encoder for every
+    field, so these values can be reused until a new forecast reference
+    time arrives.
+
+    Templates with statistical processing (productDefinitionTemplateNumber
+    8) are the exception: the end of their overall time interval is not set
+    by the encoder. They are derived from the reference message of the step
+    being encoded and only reused within that step.
+    """
+
+    def __init__(self) -> None:
+        self.forecast_ref_time: datetime | None = None
+        self._reference: tuple[int, str] | None = None
+        self._templates: dict[tuple[str, int | None], dict[str, typing.Any]] = {}
+        # Templates depending on the step of the reference
+        self._step_templates: dict[tuple[str, int], dict[str, typing.Any]] = {}
+        self._pv: dict[str, typing.Any] | None = None
+        self._editions: dict[str, int] = {}
+        self._encoded: dict[str, bytes] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def set_forecast(self, forecast_ref_time: datetime) -> None:
+        """Invalidate the cache if ``forecast_ref_time`` is a new forecast."""
+        if forecast_ref_time == self.forecast_ref_time:
+            return
+        if self.forecast_ref_time is not None:
+            logger.info(
+                f"New forecast {forecast_ref_time}, clearing the metadata cache."
+            )
+        self.forecast_ref_time = forecast_ref_time
+        self._reference = None
+        self._templates.clear()
+        self._step_templates.clear()
+        self._pv = None
+        self._editions.clear()
+        self._encoded.clear()
+
+    def pv(self, message: str) -> dict[str, typing.Any]:
+        """Return the hybrid level coefficients extracted from ``message``."""
+        if self._pv is None:
+            with config.set_values(data_scope="ifs"):
+                self._pv = metadata.extract_pv(message)
+        return self._pv
+
+    def edition(self, name: str, message: str) -> int:
+        """Return the GRIB edition of the output field ``name``."""
+        if name not in self._editions:
+            self._editions[name] = metadata.extract_keys(message, "editionNumber")
+        return self._editions[name]
+
+    def reference(self, ds_out: dict[str, typing.Any]) -> str:
+        """Return the message of an edition 2 output field without statistics."""
+        # The constants keep the lead time of their input, the step is the
+        # latest lead time of the output
+        step = max(_step_hours(field) for field in ds_out.values())
+        if self._reference is None or self._reference[0] != step:
+            self._step_templates.clear()
+            self._reference = step, next(
+                field.message
+                for field in ds_out.values()
+                if metadata.extract_keys(field.message, REF_KEYS) == REF_VALUES
+            )
+        return self._reference[1]
+
+    def template(
+        self,
+        ds_out: dict[str, typing.Any],
+        short_name: str,
+        product_definition_template: int | None = None,
+    ) -> dict[str, typing.Any]:
+        """
+        Return the reference metadata overridden with a shortName and,
+        if given, a productDefinitionTemplateNumber.
+
+        Templates with a productDefinitionTemplateNumber are reused within
+        the step of ``ds_out`` only.
+        """
+        reference = self.reference(ds_out)
+        templates: dict[typing.Any, dict[str, typing.Any]] = self._templates
+        if product_definition_template is not None:
+            templates = self._step_templates
+        key = short_name, product_definition_template
+        if key in templates:
+            self.hits += 1
+            return templates[key]
+
+        self.misses += 1
+        # The template number is set first, as it redefines the other keys
+        overrides: dict[str, typing.Any] = {}
+        if product_definition_template is not None:
+            overrides["productDefinitionTemplateNumber"] = product_definition_template
+        overrides["shortName"] = short_name
+        templates[key] = metadata.override(reference, **overrides)
+        return templates[key]
+
+    def encoded_constant(
+        self,
+        name: str,
+        field: typing.Any,
+        packing: dict[str, typing.Any] | None = None,
+    ) -> bytes:
+        """
+        Return a constant field encoded as GRIB, with the given packing keys.
+
+        The field is encoded on first use only and reused by the later steps.
+        The constants keep the lead time of their step-0 input, so their
+        encoding does not depend on the step.
+        """
+        if name not in self._encoded:
+            self._encoded[name] = encode_field(field, packing)
+        return self._encoded[name]
@@ -0,0 +1,241 @@
+import contextlib
+import fcntl
+import json
+import logging
+import operator
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+import typing
+
+from flexprep import CONFIG
+
+logger = logging.getLogger(__name__)
+
+# Span attributes exported as metrics, with their help text and how the
+# spans of a stage are aggregated
+SPAN_METRICS: dict[str, tuple[str, str, typing.Callable[[float, float], float]]] = {
+    "seconds": (
+        "flexprep_stage_duration_seconds",
+        "Duration of the stage",
+        operator.add,
+    ),
+    "bytes": ("flexprep_stage_bytes", "Bytes moved by the stage", operator.add),
+    "fields": ("flexprep_stage_fields", "Fields handled by the stage", operator.add),
+    "rss_bytes": (
+        "flexprep_stage_rss_bytes",
+        "Resident memory at the end of the stage",
+        max,
+    ),
+    "peak_rss_bytes": (
+        "flexprep_stage_peak_rss_bytes",
+        "Peak resident memory of the process up to the end of the stage",
+        max,
+    ),
+    "traced_peak_bytes": (
+        "flexprep_stage_traced_peak_bytes",
+        "Peak of the memory allocated by Python during the stage",
+        max,
+    ),
+}
+# Number of allocation sites logged per stage when tracing allocations
+SNAPSHOT_LINES = 5
+
+
+def rss_bytes() -> int | None:
+    """Return the resident memory of the process, if known."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def peak_rss_bytes() -> int:
+    """Return the peak resident memory of the process (Linux reports KiB)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def slot_textfile(textfile: str, slot: int) -> str:
+    """Return the metrics file of a slot: ``<name>.<slot>.prom``."""
+    root, ext = os.path.splitext(textfile)
+    return f"{root}.{slot}{ext}"
+
+
+def claim_slot(textfile: str) -> tuple[int, typing.TextIO]:
+    """
+    Claim the lowest metrics slot that no running process holds.
+
+    The slot is held with ``flock`` on ``<name>.<slot>.lock`` until the
+    returned file is closed, at the latest when the process exits.
+
+    Returns:
+        tuple[int, TextIO]: The slot and its open lock file.
+    """
+    root, _ = os.path.splitext(textfile)
+    slot = 0
+    while True:
+        lock = open(f"{root}.{slot}.lock", "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            slot += 1
+            continue
+        return slot, lock
+
+
+class Metrics:
+    """
+    Timing spans of the processing stages of a step.
+
+    Each span is logged as a JSON record. When a step is finished, the spans
+    are aggregated by stage and written to a file in the Prometheus text
+    format, for the textfile collector of the node exporter. Every process
+    writes its own file, ``<name>.<slot>.prom`` next to ``textfile``, with a
+    ``slot`` label on its series. The slot is the lowest one not held by a
+    running process, so the series and files are bounded by the number of
+    concurrent processes and are kept across runs.
+    When disabled, spans only cost an empty context manager.
+
+    Spans record the resident memory of the process and, with
+    ``trace_allocations``, the peak of the Python allocations of the stage and
+    its main allocation sites. Tracing slows down the processing noticeably
+    and the peak is reset by every span, so spans must not be nested.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        textfile: str | None = None,
+        trace_allocations: bool = False,
+    ) -> None:
+        self.enabled = enabled
+        self.textfile = textfile
+        self.trace_allocations = enabled and trace_allocations
+        self.step: int | None = None
+        self.spans: list[dict[str, typing.Any]] = []
+        # Slot of the metrics file and its lock, with the pid that claimed it
+        self._slot: tuple[int, typing.TextIO, int] | None = None
+        if self.trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @classmethod
+    def from_config(cls) -> "Metrics":
+        settings = CONFIG.main.metrics
+        return cls(settings.enabled, settings.textfile, settings.tracemalloc)
+
+    def start_step(self, step: int) -> None:
+        self.step = step
+        self.spans = []
+
+    @contextlib.contextmanager
+    def span(
+        self, stage: str, start: float | None = None
+    ) -> typing.Iterator[dict[str, typing.Any]]:
+        """
+        Time a stage of the current step.
+
+        Args:
+            stage (str): Name of the stage.
+            start (float | None): ``time.perf_counter()`` at which the stage
+                started, if before the span, e.g. for a stage running in
+                the background of the previous one.
+
+        Yields:
+            dict: The record of the span, to which the stage can add
+            ``bytes`` and ``fields``.
+        """
+        if not self.enabled:
+            yield {}
+            return
+
+        record: dict[str, typing.Any] = {"span": stage, "step": self.step}
+        if self.trace_allocations:
+            tracemalloc.reset_peak()
+        if start is None:
+            start = time.perf_counter()
+        try:
+            yield record
+        except Exception:
+            record["failed"] = True
+            raise
+        finally:
+            record["seconds"] = round(time.perf_counter() - start, 6)
+            self._record_memory(record)
+            self.spans.append(record)
+            logger.info(json.dumps(record))
+
+    def _record_memory(self, record: dict[str, typing.Any]) -> None:
+        rss = rss_bytes()
+        if rss is not None:
+            record["rss_bytes"] = rss
+        record["peak_rss_bytes"] = peak_rss_bytes()
+        if not self.trace_allocations:
+            return
+
+        record["traced_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        if logger.isEnabledFor(logging.DEBUG):
+            statistics = tracemalloc.take_snapshot().statistics("lineno")
+            for statistic in statistics[:SNAPSHOT_LINES]:
+                logger.debug(f"Allocated in {record['span']}: {statistic}")
+
+    def finish_step(self, success: bool) -> None:
+        """Write the spans of the current step to the metrics file."""
+        if not self.enabled or self.textfile is None:
+            return
+        try:
+            self._write_textfile(success)
+        except OSError as e:
+            logger.warning(f"Could not write metrics to {self.textfile}: {e}")
+
+    def _write_textfile(self, success: bool) -> None:
+        textfile = typing.cast(str, self.textfile)
+        totals: dict[str, dict[str, float]] = {}
+        for record in self.spans:
+            stage = totals.setdefault(record["span"], {})
+            for key, (_, _, aggregate) in SPAN_METRICS.items():
+                if key in record:
+                    stage[key] = (
+                        aggregate(stage[key], record[key])
+                        if key in stage
+                        else record[key]
+                    )
+
+        directory = os.path.dirname(textfile) or "."
+        os.makedirs(directory, exist_ok=True)
+        # A forked process inherits the slot of its parent but not its lock
+        if self._slot is None or self._slot[2] != os.getpid():
+            self._slot = (*claim_slot(textfile), os.getpid())
+        slot = self._slot[0]
+        lines = []
+        for key, (name, help_text, _) in SPAN_METRICS.items():
+            lines += [
+                f"# HELP {name} {help_text} in the last step of the process.",
+                f"# TYPE {name} gauge",
+            ]
+            lines += [
+                f'{name}{{slot="{slot}",stage="{stage}"}} {values[key]}'
+                for stage, values in totals.items()
+                if key in values
+            ]
+        lines += [
+            "# HELP flexprep_last_step Last step processed by the process.",
+            "# TYPE flexprep_last_step gauge",
+            f'flexprep_last_step{{slot="{slot}"}} {self.step}',
+            "# HELP flexprep_last_step_success Whether the last step succeeded.",
+            "# TYPE flexprep_last_step_success gauge",
+            f'flexprep_last_step_success{{slot="{slot}"}} {int(success)}',
+            "# HELP flexprep_last_step_timestamp_seconds End of the last step.",
+            "# TYPE flexprep_last_step_timestamp_seconds gauge",
+            f'flexprep_last_step_timestamp_seconds{{slot="{slot}"}} {time.time()}',
+        ]
+
+        # Write atomically, the collector may read the file at any time
+        fd, partial_path = tempfile.mkstemp(dir=directory, suffix=".partial")
+        with os.fdopen(fd, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.chmod(partial_path, 0o644)
+        os.replace(partial_path, slot_textfile(textfile, slot))
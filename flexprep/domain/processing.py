@@ -1,115 +1,459 @@
 import logging
 import os
 import tempfile
+import time
 import typing
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime as dt
 from datetime import timedelta
 
+import eccodes
 import meteodatalab.operators.flexpart as flx
-from meteodatalab import config, data_source, grib_decoder, metadata
+from meteodatalab import config, data_source, grib_decoder
 
+from flexprep import CONFIG
 from flexprep.domain.db_utils import DB
-from flexprep.domain.flexpart_utils import CONSTANTS, INPUT_FIELDS, prepare_output
+from flexprep.domain.encoding_utils import BinaryWriter, Packing, write_fields
+from flexprep.domain.flexpart_utils import (
+    ACCUMULATED_FIELDS,
+    CONSTANTS,
+    INPUT_FIELDS,
+    MODEL_LEVEL_FIELDS,
+    combine_lead_times,
+    concat_rows,
+    n_rows,
+    prepare_output,
+    row_blocks,
+)
+from flexprep.domain.grib_utils import (
+    coalesce_ranges,
+    extract_buffer,
+    index_buffer,
+    index_file,
+    select_messages,
+)
+from flexprep.domain.memory_utils import MemoryDataSource
+from flexprep.domain.metadata_utils import MetadataCache
+from flexprep.domain.metrics_utils import Metrics
 from flexprep.domain.s3_utils import S3client
-from flexprep.domain.validation_utils import validate_dataset
+from flexprep.domain.state_utils import AccumulationState
+from flexprep.domain.store_utils import FieldStore
+from flexprep.domain.validation_utils import validate_dataset, validate_headers
 
 logger = logging.getLogger(__name__)
 
+# A downloaded input: the path of a local file or its content in memory
+Input = str | bytes
+
+
+def _input_size(local_input: Input) -> int:
+    if isinstance(local_input, bytes):
+        return len(local_input)
+    return os.path.getsize(local_input)
+
 
 class Processing:
     FileObject = dict[str, typing.Any]
 
-    def __init__(self) -> None:
+    def __init__(self, db: DB | None = None) -> None:
         self.s3_client = S3client()
+        self.db = db
+        self.metadata_cache = MetadataCache()
+        self.metrics = Metrics.from_config()
+        settings = CONFIG.main.state
+        self.accumulation_state = (
+            AccumulationState(settings.path, settings.dtype, settings.keep_forecasts)
+            if settings.enabled
+            else None
+        )
+        store_settings = CONFIG.main.field_store
+        self.field_store = (
+            FieldStore(
+                store_settings.path,
+                int(store_settings.max_size_gb * 1024**3),
+                store_settings.keep_forecasts,
+            )
+            if store_settings.enabled
+            else None
+        )
 
-    def process(self, file_objs: list[FileObject]) -> None:
-        if file_objs:
-            logger.info(f"Processing timestep: {file_objs[-1]['step']}")
-
-        result = self._sort_and_download_files(file_objs)
-        if result is None:
-            logger.exception("Failed to sort and download files.")
-            raise
+    def process_window(self, processable_steps: list[list[FileObject]]) -> list[int]:
+        """
+        Process several steps of one forecast in a single pass.
 
-        temp_files, to_process, prev_file = result
+        The steps are walked in ascending order. The decoded step-0 and
+        constants fields are kept for the whole window and the decoded current
+        step is reused as the previous step of the next one, so that each step
+        only decodes its own input file.
 
-        ds_in = self._load_and_validate_data(temp_files, to_process, prev_file)
-        if ds_in is None:
-            logger.exception("Failed to load and validate data.")
-            raise
+        Args:
+            processable_steps (list[list[FileObject]]): File objects per step,
+            as returned by ``DB.get_processable_steps``.
 
-        ds_out = self._apply_flexpart(ds_in)
-        self._save_output(
-            ds_out,
-            to_process["forecast_ref_time"],
-            int(to_process["step"]),
-            to_process["row_id"],
+        Returns:
+            list[int]: The steps that failed. A failing step is logged and
+            does not prevent the remaining steps from being processed.
+        """
+        window = sorted(
+            processable_steps, key=lambda objs: max(int(obj["step"]) for obj in objs)
         )
+        params = list(CONSTANTS | INPUT_FIELDS)
 
-    def _sort_and_download_files(
-        self, file_objs: list[FileObject]
-    ) -> tuple[list[str], FileObject, FileObject] | None:
-        """Sort file objects, validate, and select files for processing."""
-        try:
-            sorted_files = sorted(file_objs, key=lambda x: int(x["step"]), reverse=True)
-            if len(sorted_files) < 3:
-                raise ValueError("Not enough files for pre-processing")
+        step_zero_ds: dict[str, typing.Any] | None = None
+        last_step: int | None = None
+        last_ds: dict[str, typing.Any] = {}
+        failed_steps = []
 
+        for file_objs in window:
+            sorted_files = sorted(file_objs, key=lambda x: int(x["step"]), reverse=True)
             to_process = sorted_files[0]
-            prev_file = sorted_files[1]
+            step = int(to_process["step"])
+            logger.info(f"Processing timestep: {step}")
+            self.metadata_cache.set_forecast(to_process["forecast_ref_time"])
+            self.metrics.start_step(step)
 
-            init_files = (
-                sorted_files[2:4] if int(prev_file["step"]) == 0 else sorted_files[2:4]
-            )
-            files_to_download = [to_process, prev_file] + init_files
+            success = False
+            try:
+                if len(sorted_files) < 3:
+                    raise ValueError("Not enough files for pre-processing")
+                prev_file = sorted_files[1]
+                prev_step = int(prev_file["step"])
+                # The previous file is not downloaded when its step is reused
+                # or rebuilt from the state, nor are its headers fetched
+                prev_cached = prev_step != 0 and (
+                    prev_step == last_step
+                    or self._has_state(to_process["forecast_ref_time"], prev_step)
+                )
+                if prev_cached:
+                    self._validate_headers(
+                        [obj for obj in sorted_files if obj is not prev_file],
+                        to_process,
+                        None,
+                    )
+                else:
+                    self._validate_headers(sorted_files, to_process, prev_file)
+                if step_zero_ds is None:
+                    step_zero_ds = self._decode_files(
+                        [obj for obj in sorted_files if int(obj["step"]) == 0]
+                    )
 
-            tempfiles = self._download_files(files_to_download)
-            return tempfiles, to_process, prev_file
+                cur_ds = self._decode_files([to_process])
+                if prev_step == 0:
+                    prev_ds = {}
+                elif prev_step == last_step:
+                    logger.debug(f"Reusing decoded data of step {prev_step}")
+                    prev_ds = last_ds
+                else:
+                    prev_ds = self._load_state(
+                        to_process["forecast_ref_time"], prev_step, cur_ds, step
+                    ) or self._decode_files([prev_file])
 
-        except Exception as e:
-            logger.exception(f"Sorting and validation failed: {e}")
+                ds_in = combine_lead_times(step_zero_ds, prev_ds, cur_ds)
+                with self.metrics.span("validate"):
+                    validate_dataset(
+                        ds_in, params, to_process["forecast_ref_time"], step, prev_step
+                    )
+                # Only validated steps are reused by the next ones
+                if self.accumulation_state is not None:
+                    self.accumulation_state.save(
+                        to_process["forecast_ref_time"], step, cur_ds
+                    )
+                last_step, last_ds = step, cur_ds
+
+                ds_in |= self.metadata_cache.pv(ds_in["u"].message)
+
+                ds_out = self._apply_flexpart(ds_in)
+                self._save_output(
+                    ds_out,
+                    to_process["forecast_ref_time"],
+                    step,
+                    to_process["row_id"],
+                )
+                success = True
+            except Exception as e:
+                logger.exception(f"Processing of timestep {step} failed: {e}")
+                failed_steps.append(step)
+                # Let the next notification retry the step
+                (self.db or DB()).release_item(to_process["row_id"])
+            finally:
+                self.metrics.finish_step(success)
+
+        return failed_steps
+
+    def _has_state(self, forecast_ref_time: dt, step: int) -> bool:
+        return self.accumulation_state is not None and self.accumulation_state.has_step(
+            forecast_ref_time, step
+        )
+
+    def _load_state(
+        self,
+        forecast_ref_time: dt,
+        prev_step: int,
+        cur_ds: dict[str, typing.Any],
+        step: int,
+    ) -> dict[str, typing.Any] | None:
+        """Rebuild the previous step from the accumulation state, if stored."""
+        if self.accumulation_state is None:
             return None
+        prev_ds = self.accumulation_state.load(
+            forecast_ref_time, prev_step, cur_ds, step
+        )
+        if prev_ds is not None:
+            logger.info(f"Rebuilt step {prev_step} from the accumulation state")
+        return prev_ds
 
-    def _download_files(self, files_to_download: list[FileObject]) -> list[str]:
-        """Download files from S3 based on the file objects."""
-        try:
-            return [
-                self.s3_client.download_file(file_obj) for file_obj in files_to_download
+    def _validate_headers(
+        self,
+        file_objs: list[FileObject],
+        to_process: FileObject,
+        prev_file: FileObject | None,
+    ) -> None:
+        """
+        Validate the input files of a step from their GRIB headers only.
+
+        The headers are read with ranged GETs, or from a sidecar index, before
+        anything is downloaded. Their index is reused by the selective
+        download. ``prev_file`` is None if the previous step is not among
+        ``file_objs``.
+        """
+        if not CONFIG.main.validation.headers:
+            return
+        with self.metrics.span("validate_headers"):
+            try:
+                messages = [
+                    message
+                    for file_obj in file_objs
+                    for message in self.s3_client.message_index(file_obj["key"])
+                ]
+            except (ValueError, KeyError, eccodes.GribInternalError) as e:
+                # Unknown tables or parameters, the decoder validates them
+                logger.warning(f"Headers not validated, they cannot be scanned: {e}")
+                return
+            validate_headers(
+                messages,
+                CONSTANTS | INPUT_FIELDS,
+                to_process["forecast_ref_time"],
+                int(to_process["step"]),
+                None if prev_file is None else int(prev_file["step"]),
+            )
+
+    def _download_files(self, files_to_download: list[FileObject]) -> list[Input]:
+        """
+        Download files from S3 based on the file objects.
+
+        Up to ``download.max_workers`` files are fetched concurrently. If any
+        download fails, the files that were fetched successfully are released
+        before the error is raised.
+        """
+        start = time.perf_counter()
+        with (
+            self.metrics.span("download") as span,
+            ThreadPoolExecutor(
+                max_workers=CONFIG.main.download.max_workers
+            ) as executor,
+        ):
+            futures = [
+                executor.submit(self._download_file, file_obj)
+                for file_obj in files_to_download
             ]
-        except Exception as e:
-            logger.exception(f"File download failed: {e}")
-            raise RuntimeError("An error occurred while downloading files.") from e
+            wait(futures)
 
-    def _load_and_validate_data(
-        self, temp_files: list[str], to_process: FileObject, prev_file: FileObject
-    ) -> typing.Any:
-        """Load and validate data from downloaded files."""
+        temp_files = [f.result() for f in futures if f.exception() is None]
+        errors = [f.exception() for f in futures if f.exception() is not None]
+        if errors:
+            self._release_inputs(temp_files)
+            logger.error(f"File download failed: {errors[0]}", exc_info=errors[0])
+            raise RuntimeError(
+                "An error occurred while downloading files."
+            ) from errors[0]
+
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        total_bytes = sum(_input_size(temp_file) for temp_file in temp_files)
+        span.update(bytes=total_bytes, files=len(temp_files))
+        logger.info(
+            f"Downloaded {len(temp_files)} file(s), {total_bytes / 1024**2:.1f} MiB "
+            f"in {elapsed:.2f} s ({total_bytes / 1024**2 / elapsed:.1f} MiB/s)"
+        )
+        return temp_files
+
+    def _download_file(self, file_obj: FileObject) -> Input:
+        """
+        Download a single file and log its throughput.
+
+        In ``memory`` input mode the file is kept in memory, unless it is
+        larger than ``input.max_memory_mb``. Such files bypass the file cache
+        and are downloaded again by every step that needs them.
+        """
+        start = time.perf_counter()
+        params = CONSTANTS | INPUT_FIELDS
+        local_input: Input | None = None
+        if CONFIG.main.input.mode == "memory":
+            local_input = self.s3_client.download_to_memory(file_obj, params)
+        if local_input is None:
+            local_input = self.s3_client.download_file(file_obj, params)
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        size = _input_size(local_input)
+        logger.info(
+            f"Fetched {file_obj['key']}: {size / 1024**2:.1f} MiB in {elapsed:.2f} s "
+            f"({size / 1024**2 / elapsed:.1f} MiB/s)"
+        )
+        return local_input
+
+    def _release_inputs(self, local_inputs: list[Input]) -> None:
+        """Release the downloaded files; buffers are left to the garbage collector."""
+        for local_input in local_inputs:
+            if isinstance(local_input, str):
+                self.s3_client.release_file(local_input)
+
+    def _decode_files(self, file_objs: list[FileObject]) -> dict[str, typing.Any]:
+        """
+        Download and decode the requested fields of the given files.
+
+        The fields of step 0, needed by every step of a forecast, are taken
+        from the field store when another process has decoded the same input
+        objects already, by ETag, and published to it otherwise.
+        """
         request = {"param": list(CONSTANTS | INPUT_FIELDS)}
+        field_store = (
+            self.field_store
+            if all(int(file_obj["step"]) == 0 for file_obj in file_objs)
+            else None
+        )
+        if field_store is not None:
+            forecast_ref_time = file_objs[0]["forecast_ref_time"]
+            version = FieldStore.input_version(
+                (file_obj["key"], self.s3_client.etag(file_obj["key"]))
+                for file_obj in file_objs
+            )
+            ds = field_store.load(forecast_ref_time, 0, version, request["param"])
+            if ds is not None:
+                logger.info("Loaded the fields of step 0 from the field store")
+                return ds
+
+        temp_files = self._download_files(file_objs)
         try:
-            with config.set_values(data_scope="ifs"):
-                source = data_source.FileDataSource(datafiles=temp_files)
-                ds_in = grib_decoder.load(source, request)
-                validate_dataset(
-                    ds_in,
-                    request["param"],
-                    to_process["forecast_ref_time"],
-                    int(to_process["step"]),
-                    int(prev_file["step"]),
-                )
-                ds_in |= metadata.extract_pv(ds_in["u"].message)
+            ds = self._load(temp_files, request)
+        finally:
+            self._release_inputs(temp_files)
+        if field_store is not None:
+            field_store.save(forecast_ref_time, 0, version, ds)
+        return ds
 
-            return ds_in
+    def _load(
+        self, temp_files: list[Input], request: dict[str, typing.Any]
+    ) -> dict[str, typing.Any]:
+        """
+        Decode the requested fields from local GRIB files and buffers.
 
-        except Exception as e:
-            logger.exception(f"Data loading and validation failed: {e}")
-            raise
+        With ``flexpart.rows_per_block``, the fields on model levels are
+        decoded one at a time: the decoder holds the values of every message
+        until all the fields it decodes are assembled, so that decoding them
+        together needs about twice their size.
+        """
+        params = request["param"]
+        groups = [params]
+        if CONFIG.main.flexpart.rows_per_block:
+            others = [param for param in params if param not in MODEL_LEVEL_FIELDS]
+            groups = [[param] for param in params if param in MODEL_LEVEL_FIELDS]
+            groups.append(others)
+        with (
+            self.metrics.span("decode") as span,
+            config.set_values(data_scope="ifs"),
+        ):
+            ds: dict[str, typing.Any] = {}
+            for group in filter(None, groups):
+                source = self._source(temp_files, group)
+                ds |= grib_decoder.load(source, {**request, "param": group})
+            span["fields"] = len(ds)
+            return ds
 
-        finally:
-            for temp_file in temp_files:
-                os.unlink(temp_file)
+    def _source(
+        self, temp_files: list[Input], params: list[str]
+    ) -> data_source.DataSource:
+        """Data source of the messages of ``params`` in the inputs."""
+        paths = [temp_file for temp_file in temp_files if isinstance(temp_file, str)]
+        buffers = [
+            self._select_from_buffer(temp_file, params)
+            for temp_file in temp_files
+            if isinstance(temp_file, bytes)
+        ]
+        datafiles, parts = self._select_from_index(paths, params)
+        if buffers or parts:
+            return MemoryDataSource(datafiles=datafiles, buffers=buffers, parts=parts)
+        return data_source.FileDataSource(datafiles=datafiles)
+
+    def _select_from_index(
+        self, temp_files: list[str], params: list[str]
+    ) -> tuple[list[str], dict[str, list[tuple[int, int]]]]:
+        """
+        Reduce the input files to the requested messages using their index.
+
+        Returns:
+            tuple[list[str], dict[str, list[tuple[int, int]]]]: The files to
+            decode whole and the (offset, length) byte ranges of the messages
+            to decode in the other files, which are read in place.
+        """
+        if not CONFIG.main.grib_index.enabled:
+            return temp_files, {}
+
+        datafiles, parts = [], {}
+        for temp_file in temp_files:
+            try:
+                messages = index_file(temp_file)
+            except (ValueError, KeyError, eccodes.GribInternalError) as e:
+                logger.warning(f"Decoding {temp_file} without index: {e}")
+                datafiles.append(temp_file)
+                continue
+
+            selected = select_messages(messages, params)
+            if len(selected) == len(messages):
+                datafiles.append(temp_file)
+            elif selected:
+                parts[temp_file] = [
+                    (start, end - start) for start, end in coalesce_ranges(selected)
+                ]
+
+        return datafiles, parts
+
+    def _select_from_buffer(self, data: bytes, params: list[str]) -> bytes:
+        """Reduce a buffer to the requested messages, like ``_select_from_index``."""
+        if not CONFIG.main.grib_index.enabled:
+            return data
+        try:
+            messages = index_buffer(data)
+        except (ValueError, KeyError, eccodes.GribInternalError) as e:
+            logger.warning(f"Decoding buffer without index: {e}")
+            return data
+        selected = select_messages(messages, params)
+        if len(selected) == len(messages):
+            return data
+        return extract_buffer(data, selected)
 
     def _apply_flexpart(self, ds_in: typing.Any) -> typing.Any:
-        """Apply flexpart pre-processing and return processed data structure."""
+        """
+        Apply flexpart pre-processing and return processed data structure.
+
+        With ``flexpart.rows_per_block``, the pre-processing runs on blocks of
+        grid rows. Only the output lead time of each block is kept, and it is
+        copied into the output as soon as the block is processed, so that the
+        intermediate arrays are the size of a block.
+        """
+        with self.metrics.span("flexpart") as span:
+            rows_per_block = CONFIG.main.flexpart.rows_per_block
+            if rows_per_block:
+                ds_out = concat_rows(
+                    (
+                        self._fflexpart(block)
+                        for block in row_blocks(ds_in, rows_per_block)
+                    ),
+                    n_rows(ds_in),
+                )
+            else:
+                ds_out = self._fflexpart(ds_in)
+            span["fields"] = len(ds_out)
+        return ds_out
+
+    def _fflexpart(self, ds_in: dict[str, typing.Any]) -> dict[str, typing.Any]:
         ds_out = flx.fflexpart(ds_in)
         prepare_output(ds_out, ds_in, INPUT_FIELDS, CONSTANTS)
         return ds_out
@@ -121,54 +465,79 @@ class Processing:
         step_to_process: int,
         row_id: int,
     ) -> None:
-        """Save processed data to a temporary file and upload to output-S3."""
+        """Encode processed data and upload it to output-S3."""
         try:
             lead_time = forecast_ref_time + timedelta(hours=step_to_process)
             lead_time_str = lead_time.strftime("%Y%m%d%H")
             key = f"dispf{lead_time_str}"
 
-            ref_keys = "editionNumber", "productDefinitionTemplateNumber"
-            ref_values = 2, 0
-            ref = next(
-                field
-                for field in ds_out.values()
-                if metadata.extract_keys(field.message, ref_keys) == ref_values
-            )
-
-            with tempfile.NamedTemporaryFile(
-                suffix=key,
-            ) as output_file:
-                for name, field in ds_out.items():
-                    if field.isnull().all():
-                        logging.info(f"Ignoring field {field} - only NaN values")
-                        continue
-
-                    if metadata.extract_keys(field.message, "editionNumber") == 1:
-                        # Variables in this set have undergone statistical
-                        # processing (e.g., aggregation), so the
-                        # productDefinitionTemplateNumber must change
-                        # (e.g., to include typeOfStatisticalProcessing).
-                        if name in set(["lsp", "sshf", "ewss", "nsss", "cp", "ssr"]):
-                            msg = metadata.override(
-                                ref.message,
-                                productDefinitionTemplateNumber=8,
-                                shortName=field.parameter["shortName"],
-                            )
-                        else:
-                            # No statistical processing; only override the shortName.
-                            msg = metadata.override(
-                                ref.message, shortName=field.parameter["shortName"]
-                            )
-                        field.attrs = msg
-                    grib_decoder.save(field, output_file)
-                logger.info("Writing GRIB fields to file completed.")
-
-                # Upload the file to S3
-                S3client().upload_file(output_file.name, key=key)
+            if CONFIG.main.upload.streaming:
+                # Parts are uploaded while the remaining fields are encoded
+                with self.s3_client.open_upload(key) as output_file:
+                    self._write_fields(ds_out, output_file)
+                    # The span covers the whole upload, from the opening of
+                    # the writer, so it overlaps the encode span
+                    with self.metrics.span("upload", output_file.started) as span:
+                        span["bytes"] = output_file.tell()
+                        output_file.close()
+            else:
+                with tempfile.NamedTemporaryFile(suffix=key) as output_file:
+                    self._write_fields(ds_out, output_file)
+                    output_file.flush()
+                    # Upload the file to S3
+                    with self.metrics.span("upload") as span:
+                        span["bytes"] = output_file.tell()
+                        self.s3_client.upload_file(output_file.name, key=key)
 
             # Mark the item as processed if everything was successful
-            DB().update_item_as_processed(row_id)
+            (self.db or DB()).update_item_as_processed(row_id)
 
         except Exception as e:
             logger.exception(f"Failed to save or upload output file: {e}")
             raise
+
+    def _write_fields(self, ds_out: typing.Any, output_file: BinaryWriter) -> None:
+        """Encode the output fields as GRIB to a binary file object."""
+        with self.metrics.span("encode") as span:
+            start = time.perf_counter()
+            cache = self.metadata_cache
+            misses = cache.misses
+            # Find the reference before any field is overridden
+            cache.reference(ds_out)
+            fields: list[typing.Any] = []
+            packing: list[Packing] = []
+            position = output_file.tell()
+            for name, field in ds_out.items():
+                if field.isnull().all():
+                    logging.info(f"Ignoring field {field} - only NaN values")
+                    continue
+
+                if cache.edition(name, field.message) == 1:
+                    # Variables in this set have undergone statistical
+                    # processing (e.g., aggregation), so the
+                    # productDefinitionTemplateNumber must change
+                    # (e.g., to include typeOfStatisticalProcessing).
+                    if name in ACCUMULATED_FIELDS:
+                        msg = cache.template(ds_out, field.parameter["shortName"], 8)
+                    else:
+                        # No statistical processing; only override the shortName.
+                        msg = cache.template(ds_out, field.parameter["shortName"])
+                    field.attrs = dict(msg)
+                keys = CONFIG.main.packing.grib_keys(name)
+                if name in CONSTANTS:
+                    # Encoded once per forecast, spliced into every output file
+                    fields.append(cache.encoded_constant(name, field, keys))
+                    packing.append(None)
+                else:
+                    fields.append(field)
+                    packing.append(keys)
+
+            max_workers = CONFIG.main.encode.max_workers
+            write_fields(fields, output_file, max_workers, packing)
+            size = output_file.tell() - position
+            span.update(bytes=size, fields=len(fields))
+            logger.info(
+                f"Writing GRIB fields to file completed: {size / 1024**2:.1f} MiB in "
+                f"{time.perf_counter() - start:.2f} s with {max_workers} worker(s) "
+                f"({cache.misses - misses} metadata template(s) created)."
+            )
@@ -1,7 +1,11 @@
+import contextlib
 import logging
 import os
 import tempfile
+import threading
+import time
 import typing
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import boto3
 from boto3.s3.transfer import TransferConfig
@@ -9,11 +13,162 @@ from botocore.client import BaseClient
 from botocore.exceptions import ClientError
 
 from flexprep import CONFIG
+from flexprep.domain.cache_utils import FileCache
+from flexprep.domain.grib_utils import (
+    INDEX_SUFFIX,
+    GribMessage,
+    coalesce_ranges,
+    parse_sidecar_index,
+    scan_messages,
+    select_messages,
+)
 
 logger = logging.getLogger(__name__)
 
 FileObject = dict[str, typing.Any]
 
+# Number of input objects whose message index is kept in memory
+MESSAGE_INDEX_CACHE_SIZE = 32
+
+
+class S3MultipartWriter:
+    """
+    Binary file-like object streaming its content to S3.
+
+    Written bytes are sent as parts of a multipart upload as soon as a part
+    is full, while the caller keeps producing data. At most
+    ``max_in_flight`` parts are uploaded at once; ``write`` blocks when all
+    slots are taken, which bounds the memory in use. Content smaller than
+    one part is uploaded with a single PUT when the writer is closed.
+
+    Used as a context manager, the upload is completed on exit, or aborted
+    if an exception was raised.
+    """
+
+    def __init__(
+        self,
+        s3_client: BaseClient,
+        bucket: str,
+        key: str,
+        part_size: int,
+        max_in_flight: int,
+    ) -> None:
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.bytes_written = 0
+        self.closed = False
+        self._buffer = bytearray()
+        self._upload_id: str | None = None
+        self._parts: list[Future] = []
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        # time.perf_counter() at the opening of the writer
+        self.started = time.perf_counter()
+
+    def __enter__(self) -> "S3MultipartWriter":
+        return self
+
+    def __exit__(self, exc_type: typing.Any, *_: typing.Any) -> None:
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.bytes_written
+
+    def flush(self) -> None:
+        """Nothing to flush: parts are sent when full, the rest on close."""
+
+    def write(self, data: bytes) -> int:
+        if self.closed:
+            raise ValueError("I/O operation on closed writer")
+        self._buffer += data
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[: self.part_size])
+            del self._buffer[: self.part_size]
+            self._submit(part)
+        return len(data)
+
+    def _submit(self, body: bytes) -> None:
+        # Fail fast instead of encoding the rest of the output for nothing
+        for part in self._parts:
+            if part.done() and part.exception() is not None:
+                raise typing.cast(BaseException, part.exception())
+
+        if self._upload_id is None:
+            self._upload_id = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key
+            )["UploadId"]
+
+        self._slots.acquire()
+        part = self._executor.submit(self._upload_part, len(self._parts) + 1, body)
+        part.add_done_callback(lambda _: self._slots.release())
+        self._parts.append(part)
+
+    def _upload_part(self, number: int, body: bytes) -> dict[str, typing.Any]:
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            PartNumber=number,
+            Body=body,
+        )
+        return {"PartNumber": number, "ETag": response["ETag"]}
+
+    def close(self) -> None:
+        """Upload the remaining bytes and complete the upload."""
+        if self.closed:
+            return
+        try:
+            if self._upload_id is None:
+                self.s3_client.put_object(
+                    Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer)
+                )
+            else:
+                if self._buffer:
+                    self._submit(bytes(self._buffer))
+                parts = [part.result() for part in self._parts]
+                self.s3_client.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self._upload_id,
+                    MultipartUpload={"Parts": parts},
+                )
+        except Exception:
+            self.abort()
+            raise
+        self.closed = True
+        self._executor.shutdown()
+        self._buffer.clear()
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        logger.info(
+            f"Streamed {self.bytes_written / 1024**2:.1f} MiB to {self.key} "
+            f"in {max(len(self._parts), 1)} part(s), {elapsed:.2f} s"
+        )
+
+    def abort(self) -> None:
+        """Discard the upload and the parts already sent."""
+        if self.closed:
+            return
+        self.closed = True
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._buffer.clear()
+        if self._upload_id is not None:
+            try:
+                self.s3_client.abort_multipart_upload(
+                    Bucket=self.bucket, Key=self.key, UploadId=self._upload_id
+                )
+            except ClientError as e:
+                logger.error(f"Failed to abort the upload of {self.key}: {e}")
+        logger.warning(f"Aborted the upload of {self.key}")
+
 
 class S3client:
     def __init__(self) -> None:
@@ -29,6 +184,17 @@ class S3client:
             secret_key=os.getenv("S3_SECRET_KEY", ""),
         )
 
+        self.cache = (
+            FileCache(
+                CONFIG.main.cache.path,
+                int(CONFIG.main.cache.max_size_gb * 1024**3),
+            )
+            if CONFIG.main.cache.enabled
+            else None
+        )
+        self._indexes: dict[tuple[str, str], list[GribMessage]] = {}
+        self._indexes_lock = threading.Lock()
+
     def check_bucket(self, s3_client: BaseClient, bucket_name: str) -> None:
         try:
             s3_objects = s3_client.list_objects_v2(Bucket=bucket_name)
@@ -52,27 +218,276 @@ class S3client:
             use_ssl=True,
         )
 
-    def download_file(self, file_info: FileObject) -> str:
-        """Download a file from an S3 bucket to a temporary file."""
-        temp_file = tempfile.NamedTemporaryFile(suffix=file_info["key"], delete=False)
+    def download_file(
+        self, file_info: FileObject, params: typing.Collection[str] | None = None
+    ) -> str:
+        """
+        Download a file from an S3 bucket to a local file.
+
+        When the cache is enabled the returned path points into the cache and
+        must be handed back through ``release_file`` instead of being deleted.
+
+        Args:
+            file_info (FileObject): File object with the key of the input file.
+            params (Collection[str] | None): If given and selective download
+                is enabled, only the GRIB messages of these shortNames are
+                fetched with ranged GETs and written to a compact local file.
+        """
+        if not CONFIG.main.selective_download.enabled:
+            params = None
+
+        if self.cache is None:
+            return self._download_to_temp_file(file_info, params)
+
+        bucket = CONFIG.main.s3_buckets.input.name
         try:
-            self.s3_client_input.download_file(
-                CONFIG.main.s3_buckets.input.name,
-                file_info["key"],
-                temp_file.name,
-                Config=TransferConfig(multipart_threshold=5 * 1024**3),
+            version = self.etag(file_info["key"])
+            if params is not None:
+                version += "|" + ",".join(sorted(params))
+            cache_path, _ = self.cache.get_or_fetch(
+                FileCache.entry_name(bucket, file_info["key"], version),
+                lambda path: self._fetch(file_info["key"], path, params),
             )
+        except ClientError as e:
+            logger.exception(f"Error downloading file {file_info['key']} to cache: {e}")
+            raise e
+
+        file_info["temp_file"] = cache_path
+        return cache_path
+
+    def _download_to_temp_file(
+        self, file_info: FileObject, params: typing.Collection[str] | None
+    ) -> str:
+        temp_file = tempfile.NamedTemporaryFile(suffix=file_info["key"], delete=False)
+        try:
+            self._fetch(file_info["key"], temp_file.name, params)
             logger.info(
                 f"Downloaded file from S3 to temporary file: {file_info['key']}"
             )
             file_info["temp_file"] = temp_file.name
             return temp_file.name
-        except ClientError as e:
+        except Exception as e:
+            os.unlink(temp_file.name)
             logger.exception(
                 f"Error downloading file {file_info['key']} to temporary file: {e}"
             )
             raise e
 
+    def _fetch(
+        self, key: str, local_path: str, params: typing.Collection[str] | None = None
+    ) -> None:
+        if params is not None:
+            try:
+                self._fetch_messages(key, local_path, params)
+                return
+            except ValueError as e:
+                logger.warning(
+                    f"Selective download of {key} not possible ({e}), "
+                    "downloading the whole file."
+                )
+
+        self.s3_client_input.download_file(
+            CONFIG.main.s3_buckets.input.name,
+            key,
+            local_path,
+            Config=TransferConfig(multipart_threshold=5 * 1024**3),
+        )
+
+    def _fetch_messages(
+        self, key: str, local_path: str, params: typing.Collection[str]
+    ) -> None:
+        """Fetch the byte ranges of the requested messages into a local file."""
+        messages, selected = self._select_messages(key, params)
+        ranges = coalesce_ranges(selected)
+        with open(local_path, "wb") as f:
+            for start, end in ranges:
+                f.write(self._read_range(key, start, end))
+
+        selected_bytes = sum(m.length for m in selected)
+        total_bytes = sum(m.length for m in messages)
+        logger.info(
+            f"Fetched {len(selected)} of {len(messages)} messages of {key} "
+            f"({selected_bytes / 1024**2:.1f} of {total_bytes / 1024**2:.1f} MiB) "
+            f"in {len(ranges)} ranged request(s)"
+        )
+
+    def _select_messages(
+        self, key: str, params: typing.Collection[str]
+    ) -> tuple[list[GribMessage], list[GribMessage]]:
+        """
+        Return the messages of an input and those of the requested shortNames.
+
+        Raises a ValueError if none is selected, so that the whole file is
+        downloaded instead of writing an empty one.
+        """
+        messages = self.message_index(key)
+        selected = select_messages(messages, params)
+        if not selected:
+            raise ValueError("the index lists none of the requested messages")
+        return messages, selected
+
+    def download_to_memory(
+        self, file_info: FileObject, params: typing.Collection[str] | None = None
+    ) -> bytes | str | None:
+        """
+        Download a file from an S3 bucket without writing it to local disk.
+
+        Args:
+            file_info (FileObject): File object with the key of the input file.
+            params (Collection[str] | None): As for ``download_file``.
+
+        Returns:
+            bytes | str | None: The content of the file or, if ``input.shm_dir``
+            is set, the path of a file in that memory-backed directory, which
+            must be handed back through ``release_file``. None if the file is
+            larger than ``input.max_memory_mb`` and must be downloaded to disk.
+        """
+        settings = CONFIG.main.input
+        key = file_info["key"]
+        if not CONFIG.main.selective_download.enabled:
+            params = None
+
+        try:
+            if params is not None:
+                try:
+                    ranges = coalesce_ranges(self._select_messages(key, params)[1])
+                except ValueError as e:
+                    logger.warning(
+                        f"Selective download of {key} not possible ({e}), "
+                        "downloading the whole file."
+                    )
+                    params = None
+
+            if params is not None:
+                size = sum(end - start for start, end in ranges)
+                chunks: typing.Iterable[bytes] = (
+                    self._read_range(key, start, end) for start, end in ranges
+                )
+            else:
+                response = self.s3_client_input.get_object(
+                    Bucket=CONFIG.main.s3_buckets.input.name, Key=key
+                )
+                size = response["ContentLength"]
+                chunks = response["Body"].iter_chunks(1024**2)
+
+            if size > settings.max_memory_mb * 1024**2:
+                if params is None:
+                    response["Body"].close()
+                logger.info(
+                    f"{key} exceeds the in-memory limit ({size / 1024**2:.1f} MiB)"
+                )
+                return None
+
+            if settings.shm_dir is None:
+                return b"".join(chunks)
+
+            with tempfile.NamedTemporaryFile(
+                dir=settings.shm_dir, suffix=key, delete=False
+            ) as shm_file:
+                try:
+                    for chunk in chunks:
+                        shm_file.write(chunk)
+                except Exception:
+                    os.unlink(shm_file.name)
+                    raise
+            file_info["temp_file"] = shm_file.name
+            return shm_file.name
+
+        except ClientError as e:
+            logger.exception(f"Error downloading file {key} to memory: {e}")
+            raise e
+
+    def _read_range(self, key: str, start: int, end: int) -> bytes:
+        """Read the bytes [start, end) of an input object."""
+        response = self.s3_client_input.get_object(
+            Bucket=CONFIG.main.s3_buckets.input.name,
+            Key=key,
+            Range=f"bytes={start}-{end - 1}",
+        )
+        return response["Body"].read()
+
+    def etag(self, key: str) -> str:
+        """Return the ETag of an input object, which changes when it is replaced."""
+        return self.s3_client_input.head_object(
+            Bucket=CONFIG.main.s3_buckets.input.name, Key=key
+        )["ETag"]
+
+    def message_index(self, key: str) -> list[GribMessage]:
+        """
+        List the GRIB messages of an input object without downloading it.
+
+        A sidecar index (``<key>.index``) is used when one exists, otherwise
+        the section headers of the object are read with ranged GETs. The
+        indexes of recent objects are kept by ETag, so that the headers of an
+        input are read once when it is validated and then downloaded.
+        """
+        head = self.s3_client_input.head_object(
+            Bucket=CONFIG.main.s3_buckets.input.name, Key=key
+        )
+        version = key, head["ETag"]
+        with self._indexes_lock:
+            if version in self._indexes:
+                return self._indexes[version]
+
+        messages = self._read_message_index(key, head["ContentLength"])
+        with self._indexes_lock:
+            if len(self._indexes) >= MESSAGE_INDEX_CACHE_SIZE:
+                del self._indexes[next(iter(self._indexes))]
+            self._indexes[version] = messages
+        return messages
+
+    def _read_message_index(self, key: str, size: int) -> list[GribMessage]:
+        bucket = CONFIG.main.s3_buckets.input.name
+        settings = CONFIG.main.selective_download
+        try:
+            response = self.s3_client_input.get_object(
+                Bucket=bucket, Key=key + settings.index_suffix
+            )
+            return parse_sidecar_index(response["Body"].read().decode().splitlines())
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+                raise
+
+        return scan_messages(
+            lambda start, end: self._read_range(key, start, end),
+            size,
+            block_size=settings.block_size_kb * 1024,
+        )
+
+    def list_keys(self, prefix: str) -> list[str]:
+        """List the keys of the input bucket starting with ``prefix``."""
+        paginator = self.s3_client_input.get_paginator("list_objects_v2")
+        keys: list[str] = []
+        try:
+            for page in paginator.paginate(
+                Bucket=CONFIG.main.s3_buckets.input.name, Prefix=prefix
+            ):
+                keys.extend(obj["Key"] for obj in page.get("Contents", []))
+        except ClientError as e:
+            logger.exception(f"Error listing keys with prefix {prefix}: {e}")
+            raise
+        return keys
+
+    def release_file(self, local_path: str) -> None:
+        """Delete a downloaded file, or hand it back if it is owned by the cache."""
+        if self.cache is not None and self.cache.contains(local_path):
+            self.cache.release(local_path)
+            return
+        os.unlink(local_path)
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(local_path + INDEX_SUFFIX)
+
+    def open_upload(self, key: str) -> S3MultipartWriter:
+        """Open a writer streaming to the output bucket."""
+        settings = CONFIG.main.upload
+        return S3MultipartWriter(
+            self.s3_client_output,
+            CONFIG.main.s3_buckets.output.name,
+            key,
+            part_size=settings.part_size_mb * 1024**2,
+            max_in_flight=settings.max_in_flight,
+        )
+
     def upload_file(self, local_path: str, key: str) -> None:
         """Upload a local file to an S3 bucket."""
         try:
@@ -0,0 +1,137 @@
+import logging
+import os
+import shutil
+import tempfile
+import typing
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from flexprep.domain.flexpart_utils import ACCUMULATED_FIELDS
+
+logger = logging.getLogger(__name__)
+
+
+class AccumulationState:
+    """
+    Accumulated fields of the processed steps, kept on local disk.
+
+    The values of the accumulated fields of the last decoded step of a
+    forecast are stored as ``.npy`` files per forecast and step. That step,
+    as the previous step of the next one, can then be rebuilt from them
+    instead of downloading and decoding its input file: the accumulated
+    fields take their stored values and the other fields, of which the
+    pre-processing only outputs the last lead time, take the values of the
+    current step. The earlier steps of a forecast are removed once a later
+    one is stored.
+    """
+
+    def __init__(
+        self, path: str, dtype: str = "float64", keep_forecasts: int = 2
+    ) -> None:
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.keep_forecasts = keep_forecasts
+
+    def _step_dir(self, forecast_ref_time: datetime, step: int) -> str:
+        return os.path.join(self.path, f"{forecast_ref_time:%Y%m%d%H}", str(step))
+
+    def has_step(self, forecast_ref_time: datetime, step: int) -> bool:
+        """Whether the state of a step is stored."""
+        return os.path.isdir(self._step_dir(forecast_ref_time, step))
+
+    def save(
+        self, forecast_ref_time: datetime, step: int, ds: dict[str, typing.Any]
+    ) -> None:
+        """Store the accumulated fields of the decoded step ``ds``."""
+        fields = ACCUMULATED_FIELDS & ds.keys()
+        if not fields:
+            return
+        step_dir = self._step_dir(forecast_ref_time, step)
+        if os.path.isdir(step_dir):
+            return
+
+        # Written aside and renamed, so that readers only see complete steps
+        os.makedirs(os.path.dirname(step_dir), exist_ok=True)
+        partial_dir = tempfile.mkdtemp(dir=os.path.dirname(step_dir))
+        try:
+            for name in fields:
+                values = ds[name].values
+                array = np.lib.format.open_memmap(
+                    os.path.join(partial_dir, f"{name}.npy"),
+                    mode="w+",
+                    dtype=self.dtype,
+                    shape=values.shape,
+                )
+                array[...] = values
+                array.flush()
+                del array
+            os.rename(partial_dir, step_dir)
+        except OSError as e:
+            # Another process stored the step first, or the disk is full
+            shutil.rmtree(partial_dir, ignore_errors=True)
+            if not os.path.isdir(step_dir):
+                logger.warning(f"Could not store the state of step {step}: {e}")
+            return
+        self._prune(forecast_ref_time)
+
+    def load(
+        self,
+        forecast_ref_time: datetime,
+        step: int,
+        cur_ds: dict[str, typing.Any],
+        cur_step: int,
+    ) -> dict[str, typing.Any] | None:
+        """
+        Rebuild the decoded dataset of ``step`` from the stored state.
+
+        Args:
+            forecast_ref_time (datetime): Reference time of the forecast.
+            step (int): Step to rebuild.
+            cur_ds (dict): Decoded dataset of the step being processed.
+            cur_step (int): Step of ``cur_ds``.
+
+        Returns:
+            dict | None: The dataset, or None if the state of ``step`` is
+            missing or does not match ``cur_ds``.
+        """
+        step_dir = self._step_dir(forecast_ref_time, step)
+        shift = np.timedelta64(timedelta(hours=cur_step - step), "ns")
+        prev_ds = {}
+        for name, field in cur_ds.items():
+            if "lead_time" not in field.dims:
+                continue
+            coords = {"lead_time": field.coords["lead_time"] - shift}
+            if "valid_time" in field.coords:
+                coords["valid_time"] = field.coords["valid_time"] - shift
+            prev_ds[name] = field.assign_coords(coords)
+
+            if name not in ACCUMULATED_FIELDS:
+                continue
+            try:
+                values = np.load(os.path.join(step_dir, f"{name}.npy"), mmap_mode="r")
+            except OSError:
+                return None
+            if values.shape != field.shape:
+                logger.warning(f"State of {name} at step {step} has another shape")
+                return None
+            prev_ds[name] = prev_ds[name].copy(data=values.astype(field.dtype))
+        return prev_ds
+
+    def _prune(self, forecast_ref_time: datetime) -> None:
+        """Keep the latest step of the most recent forecasts only."""
+        forecast_dir = os.path.join(self.path, f"{forecast_ref_time:%Y%m%d%H}")
+        steps = sorted(int(name) for name in os.listdir(forecast_dir) if name.isdigit())
+        for step in steps[:-1]:
+            # A reader that loses the step decodes its input file instead
+            shutil.rmtree(os.path.join(forecast_dir, str(step)), ignore_errors=True)
+
+        current = f"{forecast_ref_time:%Y%m%d%H}"
+        forecasts = sorted(
+            name
+            for name in os.listdir(self.path)
+            if os.path.isdir(os.path.join(self.path, name))
+        )
+        for name in forecasts[: -self.keep_forecasts]:
+            if name != current:
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
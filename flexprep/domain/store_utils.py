@@ -0,0 +1,194 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import typing
+from datetime import datetime
+
+import numpy as np
+import xarray as xr
+
+logger = logging.getLogger(__name__)
+
+VALUES_FILE = "values.npy"
+COORDS_FILE = "coords.npz"
+METADATA_FILE = "metadata.json"
+
+
+def _encode_attr(value: typing.Any) -> typing.Any:
+    """Encode the attribute values that JSON does not support natively."""
+    if isinstance(value, bytes):
+        return {"__bytes__": base64.b64encode(value).decode()}
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Attribute of type {type(value).__name__} cannot be stored")
+
+
+def _decode_attr(value: dict[str, typing.Any]) -> typing.Any:
+    if value.keys() == {"__bytes__"}:
+        return base64.b64decode(value["__bytes__"])
+    return value
+
+
+class FieldStore:
+    """
+    Decoded fields on local disk, shared by the processes of a host.
+
+    Each field is stored under ``<forecast>/<step>/<version>/<shortName>``,
+    where the version identifies the input objects by their ETag, so that a
+    re-uploaded input is decoded again. A field is stored as its values in a
+    ``.npy`` file, its coordinates in a ``.npz`` file and its dimensions and
+    attributes as JSON; nothing is unpickled when loading. Loaded values are
+    memory-mapped copy-on-write: processes decoding the same inputs share the
+    pages of the file instead of decoding them again, and a process writing
+    to the values gets private pages instead of altering the store.
+
+    Entries are written aside and renamed into place, so a reader only sees
+    complete fields. The store is bounded by ``max_size_bytes``, evicting the
+    least recently used fields, and only the most recent forecasts are kept.
+    """
+
+    def __init__(self, path: str, max_size_bytes: int, keep_forecasts: int = 2) -> None:
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.keep_forecasts = keep_forecasts
+
+    @staticmethod
+    def input_version(etags: typing.Iterable[tuple[str, str]]) -> str:
+        """Version of a set of input objects, given as (key, ETag) pairs."""
+        inputs = "\n".join(f"{key}/{etag}" for key, etag in sorted(etags))
+        return hashlib.sha256(inputs.encode()).hexdigest()[:16]
+
+    def _entry_dir(
+        self, forecast_ref_time: datetime, step: int, version: str, name: str
+    ) -> str:
+        return os.path.join(
+            self.path, f"{forecast_ref_time:%Y%m%d%H}", str(step), version, name
+        )
+
+    def load(
+        self,
+        forecast_ref_time: datetime,
+        step: int,
+        version: str,
+        names: typing.Iterable[str],
+    ) -> dict[str, xr.DataArray] | None:
+        """
+        Return the fields ``names`` of a step, or None if any is not stored.
+        """
+        ds = {}
+        for name in names:
+            entry_dir = self._entry_dir(forecast_ref_time, step, version, name)
+            try:
+                values = np.load(os.path.join(entry_dir, VALUES_FILE), mmap_mode="c")
+                with open(os.path.join(entry_dir, METADATA_FILE)) as f:
+                    metadata = json.load(f, object_hook=_decode_attr)
+                with np.load(
+                    os.path.join(entry_dir, COORDS_FILE), allow_pickle=False
+                ) as arrays:
+                    coords = {
+                        coord: xr.Variable(spec["dims"], arrays[coord], spec["attrs"])
+                        for coord, spec in metadata["coords"].items()
+                    }
+                # The access time is tracked by hand, file systems may not
+                os.utime(entry_dir)
+            except (OSError, ValueError, KeyError):
+                return None
+            ds[name] = xr.DataArray(
+                values,
+                dims=metadata["dims"],
+                coords=coords,
+                attrs=metadata["attrs"],
+                name=metadata["name"],
+            )
+        return ds
+
+    def save(
+        self,
+        forecast_ref_time: datetime,
+        step: int,
+        version: str,
+        ds: dict[str, xr.DataArray],
+    ) -> None:
+        """Publish the fields of a decoded step that are not stored yet."""
+        for name, field in ds.items():
+            entry_dir = self._entry_dir(forecast_ref_time, step, version, name)
+            if os.path.isdir(entry_dir):
+                continue
+            try:
+                self._publish(entry_dir, field)
+            except (OSError, TypeError) as e:
+                logger.warning(f"Could not store field {name} of step {step}: {e}")
+                return
+        self._prune(forecast_ref_time)
+
+    def _publish(self, entry_dir: str, field: xr.DataArray) -> None:
+        if any(coord.dtype.hasobject for coord in field.coords.values()):
+            raise TypeError("Coordinates of objects cannot be stored")
+        metadata = json.dumps(
+            {
+                "name": field.name,
+                "dims": list(field.dims),
+                "coords": {
+                    name: {"dims": list(coord.dims), "attrs": coord.attrs}
+                    for name, coord in field.coords.items()
+                },
+                "attrs": field.attrs,
+            },
+            default=_encode_attr,
+        )
+
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        partial_dir = tempfile.mkdtemp(prefix=".", dir=os.path.dirname(entry_dir))
+        try:
+            np.save(os.path.join(partial_dir, VALUES_FILE), field.values)
+            # Without the metadata pandas attaches to the dtypes of its indexes
+            np.savez(
+                os.path.join(partial_dir, COORDS_FILE),
+                **{
+                    str(name): coord.values.view(coord.dtype.str)
+                    for name, coord in field.coords.items()
+                },
+            )
+            with open(os.path.join(partial_dir, METADATA_FILE), "w") as f:
+                f.write(metadata)
+            os.rename(partial_dir, entry_dir)
+        except OSError:
+            shutil.rmtree(partial_dir, ignore_errors=True)
+            # Another process published the field first
+            if not os.path.isdir(entry_dir):
+                raise
+
+    def _prune(self, forecast_ref_time: datetime) -> None:
+        """Remove the old forecasts, then the least recently used fields."""
+        current = f"{forecast_ref_time:%Y%m%d%H}"
+        forecasts = sorted(
+            name
+            for name in os.listdir(self.path)
+            if os.path.isdir(os.path.join(self.path, name))
+        )
+        for name in forecasts[: -self.keep_forecasts]:
+            if name != current:
+                logger.info(f"Removing the stored fields of forecast {name}")
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+        entries = []
+        for root, dirs, files in os.walk(self.path):
+            if METADATA_FILE not in files or os.path.basename(root).startswith("."):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(root, f)) for f in files)
+                entries.append((os.path.getmtime(root), size, root))
+            except OSError:
+                # Removed by another process meanwhile
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, root in sorted(entries):
+            if total <= self.max_size_bytes:
+                break
+            # Fields already mapped by a reader stay valid once removed
+            shutil.rmtree(root, ignore_errors=True)
+            total -= size
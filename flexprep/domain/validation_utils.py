@@ -4,6 +4,15 @@ from datetime import datetime
 import numpy as np
 import pandas as pd
 
+from flexprep.domain.grib_utils import GribMessage
+
+
+def _expected_steps(step: int, prev_step: int | None) -> list[list[int]]:
+    """Lead times in hours a field may have: constant, or on all input steps."""
+    if not prev_step:
+        return [[0], [0, step]]
+    return [[0], [0, prev_step, step]]
+
 
 def validate_dataset(
     ds: dict[str, typing.Any],
@@ -16,33 +25,64 @@ def validate_dataset(
 
     if not all(param in ds.keys() for param in params):
         raise ValueError("Not all requested parameters are present in the dataset")
+
+    # The fields share a few distinct lead_time coordinates, compare each once
+    expected = [
+        pd.to_timedelta(steps, "h").values for steps in _expected_steps(step, prev_step)
+    ]
+    lead_times: dict[tuple[str, bytes], np.ndarray] = {}
+    for array in ds.values():
+        values = array.coords["lead_time"].values
+        lead_times.setdefault((values.dtype.str, values.tobytes()), values)
     if not all(
-        (
-            np.array_equal(
-                array.coords["lead_time"].values,
-                [pd.to_timedelta(0, "h").value],
-            )
-        )
-        or (
-            prev_step == 0
-            and np.array_equal(
-                array.coords["lead_time"].values,
-                pd.to_timedelta([0, step], "h").values,
-            )
-        )
-        or (
-            prev_step != 0
-            and np.array_equal(
-                array.coords["lead_time"].values,
-                pd.to_timedelta([0, prev_step, step], "h").values,
-            )
-        )
-        for array in ds.values()
+        any(np.array_equal(values, steps) for steps in expected)
+        for values in lead_times.values()
     ):
         raise ValueError("Downloaded steps are incorrect")
 
-    if not all(
-        (array.coords["ref_time"].values == np.datetime64(ref_time, "ns"))
-        for array in ds.values()
-    ):
+    ref_times = np.concatenate(
+        [np.ravel(array.coords["ref_time"].values) for array in ds.values()]
+    )
+    if not np.all(ref_times == np.datetime64(ref_time, "ns")):
+        raise ValueError("The forecast reference time is incorrect")
+
+
+def validate_headers(
+    messages: list[GribMessage],
+    params: typing.Collection[str],
+    ref_time: datetime,
+    step: int,
+    prev_step: int | None,
+) -> None:
+    """
+    Validate the GRIB headers of the input files of a step before decoding.
+
+    Performs the checks of ``validate_dataset`` on the messages of the
+    requested parameters, so that inputs which would fail the validation of
+    the decoded dataset are rejected before they are downloaded.
+
+    Args:
+        messages (list[GribMessage]): Messages of all input files of the step.
+        params (Collection[str]): Requested shortNames.
+        ref_time (datetime): Expected forecast reference time.
+        step (int): Step to process.
+        prev_step (int | None): Previous step of the input, None if its file
+            is not among the messages, e.g. as it is rebuilt from the
+            accumulation state.
+    """
+    steps_by_param: dict[str, set[int]] = {}
+    ref_times = set()
+    for message in messages:
+        if message.short_name in params:
+            steps_by_param.setdefault(message.short_name, set()).add(message.step)
+            ref_times.add(message.ref_time)
+
+    if not all(param in steps_by_param for param in params):
+        raise ValueError("Not all requested parameters are present in the dataset")
+
+    expected = [set(steps) for steps in _expected_steps(step, prev_step)]
+    if not all(steps in expected for steps in steps_by_param.values()):
+        raise ValueError("Downloaded steps are incorrect")
+
+    if ref_times != {ref_time}:
         raise ValueError("The forecast reference time is incorrect")
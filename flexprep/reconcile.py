@@ -0,0 +1,102 @@
+"""Record input files whose notification was lost and process what they unblock."""
+
+import argparse
+import logging
+import sys
+import typing
+from datetime import datetime, timedelta
+
+from flexprep.domain.data_model import IFSForecast
+from flexprep.domain.db_utils import DB
+from flexprep.domain.dispatch_utils import process_steps
+from flexprep.domain.s3_utils import S3client
+
+logger = logging.getLogger(__name__)
+
+FileObject = dict[str, typing.Any]
+
+
+def parse_arguments() -> argparse.Namespace:
+    """Parse and return command-line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Reconcile the database with the input bucket"
+    )
+    parser.add_argument(
+        "--start", type=str, required=True, help="First reference time (yyyymmddHH)"
+    )
+    parser.add_argument(
+        "--end", type=str, help="Last reference time (yyyymmddHH), --start by default"
+    )
+    parser.add_argument(
+        "--interval", type=int, default=6, help="Hours between reference times"
+    )
+    return parser.parse_args()
+
+
+def forecast_ref_times(
+    start: datetime, end: datetime, interval: timedelta
+) -> list[datetime]:
+    times = []
+    while start <= end:
+        times.append(start)
+        start += interval
+    return times
+
+
+def find_missing(
+    db: DB, s3_client: S3client, forecast_ref_time: datetime
+) -> list[IFSForecast]:
+    """List the input files of a forecast that are not recorded in the database."""
+    recorded = db.get_keys(forecast_ref_time)
+    missing = []
+    for key in s3_client.list_keys(f"P1D{forecast_ref_time:%m%d%H%M}"):
+        if key in recorded:
+            continue
+        try:
+            missing.append(IFSForecast.from_key(key, forecast_ref_time))
+        except ValueError:
+            # Sidecar indexes and other objects sharing the prefix
+            logger.debug(f"Skipping {key}")
+    return missing
+
+
+def reconcile(
+    db: DB, s3_client: S3client, forecast_ref_time: datetime
+) -> list[list[FileObject]]:
+    """
+    Insert the missing input files of a forecast.
+
+    Returns:
+        list[list[FileObject]]: The steps of the forecast that are
+        processable, claimed for processing.
+    """
+    missing = find_missing(db, s3_client, forecast_ref_time)
+    if missing:
+        inserted = db.insert_items(missing)
+        logger.info(
+            f"Recorded {inserted} missing file(s) of forecast {forecast_ref_time}."
+        )
+    return db.claim_steps(db.get_processable_steps(forecast_ref_time))
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    start = datetime.strptime(args.start, "%Y%m%d%H")
+    end = datetime.strptime(args.end, "%Y%m%d%H") if args.end else start
+
+    db, s3_client = DB(), S3client()
+    failed = False
+    for forecast_ref_time in forecast_ref_times(
+        start, end, timedelta(hours=args.interval)
+    ):
+        # Steps of different forecasts are processed separately, as the
+        # processing window reuses decoded data between consecutive steps
+        failed_steps = process_steps(reconcile(db, s3_client, forecast_ref_time))
+        if failed_steps:
+            logger.error(
+                f"Processing of forecast {forecast_ref_time} failed "
+                f"for timestep(s): {failed_steps}"
+            )
+            failed = True
+    if failed:
+        sys.exit(1)
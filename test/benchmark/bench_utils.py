@@ -0,0 +1,17 @@
+"""Timing helpers shared by the benchmarks."""
+
+import statistics
+import time
+import typing
+
+
+def median_time(
+    func: typing.Callable[[], typing.Any], repeat: int
+) -> tuple[float, typing.Any]:
+    """Return the median duration of ``repeat`` calls in seconds, and a result."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), result
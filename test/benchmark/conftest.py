@@ -0,0 +1,31 @@
+import json
+import os
+import typing
+from datetime import datetime
+
+import pytest
+
+
+@pytest.fixture(scope="session")
+def benchmark_results():
+    """
+    Record the result of a benchmark: its name, its timings in seconds and
+    other details. The results are written as JSON at the end of the session
+    to ``$FLEXPREP_BENCHMARK_JSON`` (``benchmark-results.json`` by default).
+    """
+    results: list[dict[str, typing.Any]] = []
+
+    def record(
+        benchmark: str, seconds: dict[str, float], **details: typing.Any
+    ) -> None:
+        results.append({"benchmark": benchmark, **details, "seconds": seconds})
+
+    yield record
+    if results:
+        path = os.environ.get("FLEXPREP_BENCHMARK_JSON", "benchmark-results.json")
+        with open(path, "w") as f:
+            json.dump(
+                {"created": datetime.now().isoformat(), "results": results},
+                f,
+                indent=2,
+            )
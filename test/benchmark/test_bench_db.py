@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta
+
+import pytest
+from bench_utils import median_time
+
+from flexprep import CONFIG
+from flexprep.domain.data_model import IFSForecast
+from flexprep.domain.db_utils import DB
+
+# About a month of forecasts, four per day
+N_FORECASTS = 120
+N_STEPS = 90
+REPEAT = 20
+
+
+def _forecast(
+    ref_time: datetime, step: int, suffix: str = "001", processed: bool = False
+) -> IFSForecast:
+    key = f"P1D{ref_time:%m%d%H}00{ref_time + timedelta(hours=step):%m%d%H}{suffix}"
+    return IFSForecast(
+        row_id=None,
+        forecast_ref_time=ref_time,
+        step=step,
+        key=key,
+        processed=processed,
+    )
+
+
+@pytest.mark.benchmark
+def test_bench_processable_steps(tmp_path, monkeypatch, benchmark_results):
+    monkeypatch.setattr(CONFIG.main, "db_path", str(tmp_path / "db.sqlite"))
+    db = DB()
+    ref_times = [
+        datetime(2024, 10, 1) + timedelta(hours=6 * i) for i in range(N_FORECASTS)
+    ]
+    # The earlier forecasts have been processed. The steps of the latest one
+    # arrived in a burst, e.g. after an outage, and are not processed yet.
+    latest = ref_times[-1]
+    db.insert_items(
+        item
+        for ref_time in ref_times
+        for item in [
+            _forecast(ref_time, 0, "011"),
+            _forecast(ref_time, 0),
+            *(
+                _forecast(ref_time, step, processed=ref_time != latest)
+                for step in range(1, N_STEPS + 1)
+                if (ref_time, step) != (latest, N_STEPS // 2)
+            ),
+        ]
+    )
+    # The step missing from the burst arrives
+    inserted = _forecast(latest, N_STEPS // 2)
+    db.insert_item(inserted)
+
+    full, steps = median_time(lambda: db.get_processable_steps(latest), REPEAT)
+    incremental, incremental_steps = median_time(
+        lambda: db.get_processable_steps(latest, inserted), REPEAT
+    )
+    n_full, n_incremental = len(steps), len(incremental_steps)
+
+    rows = N_FORECASTS * (N_STEPS + 2)
+    benchmark_results(
+        "processable_steps",
+        {"full": full, "incremental": incremental},
+        rows=rows,
+        steps={"full": n_full, "incremental": n_incremental},
+    )
+    print(
+        f"\nProcessable steps after one insert ({rows} rows): "
+        f"full rescan {full * 1000:.2f} ms ({n_full} steps), "
+        f"incremental {incremental * 1000:.2f} ms ({n_incremental} steps)"
+    )
+    assert n_incremental == N_STEPS // 2 + 1
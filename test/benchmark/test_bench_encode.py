@@ -0,0 +1,108 @@
+import io
+
+import pytest
+from bench_utils import median_time
+from meteodatalab import config, data_source, grib_decoder, metadata
+
+from flexprep.domain.encoding_utils import write_fields
+from flexprep.domain.metadata_utils import REF_KEYS, REF_VALUES, MetadataCache
+
+FIELDS = ["u", "v", "t", "q", "sp", "2t", "10u", "10v", "tcc", "sd"]
+ACCUMULATED = ["cp", "lsp", "ssr", "sshf", "ewss", "nsss"]
+N_STEPS = 5
+
+
+def _encode(ds, template):
+    """Encode a step like ``Processing._write_fields``."""
+    out = io.BytesIO()
+    for name, field in ds.items():
+        if metadata.extract_keys(field.message, "editionNumber") == 1:
+            template_number = 8 if name in ACCUMULATED else None
+            field.attrs = dict(template(ds, name, template_number))
+        grib_decoder.save(field, out)
+    return out.getvalue()
+
+
+def _uncached(ds, name, template_number):
+    ref = next(
+        field.message
+        for field in ds.values()
+        if metadata.extract_keys(field.message, REF_KEYS) == REF_VALUES
+    )
+    overrides = {}
+    if template_number is not None:
+        overrides["productDefinitionTemplateNumber"] = template_number
+    return metadata.override(ref, **overrides, shortName=name)
+
+
+@pytest.mark.benchmark
+def test_bench_encode_templates(synthetic_ifs, benchmark_results):
+    # Every step has its own inputs: accumulated surface fields in GRIB1 use
+    # a template with statistical processing, which depends on the step
+    datasets = []
+    for step in range(1, N_STEPS + 1):
+        file_objs, paths = synthetic_ifs(step, step - 1, levels=10, grid=(31, 16))
+        with config.set_values(data_scope="ifs"):
+            source = data_source.FileDataSource(datafiles=[paths[file_objs[-1]["key"]]])
+            datasets.append(grib_decoder.load(source, {"param": FIELDS + ACCUMULATED}))
+
+    before, uncached = median_time(
+        lambda: [_encode(ds, _uncached) for ds in datasets], 1
+    )
+    before /= N_STEPS
+
+    cache = MetadataCache()
+    cache.set_forecast(datasets[0]["u"].ref_time.values[0])
+    after, cached = median_time(
+        lambda: [_encode(ds, cache.template) for ds in datasets], 1
+    )
+    after /= N_STEPS
+
+    benchmark_results(
+        "encode_templates",
+        {"uncached_per_step": before, "cached_per_step": after},
+        fields=len(datasets[0]),
+    )
+    print(
+        f"\nEncode time per step of {len(datasets[0])} fields: "
+        f"{before:.3f} s without, {after:.3f} s with the template cache"
+    )
+    assert cached == uncached
+
+
+@pytest.mark.benchmark
+def test_bench_parallel_encoding(synthetic_grib, benchmark_results):
+    path = synthetic_grib(
+        "input.grib",
+        fields_3d=FIELDS[:4],
+        fields_2d=FIELDS[4:],
+        levels=60,
+        step=3,
+        grid=(181, 91),
+    )
+    with config.set_values(data_scope="ifs"):
+        source = data_source.FileDataSource(datafiles=[path])
+        ds = grib_decoder.load(source, {"param": FIELDS})
+    fields = list(ds.values())
+
+    def encode(max_workers):
+        out = io.BytesIO()
+        write_fields(fields, out, max_workers)
+        return out.getvalue()
+
+    timings, outputs = {}, {}
+    for max_workers in (1, 4):
+        timings[max_workers], outputs[max_workers] = median_time(
+            lambda: encode(max_workers), 1
+        )
+
+    benchmark_results(
+        "parallel_encoding",
+        {f"{max_workers}_workers": seconds for max_workers, seconds in timings.items()},
+        fields=len(fields),
+    )
+    print(
+        f"\nEncoding {len(fields)} fields: {timings[1]:.3f} s serial, "
+        f"{timings[4]:.3f} s with 4 threads"
+    )
+    assert outputs[4] == outputs[1]
@@ -0,0 +1,58 @@
+import pytest
+from bench_utils import median_time
+from meteodatalab import config, data_source, grib_decoder
+
+from flexprep.domain.grib_utils import coalesce_ranges, index_file, select_messages
+from flexprep.domain.memory_utils import MemoryDataSource
+
+REQUESTED = ["u", "v", "t", "q", "sp"]
+REPEAT = 3
+
+
+def _load(datafiles):
+    with config.set_values(data_scope="ifs"):
+        source = data_source.FileDataSource(datafiles=datafiles)
+        return grib_decoder.load(source, {"param": REQUESTED})
+
+
+def _load_indexed(path):
+    selected = select_messages(index_file(path), REQUESTED)
+    parts = [(start, end - start) for start, end in coalesce_ranges(selected)]
+    with config.set_values(data_scope="ifs"):
+        source = MemoryDataSource(parts={path: parts})
+        return grib_decoder.load(source, {"param": REQUESTED})
+
+
+@pytest.mark.benchmark
+def test_bench_indexed_load(synthetic_grib, benchmark_results):
+    # 8 fields on 60 levels plus surface fields: ~500 messages,
+    # of which only about half are requested
+    path = synthetic_grib(
+        "input.grib",
+        fields_3d=["u", "v", "t", "q", "w", "vo", "d", "cc"],
+        fields_2d=["sp", "2t", "10u", "10v", "tcc", "sd"],
+        levels=60,
+        step=3,
+    )
+
+    unindexed, ds_full = median_time(lambda: _load([path]), 1)
+    # The first indexed load builds the index, the later ones read it
+    first_indexed, ds_indexed = median_time(lambda: _load_indexed(path), 1)
+    indexed, _ = median_time(lambda: _load_indexed(path), REPEAT)
+
+    benchmark_results(
+        "indexed_load",
+        {
+            "unindexed": unindexed,
+            "indexed_building_index": first_indexed,
+            "indexed": indexed,
+        },
+    )
+    print(
+        f"\nunindexed load: {unindexed:.3f} s, "
+        f"indexed load (building index): {first_indexed:.3f} s, "
+        f"indexed load (persisted index): {indexed:.3f} s"
+    )
+    assert ds_full.keys() == ds_indexed.keys()
+    for name in REQUESTED:
+        assert (ds_full[name] == ds_indexed[name]).all()
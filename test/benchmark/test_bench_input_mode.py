@@ -0,0 +1,59 @@
+import os
+import tempfile
+
+import pytest
+from bench_utils import median_time
+from meteodatalab import config, data_source, grib_decoder
+
+from flexprep.domain.memory_utils import MemoryDataSource
+
+REQUESTED = ["u", "v", "t", "q", "sp"]
+REPEAT = 3
+
+
+def _decode_from_disk(data: bytes):
+    # What the disk mode does: write the download, then decode the file
+    with tempfile.NamedTemporaryFile(suffix=".grib", delete=False) as f:
+        f.write(data)
+    try:
+        with config.set_values(data_scope="ifs"):
+            source = data_source.FileDataSource(datafiles=[f.name])
+            return grib_decoder.load(source, {"param": REQUESTED})
+    finally:
+        os.unlink(f.name)
+
+
+def _decode_from_memory(data: bytes):
+    with config.set_values(data_scope="ifs"):
+        source = MemoryDataSource(buffers=[data])
+        return grib_decoder.load(source, {"param": REQUESTED})
+
+
+@pytest.mark.benchmark
+def test_bench_input_mode(synthetic_grib, benchmark_results):
+    path = synthetic_grib(
+        "input.grib",
+        fields_3d=["u", "v", "t", "q"],
+        fields_2d=["sp"],
+        levels=60,
+        step=3,
+        grid=(181, 91),
+    )
+    with open(path, "rb") as f:
+        data = f.read()
+
+    disk, ds_disk = median_time(lambda: _decode_from_disk(data), REPEAT)
+    memory, ds_memory = median_time(lambda: _decode_from_memory(data), REPEAT)
+
+    benchmark_results(
+        "input_mode",
+        {"disk": disk, "memory": memory},
+        input_mib=len(data) / 1024**2,
+    )
+    print(
+        f"\n{len(data) / 1024**2:.1f} MiB input: "
+        f"disk {disk:.3f} s, memory {memory:.3f} s"
+    )
+    assert ds_disk.keys() == ds_memory.keys()
+    for name in REQUESTED:
+        assert (ds_disk[name] == ds_memory[name]).all()
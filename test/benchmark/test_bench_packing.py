@@ -0,0 +1,87 @@
+import eccodes
+import numpy as np
+import pytest
+from bench_utils import median_time
+
+# packingType, bitsPerValue
+CHOICES = [
+    ("grid_simple", 16),
+    ("grid_simple", 24),
+    ("grid_ccsds", 12),
+    ("grid_ccsds", 16),
+    ("grid_ccsds", 24),
+]
+N_LEVELS = 20
+GRID = 720, 361
+
+
+def _model_levels():
+    """Smooth fields on a 0.5 degree grid."""
+    ni, nj = GRID
+    return [
+        250 + np.cumsum(np.random.randn(nj, ni), axis=1).ravel() / 10
+        for _ in range(N_LEVELS)
+    ]
+
+
+def _encode(fields, packing_type, bits_per_value):
+    """Encode the fields once, with the packing set before the values."""
+    messages = []
+    for field in fields:
+        handle = eccodes.codes_grib_new_from_samples("GRIB2")
+        try:
+            eccodes.codes_set(handle, "Ni", GRID[0])
+            eccodes.codes_set(handle, "Nj", GRID[1])
+            eccodes.codes_set(handle, "packingType", packing_type)
+            eccodes.codes_set(handle, "bitsPerValue", bits_per_value)
+            eccodes.codes_set_values(handle, field)
+            messages.append(eccodes.codes_get_message(handle))
+        finally:
+            eccodes.codes_release(handle)
+    return messages
+
+
+def _decode(messages):
+    values = []
+    for message in messages:
+        handle = eccodes.codes_new_from_message(message)
+        values.append(eccodes.codes_get_values(handle))
+        eccodes.codes_release(handle)
+    return values
+
+
+@pytest.mark.benchmark
+def test_bench_packing(benchmark_results):
+    fields = _model_levels()
+
+    lines, sizes = [""], {}
+    for packing_type, bits_per_value in CHOICES:
+        elapsed, messages = median_time(
+            lambda: _encode(fields, packing_type, bits_per_value), 1
+        )
+
+        # Compared with the values before encoding
+        errors = [
+            np.abs(decoded - original).max() / np.ptp(original)
+            for decoded, original in zip(_decode(messages), fields)
+        ]
+        size = sizes[packing_type, bits_per_value] = sum(map(len, messages))
+        simple = sizes.get(("grid_simple", bits_per_value))
+        ratio = ""
+        if simple and packing_type != "grid_simple":
+            ratio = f", {size / simple:.0%} of grid_simple"
+        lines.append(
+            f"{packing_type:>11}, {bits_per_value} bits: "
+            f"{size / 1024**2:5.1f} MiB{ratio}, encoded in {elapsed:.2f} s, "
+            f"max error {max(errors):.1e} of the value range"
+        )
+        benchmark_results(
+            "packing",
+            {"encode": elapsed},
+            packing_type=packing_type,
+            bits_per_value=bits_per_value,
+            output_mib=size / 1024**2,
+            max_relative_error=float(max(errors)),
+        )
+        assert max(errors) <= 2.0**-bits_per_value
+    print("\n".join(lines))
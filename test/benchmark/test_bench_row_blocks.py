@@ -0,0 +1,80 @@
+"""Peak memory of the decoding and pre-processing of a step, by row blocks."""
+
+import json
+import subprocess
+import sys
+
+import pytest
+
+STEP, PREV_STEP = 4, 3
+# The operator outputs the model levels from 40 to 137
+GRID, LEVELS = (180, 91), 137
+ROWS_PER_BLOCK = [None, 16]
+
+# Runs in a fresh interpreter, as the peak resident memory of a process
+# only grows. Prints the spans of the metrics, which record it.
+PRE_PROCESS = """
+import json, sys
+from datetime import datetime
+from unittest.mock import MagicMock
+
+from flexprep import CONFIG
+from flexprep.domain.flexpart_utils import CONSTANTS, INPUT_FIELDS
+from flexprep.domain.processing import Processing
+
+setup = json.loads(sys.argv[1])
+CONFIG.main.flexpart.rows_per_block = setup["rows_per_block"]
+CONFIG.main.metrics.enabled = True
+CONFIG.main.metrics.textfile = None
+CONFIG.main.state.enabled = False
+CONFIG.main.field_store.enabled = False
+
+processing = Processing(db=MagicMock())
+processing.metadata_cache.set_forecast(datetime.fromisoformat(setup["ref_time"]))
+ds_in = processing._load(setup["paths"], {"param": list(CONSTANTS | INPUT_FIELDS)})
+ds_in |= processing.metadata_cache.pv(ds_in["u"].message)
+processing._apply_flexpart(ds_in)
+print(json.dumps(processing.metrics.spans))
+"""
+
+
+@pytest.mark.benchmark
+def test_bench_row_blocks(synthetic_ifs, benchmark_results):
+    pytest.importorskip("meteodatalab.operators.flexpart")
+    file_objs, paths = synthetic_ifs(STEP, PREV_STEP, LEVELS, GRID)
+    ref_time = file_objs[0]["forecast_ref_time"]
+
+    lines = [""]
+    for rows_per_block in ROWS_PER_BLOCK:
+        setup = {
+            "rows_per_block": rows_per_block,
+            "ref_time": ref_time.isoformat(),
+            "paths": list(paths.values()),
+        }
+        result = subprocess.run(
+            [sys.executable, "-c", PRE_PROCESS, json.dumps(setup)],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        spans = {span["span"]: span for span in json.loads(result.stdout)}
+        peak_rss_mib = {
+            name: span["peak_rss_bytes"] / 1024**2 for name, span in spans.items()
+        }
+        benchmark_results(
+            "row_blocks",
+            {name: span["seconds"] for name, span in spans.items()},
+            rows_per_block=rows_per_block,
+            grid=list(GRID),
+            levels=LEVELS,
+            peak_rss_mib=peak_rss_mib,
+        )
+        lines.append(
+            f"rows per block {rows_per_block}: "
+            + ", ".join(
+                f"{name} {spans[name]['seconds']:.2f} s, "
+                f"peak RSS {peak_rss_mib[name]:.0f} MiB"
+                for name in ("decode", "flexpart")
+            )
+        )
+    print("\n".join(lines))
@@ -0,0 +1,106 @@
+"""Time each stage of the processing of one step on synthetic IFS inputs."""
+
+import contextlib
+import io
+import os
+import tempfile
+import time
+from unittest.mock import MagicMock
+
+import boto3
+import pytest
+from moto import mock_aws
+
+pytest.importorskip("meteodatalab.operators.flexpart")
+
+from flexprep import CONFIG  # noqa: E402
+from flexprep.domain.flexpart_utils import CONSTANTS, INPUT_FIELDS  # noqa: E402
+from flexprep.domain.processing import Processing  # noqa: E402
+from flexprep.domain.validation_utils import validate_dataset  # noqa: E402
+
+STEP, PREV_STEP = 4, 3
+# name: (grid, number of model levels)
+SIZES = {
+    "small": ((90, 46), 20),
+    "medium": ((360, 181), 60),
+    "large": ((720, 361), 137),
+}
+
+
+@pytest.fixture
+def processing():
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=CONFIG.main.s3_buckets.input.name)
+        client.create_bucket(Bucket=CONFIG.main.s3_buckets.output.name)
+        processing = Processing(db=MagicMock())
+        processing.s3_client.s3_client_input = client
+        processing.s3_client.s3_client_output = client
+        processing.s3_client.cache = None
+        yield processing
+
+
+def _upload(processing: Processing, data: bytes, key: str) -> None:
+    """Upload the output the way ``_save_output`` does."""
+    if CONFIG.main.upload.streaming:
+        with processing.s3_client.open_upload(key) as writer:
+            writer.write(data)
+        return
+    with tempfile.NamedTemporaryFile(suffix=key) as output_file:
+        output_file.write(data)
+        output_file.flush()
+        processing.s3_client.upload_file(output_file.name, key=key)
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("size", SIZES)
+def test_bench_stages(processing, synthetic_ifs, benchmark_results, size):
+    grid, levels = SIZES[size]
+    file_objs, paths = synthetic_ifs(STEP, PREV_STEP, levels, grid)
+    ref_time = file_objs[0]["forecast_ref_time"]
+    for key, path in paths.items():
+        processing.s3_client.s3_client_input.upload_file(
+            path, CONFIG.main.s3_buckets.input.name, key
+        )
+    params = list(CONSTANTS | INPUT_FIELDS)
+    timings: dict[str, float] = {}
+
+    @contextlib.contextmanager
+    def stage(name: str):
+        start = time.perf_counter()
+        yield
+        timings[name] = time.perf_counter() - start
+
+    with stage("download"):
+        temp_files = processing._download_files(file_objs)
+    try:
+        with stage("decode"):
+            ds_in = processing._load(temp_files, {"param": params})
+    finally:
+        processing._release_inputs(temp_files)
+    with stage("validate"):
+        validate_dataset(ds_in, params, ref_time, STEP, PREV_STEP)
+    processing.metadata_cache.set_forecast(ref_time)
+    ds_in |= processing.metadata_cache.pv(ds_in["u"].message)
+    with stage("flexpart"):
+        ds_out = processing._apply_flexpart(ds_in)
+    output = io.BytesIO()
+    with stage("encode"):
+        processing._write_fields(ds_out, output)
+    with stage("upload"):
+        _upload(processing, output.getvalue(), "dispf2024100104")
+
+    input_bytes = sum(os.path.getsize(path) for path in paths.values())
+    benchmark_results(
+        "stages",
+        timings,
+        size=size,
+        grid=list(grid),
+        levels=levels,
+        input_mib=input_bytes / 1024**2,
+        output_mib=len(output.getvalue()) / 1024**2,
+    )
+    print(
+        f"\n{size} ({grid[0]}x{grid[1]}, {levels} levels): "
+        + ", ".join(f"{name} {seconds:.2f} s" for name, seconds in timings.items())
+    )
@@ -0,0 +1,118 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+import pytest
+from bench_utils import median_time
+
+REPEAT = 5
+STEP, PREV_STEP = 4, 3
+INPUT_ENDPOINT = "https://object-store.os-api.cci1.ecmwf.int"
+
+INSERT_ONLY = "import runpy; runpy.run_module('flexprep', run_name='__main__')"
+
+# Uploads the inputs of a step to a mocked S3 and records the files before it
+# in the database, then times the notification of the step in the same
+# interpreter. boto3 is imported by the mock before the timer starts.
+INSERT_AND_PROCESS = """
+import json, runpy, sys, time
+
+import boto3
+from moto import mock_aws
+
+from flexprep import CONFIG
+from flexprep.domain.data_model import IFSForecast
+from flexprep.domain.db_utils import DB
+
+setup = json.loads(sys.argv.pop(1))
+with mock_aws():
+    client = boto3.client(
+        "s3", endpoint_url=CONFIG.main.s3_buckets.input.endpoint_url
+    )
+    for bucket in CONFIG.main.s3_buckets.input, CONFIG.main.s3_buckets.output:
+        client.create_bucket(Bucket=bucket.name)
+    for key, path in setup["paths"].items():
+        client.upload_file(path, CONFIG.main.s3_buckets.input.name, key)
+    db = DB()
+    for step, key in setup["inserted"]:
+        db.insert_item(
+            IFSForecast.from_notification(step, "20241001", "0", "/input/" + key)
+        )
+    db.conn.close()
+
+    start = time.perf_counter()
+    try:
+        runpy.run_module("flexprep", run_name="__main__")
+    except SystemExit as e:
+        if e.code:
+            raise
+    print(time.perf_counter() - start)
+"""
+
+
+def _run(code: str, step: int, key: str, env: dict[str, str], *setup: str) -> str:
+    args = ["--step", str(step), "--date", "20241001", "--time", "0"]
+    args += ["--location", f"/input/{key}"]
+    result = subprocess.run(
+        [sys.executable, "-c", code, *setup, *args],
+        env=os.environ | env,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return result.stdout
+
+
+@pytest.mark.benchmark
+def test_bench_cold_start_insert_only(tmp_path, benchmark_results):
+    env = {"SVC__MAIN__DB_PATH": str(tmp_path / "db.sqlite")}
+    # Without step-0 files no step becomes processable
+    steps = iter(range(1, REPEAT + 1))
+
+    def insert() -> None:
+        step = next(steps)
+        _run(INSERT_ONLY, step, f"P1D10010000100100{step:02d}1", env)
+
+    median, _ = median_time(insert, REPEAT)
+
+    benchmark_results("cold_start_insert_only", {"median": median}, runs=REPEAT)
+    print(f"\ninsert only: median {median:.3f} s over {REPEAT} runs")
+
+
+@pytest.mark.benchmark
+def test_bench_cold_start_insert_and_process(
+    tmp_path, synthetic_ifs, benchmark_results
+):
+    pytest.importorskip("meteodatalab.operators.flexpart")
+    file_objs, paths = synthetic_ifs(STEP, PREV_STEP, levels=20, grid=(90, 46))
+    *inserted, notified = file_objs
+    setup = json.dumps(
+        {
+            "paths": paths,
+            "inserted": [(obj["step"], obj["key"]) for obj in inserted],
+        }
+    )
+
+    timings = []
+    for run in range(REPEAT):
+        run_dir = tmp_path / str(run)
+        run_dir.mkdir()
+        env = {
+            "SVC__MAIN__DB_PATH": str(run_dir / "db.sqlite"),
+            "SVC__MAIN__CACHE__ENABLED": "false",
+            "SVC__MAIN__STATE__ENABLED": "false",
+            "SVC__MAIN__FIELD_STORE__ENABLED": "false",
+            "SVC__MAIN__DAEMON__SPOOL_DIR": str(run_dir / "spool"),
+            "SVC__MAIN__METRICS__ENABLED": "false",
+            "MOTO_S3_CUSTOM_ENDPOINTS": INPUT_ENDPOINT,
+            "AWS_DEFAULT_REGION": "us-east-1",
+        }
+        stdout = _run(INSERT_AND_PROCESS, notified["step"], notified["key"], env, setup)
+        timings.append(float(stdout.split()[-1]))
+
+    # Timed in the subprocess, after the mocked inputs are set up
+    median = statistics.median(timings)
+    benchmark_results("cold_start_insert_and_process", {"median": median}, runs=REPEAT)
+    print(f"\ninsert and process: median {median:.3f} s over {REPEAT} runs")
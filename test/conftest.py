@@ -0,0 +1,65 @@
+import typing
+from datetime import timedelta
+
+import pytest
+from synthetic import CONSTANTS, INPUT_FIELDS, REF_TIME, write_grib_file, write_ifs_file
+
+
+@pytest.fixture
+def synthetic_ifs(tmp_path):
+    """
+    Factory writing the inputs of one step: the constants and step-0 files,
+    the previous step and the current step.
+
+    Returns the file objects of the step as stored in the database, and
+    the paths of the files by key.
+    """
+
+    def create(
+        step: int,
+        prev_step: int,
+        levels: int,
+        grid: tuple[int, int],
+    ) -> tuple[list[dict[str, typing.Any]], dict[str, str]]:
+        # The constants file is valid at minute 01 of the reference time
+        files = [(f"P1D{REF_TIME:%m%d%H%M}{REF_TIME:%m%d%H}011", 0, CONSTANTS)]
+        for file_step in sorted({0, prev_step, step}):
+            valid_time = REF_TIME + timedelta(hours=file_step)
+            key = f"P1D{REF_TIME:%m%d%H%M}{valid_time:%m%d%H%M}1"
+            files.append((key, file_step, INPUT_FIELDS))
+
+        file_objs, paths = [], {}
+        for row_id, (key, file_step, fields) in enumerate(files, start=1):
+            paths[key] = str(tmp_path / key)
+            write_ifs_file(paths[key], sorted(fields), file_step, levels, grid)
+            file_objs.append(
+                {
+                    "row_id": row_id,
+                    "forecast_ref_time": REF_TIME,
+                    "step": file_step,
+                    "key": key,
+                    "processed": False,
+                }
+            )
+        return file_objs, paths
+
+    return create
+
+
+@pytest.fixture
+def synthetic_grib(tmp_path):
+    """Factory writing a synthetic multi-message GRIB file."""
+
+    def create(
+        name: str,
+        fields_3d: typing.Iterable[str],
+        fields_2d: typing.Iterable[str],
+        levels: int,
+        step: int,
+        grid: tuple[int, int] = (31, 16),
+    ) -> str:
+        path = str(tmp_path / name)
+        write_grib_file(path, fields_3d, fields_2d, step, levels, grid)
+        return path
+
+    return create
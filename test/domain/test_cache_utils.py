@@ -0,0 +1,96 @@
+import os
+
+import pytest
+
+from flexprep.domain.cache_utils import FileCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return FileCache(str(tmp_path / "cache"), max_size_bytes=10)
+
+
+def _writer(content: bytes):
+    def fetch(path):
+        with open(path, "wb") as f:
+            f.write(content)
+
+    return fetch
+
+
+def test_entry_name_depends_on_etag():
+    name_1 = FileCache.entry_name("bucket", "P1D10010000100100011", '"etag-1"')
+    name_2 = FileCache.entry_name("bucket", "P1D10010000100100011", '"etag-2"')
+
+    assert name_1 != name_2
+    assert name_1.endswith("P1D10010000100100011")
+
+
+def test_get_or_fetch_hit_and_miss(cache):
+    path, hit = cache.get_or_fetch("entry", _writer(b"grib"))
+    assert not hit
+
+    path_again, hit = cache.get_or_fetch("entry", _writer(b"other"))
+    assert hit
+    assert path_again == path
+    with open(path, "rb") as f:
+        assert f.read() == b"grib"
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.contains(path)
+
+
+def test_failed_fetch_leaves_no_entry(cache):
+    def failing_fetch(path):
+        raise RuntimeError("download failed")
+
+    with pytest.raises(RuntimeError):
+        cache.get_or_fetch("entry", failing_fetch)
+
+    assert os.listdir(cache.path) == [FileCache.LOCK_DIR]
+
+
+def test_evict_least_recently_used(cache):
+    old_path, _ = cache.get_or_fetch("old", _writer(b"123456"))
+    cache.release(old_path)
+    os.utime(old_path, (0, 0))
+    new_path, _ = cache.get_or_fetch("new", _writer(b"123456"))
+
+    assert not os.path.exists(old_path)
+    assert os.path.exists(new_path)
+
+
+def test_lock_files_are_bounded(cache, monkeypatch):
+    monkeypatch.setattr(FileCache, "LOCK_SLOTS", 4)
+    for i in range(20):
+        path, _ = cache.get_or_fetch(f"entry-{i}", _writer(b"1"))
+        cache.release(path)
+
+    lock_files = os.listdir(os.path.join(cache.path, FileCache.LOCK_DIR))
+    # A use and a fetch lock per slot, and the eviction lock
+    assert len(lock_files) <= 2 * FileCache.LOCK_SLOTS + 1
+
+
+def test_evict_skips_entries_in_use(cache):
+    old_path, _ = cache.get_or_fetch("old", _writer(b"123456"))
+    os.utime(old_path, (0, 0))
+    new_path, _ = cache.get_or_fetch("new", _writer(b"123456"))
+
+    assert os.path.exists(old_path)
+    assert os.path.exists(new_path)
+
+    # Once handed back, the entry is evicted on the next miss
+    cache.release(old_path)
+    cache.get_or_fetch("other", _writer(b"1"))
+    assert not os.path.exists(old_path)
+
+
+def test_evict_counts_sidecars(cache):
+    old_path, _ = cache.get_or_fetch("old", _writer(b"1234"))
+    with open(old_path + ".idx", "w") as f:
+        f.write("1234")
+    cache.release(old_path)
+    os.utime(old_path, (0, 0))
+    cache.get_or_fetch("new", _writer(b"1234"))
+
+    assert not os.path.exists(old_path)
+    assert not os.path.exists(old_path + ".idx")
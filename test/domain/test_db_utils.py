@@ -0,0 +1,223 @@
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from flexprep import CONFIG
+from flexprep.domain import db_utils
+from flexprep.domain.data_model import IFSForecast
+from flexprep.domain.db_utils import DB
+
+FORECAST_REF_TIME = datetime(2024, 10, 1)
+N_STEPS = 24
+N_PROCESSES = 8
+
+
+def _forecast(step: int, key: str) -> IFSForecast:
+    return IFSForecast(
+        row_id=None,
+        forecast_ref_time=FORECAST_REF_TIME,
+        step=step,
+        key=key,
+        processed=False,
+    )
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "sqlite3-db")
+    monkeypatch.setattr(CONFIG.main, "db_path", path)
+    db = DB()
+    db.insert_item(_forecast(0, "P1D10010000100100011"))
+    db.insert_item(_forecast(0, "P1D10010000100100001"))
+    for step in range(1, N_STEPS + 1):
+        db.insert_item(_forecast(step, f"P1D100100001001{step:02d}001"))
+    db.conn.close()
+    return path
+
+
+def test_processable_steps(db_path):
+    steps = DB().get_processable_steps(FORECAST_REF_TIME)
+
+    assert [objs[-1]["step"] for objs in steps] == list(range(1, N_STEPS + 1))
+    # Step 1 uses both step-0 files, later steps also their previous step
+    assert len(steps[0]) == 3
+    assert len(steps[1]) == 4
+
+
+def test_claim_item(db_path):
+    db = DB()
+    row_id = db.get_processable_steps(FORECAST_REF_TIME)[0][-1]["row_id"]
+
+    assert db.claim_item(row_id, owner="first")
+    assert not db.claim_item(row_id, owner="second")
+    # Claimed steps are no longer reported as processable
+    assert row_id not in [
+        objs[-1]["row_id"] for objs in db.get_processable_steps(FORECAST_REF_TIME)
+    ]
+
+    db.release_item(row_id)
+    assert db.claim_item(row_id, owner="second")
+
+
+def test_expired_lease_can_be_claimed(db_path, monkeypatch):
+    db = DB()
+    row_id = db.get_processable_steps(FORECAST_REF_TIME)[0][-1]["row_id"]
+    monkeypatch.setattr(CONFIG.main.db, "lease_seconds", -1)
+
+    assert db.claim_item(row_id, owner="crashed")
+    assert db.claim_item(row_id, owner="second")
+
+
+def _claim_in_process(db_path: str) -> list[int]:
+    CONFIG.main.db_path = db_path
+    db = DB()
+    steps = db.claim_steps(db.get_processable_steps(FORECAST_REF_TIME))
+    return [objs[-1]["step"] for objs in steps]
+
+
+def test_concurrent_processes_split_the_work(db_path):
+    with ProcessPoolExecutor(max_workers=N_PROCESSES) as executor:
+        claimed = list(executor.map(_claim_in_process, [db_path] * N_PROCESSES))
+
+    all_claimed = [step for steps in claimed for step in steps]
+    assert sorted(all_claimed) == list(range(1, N_STEPS + 1))
+
+
+def test_incremental_processable_steps(tmp_path, monkeypatch):
+    monkeypatch.setattr(CONFIG.main, "db_path", str(tmp_path / "sqlite3-db"))
+    db = DB()
+    db.insert_item(_forecast(0, "P1D10010000100100011"))
+    db.insert_item(_forecast(0, "P1D10010000100100001"))
+    # Steps arrive out of order: step 3 stays blocked until step 2 arrives,
+    # step 5 is not unblocked by step 2
+    for step in (1, 3, 5):
+        db.insert_item(_forecast(step, f"P1D100100001001{step:02d}001"))
+    db.update_item_as_processed(
+        db.get_processable_steps(FORECAST_REF_TIME)[0][-1]["row_id"]
+    )
+    step_2 = _forecast(2, "P1D10010000100100021")
+    db.insert_item(step_2)
+
+    steps = db.get_processable_steps(FORECAST_REF_TIME, inserted=step_2)
+
+    assert [objs[-1]["step"] for objs in steps] == [2, 3]
+    full_rescan = db.get_processable_steps(FORECAST_REF_TIME)
+    assert steps == [objs for objs in full_rescan if objs[-1]["step"] in (2, 3)]
+
+
+def test_failed_step_is_retried_by_a_later_insert(tmp_path, monkeypatch):
+    monkeypatch.setattr(CONFIG.main, "db_path", str(tmp_path / "sqlite3-db"))
+    db = DB()
+    db.insert_item(_forecast(0, "P1D10010000100100011"))
+    db.insert_item(_forecast(0, "P1D10010000100100001"))
+    step_1 = _forecast(1, "P1D10010000100101001")
+    db.insert_item(step_1)
+    [failed] = db.claim_steps(db.get_processable_steps(FORECAST_REF_TIME, step_1))
+    # The processing of step 1 fails and its lease is released
+    db.release_item(failed[-1]["row_id"])
+
+    step_2 = _forecast(2, "P1D10010000100102001")
+    db.insert_item(step_2)
+    steps = db.claim_steps(db.get_processable_steps(FORECAST_REF_TIME, step_2))
+
+    assert [objs[-1]["step"] for objs in steps] == [1, 2]
+
+
+def test_deferred_step_waits_for_its_previous_step(tmp_path, monkeypatch):
+    monkeypatch.setattr(CONFIG.main, "db_path", str(tmp_path / "sqlite3-db"))
+    db = DB()
+    db.insert_item(_forecast(0, "P1D10010000100100011"))
+    db.insert_item(_forecast(0, "P1D10010000100100001"))
+    step_1 = _forecast(1, "P1D10010000100101001")
+    db.insert_item(step_1)
+    [deferred] = db.claim_steps(db.get_processable_steps(FORECAST_REF_TIME, step_1))
+    db.release_item(deferred[-1]["row_id"], retry=False)
+
+    step_3 = _forecast(3, "P1D10010000100103001")
+    db.insert_item(step_3)
+
+    assert db.get_processable_steps(FORECAST_REF_TIME, step_3) == []
+    # Still found by a full query, e.g. of the reconciler
+    assert len(db.get_processable_steps(FORECAST_REF_TIME)) == 1
+
+
+def test_retry_query_uses_its_index(db_path):
+    db = DB()
+    captured = []
+    db.conn.set_trace_callback(captured.append)
+    db.get_processable_steps(FORECAST_REF_TIME, _forecast(5, "unused"))
+    retry_query = next(query for query in captured if "cur.retry" in query)
+
+    plan = [
+        row["detail"] for row in db.conn.execute("EXPLAIN QUERY PLAN " + retry_query)
+    ]
+
+    assert any(
+        detail.startswith("SEARCH cur USING INDEX idx_uploaded_retry")
+        for detail in plan
+    )
+
+
+def test_step_query_uses_covering_index(db_path):
+    db = DB()
+    captured = []
+    db.conn.set_trace_callback(captured.append)
+    db.get_processable_steps(FORECAST_REF_TIME)
+    step_query = next(query for query in captured if "LEFT JOIN" in query)
+
+    plan = [
+        row["detail"] for row in db.conn.execute("EXPLAIN QUERY PLAN " + step_query)
+    ]
+
+    assert any(
+        detail.startswith("SEARCH cur USING COVERING INDEX idx_uploaded_steps")
+        for detail in plan
+    )
+    assert any(
+        detail.startswith("SEARCH prev USING COVERING INDEX idx_uploaded_steps")
+        and "step=?" in detail
+        for detail in plan
+    )
+
+
+def test_constants_flag(db_path):
+    db = DB()
+    rows = db.conn.execute("SELECT key FROM uploaded WHERE is_constants").fetchall()
+
+    assert [row["key"] for row in rows] == ["P1D10010000100100011"]
+
+
+@pytest.mark.parametrize("archive", [True, False])
+def test_prune(db_path, monkeypatch, archive):
+    monkeypatch.setattr(CONFIG.main.db, "retention_days", 30)
+    monkeypatch.setattr(CONFIG.main.db, "archive", archive)
+    db = DB()
+
+    assert db.prune(now=FORECAST_REF_TIME) == 0
+    assert db.prune(now=datetime(2024, 11, 1)) == N_STEPS + 2
+
+    assert db.conn.execute("SELECT COUNT(*) FROM uploaded").fetchone()[0] == 0
+    archived = db.conn.execute("SELECT COUNT(*) FROM uploaded_archive").fetchone()[0]
+    assert archived == (N_STEPS + 2 if archive else 0)
+
+
+def test_prune_uses_utc(db_path, monkeypatch):
+    monkeypatch.setattr(CONFIG.main.db, "retention_days", 30)
+    monkeypatch.setattr(CONFIG.main.db, "archive", True)
+
+    class Datetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            # 30 days and 30 minutes after the forecast, in UTC
+            utc = datetime(2024, 10, 31, 0, 30, tzinfo=timezone.utc)
+            # Local time of a host two hours behind UTC
+            return utc.astimezone(tz or timezone(timedelta(hours=-2)))
+
+    monkeypatch.setattr(db_utils, "dt", Datetime)
+    db = DB()
+    rows = db.conn.execute("SELECT * FROM uploaded ORDER BY row_id").fetchall()
+
+    assert db.prune() == N_STEPS + 2
+    archived = db.conn.execute("SELECT * FROM uploaded_archive ORDER BY row_id")
+    assert [dict(row) for row in archived] == [dict(row) for row in rows]
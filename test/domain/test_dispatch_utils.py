@@ -0,0 +1,163 @@
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from unittest.mock import MagicMock
+
+import pytest
+
+from flexprep import CONFIG
+from flexprep.domain import dispatch_utils
+from flexprep.domain.dispatch_utils import (
+    admit_steps,
+    chunk_steps,
+    estimate_step_bytes,
+    process_steps,
+    worker_count,
+)
+from flexprep.domain.grib_utils import GribMessage
+
+
+def _steps(*steps):
+    return [[{"step": 0}, {"step": 0}, {"step": step}] for step in steps]
+
+
+def test_chunk_steps_are_contiguous():
+    chunks = chunk_steps(_steps(5, 1, 4, 2, 3), 2)
+
+    assert [[objs[-1]["step"] for objs in chunk] for chunk in chunks] == [
+        [1, 2, 3],
+        [4, 5],
+    ]
+
+
+def test_chunk_steps_skips_empty_chunks():
+    assert len(chunk_steps(_steps(1), 3)) == 1
+
+
+def test_worker_count_respects_memory_budget(monkeypatch):
+    monkeypatch.setattr(CONFIG.main.parallel, "max_workers", 8)
+    monkeypatch.setattr(CONFIG.main.parallel, "worker_memory_gb", 4)
+    monkeypatch.setattr(dispatch_utils, "memory_limit_bytes", lambda: 10 * 1024**3)
+
+    assert worker_count(30) == 2
+    assert worker_count(1) == 1
+
+
+@pytest.mark.parametrize("failed", [[], [2]])
+def test_process_steps_reports_failed_steps(monkeypatch, failed):
+    monkeypatch.setattr(CONFIG.main.parallel, "max_workers", 1)
+    monkeypatch.setattr(dispatch_utils, "process_chunk", lambda chunk: failed)
+
+    assert process_steps(_steps(1, 2, 3)) == failed
+
+
+class _BrokenPool:
+    """Process pool whose workers all crash."""
+
+    def __init__(self, max_workers):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_exception(BrokenProcessPool("worker died"))
+        return future
+
+
+def test_crashed_workers_release_their_steps(monkeypatch):
+    monkeypatch.setattr(dispatch_utils, "memory_ceiling_bytes", lambda: None)
+    monkeypatch.setattr(dispatch_utils, "worker_count", lambda *args: 2)
+    monkeypatch.setattr(dispatch_utils, "ProcessPoolExecutor", _BrokenPool)
+    processing = MagicMock()
+
+    assert process_steps(_keyed_steps(1, 2, 3), processing) == [1, 2, 3]
+
+    released = [c.args[0] for c in processing.db.release_item.mock_calls]
+    assert sorted(released) == [3, 4, 5]
+
+
+def _messages(n_fields, n_values=100):
+    return [
+        GribMessage(0, 1, 2, "t", level, 1, datetime(2024, 10, 1), n_values)
+        for level in range(n_fields)
+    ] + [GribMessage(0, 1, 2, "w", None, 1, datetime(2024, 10, 1), n_values)]
+
+
+def _keyed_steps(*steps):
+    return [
+        [
+            {"row_id": 1, "key": "constants", "step": 0},
+            {"row_id": 2, "key": "0", "step": 0},
+            {"row_id": step + 2, "key": str(step), "step": step},
+        ]
+        for step in steps
+    ]
+
+
+def test_estimate_step_bytes(monkeypatch):
+    monkeypatch.setattr(CONFIG.main.memory, "bytes_per_value", 8)
+    monkeypatch.setattr(CONFIG.main.memory, "overhead", 2.0)
+    file_objs = _keyed_steps(1)[0]
+
+    # The unrequested field "w" is not decoded
+    assert estimate_step_bytes(file_objs, lambda key: _messages(10)) == 30 * 100 * 16
+    assert estimate_step_bytes(file_objs, lambda key: _messages(10, None)) is None
+
+
+def test_unknown_footprint_is_logged_once(monkeypatch, caplog):
+    monkeypatch.setattr(CONFIG.main.memory, "ceiling_mb", 1)
+    dispatch_utils._warn_unknown_footprint.cache_clear()
+    processing = MagicMock()
+    # Inputs listed by a sidecar index have no grid size
+    processing.s3_client.message_index.side_effect = lambda key: _messages(10, None)
+
+    for _ in range(2):
+        admitted, alone, largest = admit_steps(_keyed_steps(1, 2), processing)
+        assert len(admitted) == 2
+        assert (alone, largest) == ([], None)
+
+    warnings = [r for r in caplog.records if "grid size" in r.getMessage()]
+    assert len(warnings) == 1
+
+
+def test_worker_count_respects_memory_ceiling(monkeypatch):
+    monkeypatch.setattr(CONFIG.main.parallel, "max_workers", 8)
+    monkeypatch.setattr(CONFIG.main.parallel, "worker_memory_gb", 1)
+    monkeypatch.setattr(CONFIG.main.memory, "ceiling_mb", 1024)
+    monkeypatch.setattr(dispatch_utils, "memory_limit_bytes", lambda: 10 * 1024**3)
+
+    assert worker_count(30, 300 * 1024**2) == 3
+    assert worker_count(30) == 8
+
+
+@pytest.mark.parametrize("on_exceed", ["alone", "defer"])
+def test_process_steps_admission(monkeypatch, on_exceed):
+    monkeypatch.setattr(CONFIG.main.parallel, "max_workers", 1)
+    monkeypatch.setattr(CONFIG.main.memory, "ceiling_mb", 1)
+    monkeypatch.setattr(CONFIG.main.memory, "on_exceed", on_exceed)
+    processing = MagicMock()
+    processing.process_window.return_value = []
+    # Step 2 has a finer grid than the other inputs
+    processing.s3_client.message_index.side_effect = lambda key: _messages(
+        10, 10_000 if key == "2" else 100
+    )
+
+    assert process_steps(_keyed_steps(1, 2, 3), processing) == []
+
+    windows = [
+        [max(int(obj["step"]) for obj in file_objs) for file_objs in c.args[0]]
+        for c in processing.process_window.mock_calls
+    ]
+    if on_exceed == "alone":
+        assert windows == [[1, 3], [2]]
+        processing.db.release_item.assert_not_called()
+    else:
+        assert windows == [[1, 3]]
+        processing.db.release_item.assert_called_once_with(4, retry=False)
+    # The shared inputs are indexed once
+    assert processing.s3_client.message_index.call_count == 5
@@ -0,0 +1,158 @@
+import io
+import logging
+import random
+import threading
+import time
+from unittest.mock import MagicMock
+
+import eccodes
+import numpy as np
+import pytest
+import xarray as xr
+from meteodatalab import data_source, grib_decoder
+
+from flexprep import CONFIG
+from flexprep.domain import encoding_utils
+from flexprep.domain.encoding_utils import encode_field, write_fields
+
+# Replaced by the thread_safe fixture in the other tests
+eccodes_thread_safe = encoding_utils.eccodes_thread_safe
+
+
+def _save(field, file_handle, bits_per_value=16):
+    # Fields finish in random order
+    time.sleep(random.uniform(0, 0.01))
+    file_handle.write(field.encode() * 100)
+
+
+@pytest.fixture(autouse=True)
+def thread_safe(monkeypatch):
+    monkeypatch.setattr(encoding_utils, "eccodes_thread_safe", lambda: True)
+
+
+def test_parallel_encoding_is_byte_identical(monkeypatch):
+    monkeypatch.setattr(encoding_utils.grib_decoder, "save", _save)
+    fields = [f"field-{i}" for i in range(21)]
+
+    serial, parallel = io.BytesIO(), io.BytesIO()
+    write_fields(fields, serial, max_workers=1)
+    write_fields(fields, parallel, max_workers=8)
+
+    assert parallel.getvalue() == serial.getvalue()
+
+
+def test_packing_is_applied_per_field(monkeypatch):
+    def save(field, file_handle, bits_per_value=16):
+        file_handle.write(f"{field}-{bits_per_value}".encode())
+
+    monkeypatch.setattr(encoding_utils.grib_decoder, "save", save)
+    fields = ["a", "b", b"cached"]
+    packing = [{"bitsPerValue": 24}, None, None]
+
+    for max_workers in (1, 4):
+        out = io.BytesIO()
+        write_fields(fields, out, max_workers, packing)
+        assert out.getvalue() == b"a-24b-16cached"
+
+
+def test_packing_is_set_on_the_template(monkeypatch):
+    override = MagicMock(return_value={"message": "packed"})
+    save = MagicMock(side_effect=lambda field, f, bits: f.write(b"GRIB"))
+    monkeypatch.setattr(encoding_utils.metadata, "override", override)
+    monkeypatch.setattr(encoding_utils.grib_decoder, "save", save)
+    field = xr.DataArray([1.0], attrs={"message": "template"})
+
+    encoded = encode_field(
+        field,
+        {"packingType": "grid_ccsds", "bitsPerValue": 12, "ccsdsBlockSize": 32},
+    )
+
+    # The values are encoded once, with the packing of the template
+    assert encoded == b"GRIB"
+    override.assert_called_once_with(
+        "template", packingType="grid_ccsds", ccsdsBlockSize=32
+    )
+    (saved, _, bits_per_value), _ = save.call_args
+    assert saved.attrs["message"] == "packed"
+    assert bits_per_value == 12
+
+
+@pytest.mark.parametrize("bits_per_value", [12, 16])
+def test_packing_precision(tmp_path, bits_per_value):
+    handle = eccodes.codes_grib_new_from_samples("GRIB2")
+    eccodes.codes_set(handle, "shortName", "t")
+    eccodes.codes_set_values(
+        handle, np.zeros(eccodes.codes_get(handle, "numberOfValues"))
+    )
+    path = tmp_path / "t.grib"
+    path.write_bytes(eccodes.codes_get_message(handle))
+    eccodes.codes_release(handle)
+    field = grib_decoder.load(
+        data_source.FileDataSource(datafiles=[str(path)]), {"param": ["t"]}
+    )["t"]
+    original = 250 + np.cumsum(np.random.randn(*field.shape), axis=-1)
+    field = field.copy(data=original)
+
+    encoded = encode_field(
+        field, {"packingType": "grid_ccsds", "bitsPerValue": bits_per_value}
+    )
+
+    handle = eccodes.codes_new_from_message(encoded)
+    assert eccodes.codes_get(handle, "packingType") == "grid_ccsds"
+    assert eccodes.codes_get(handle, "bitsPerValue") == bits_per_value
+    values = eccodes.codes_get_values(handle)
+    eccodes.codes_release(handle)
+    tolerance = np.ptp(original) / 2**bits_per_value
+    assert np.abs(values - original.ravel()).max() <= tolerance
+
+
+def test_in_flight_fields_are_bounded(monkeypatch):
+    lock = threading.Lock()
+    started, written = [], []
+
+    def save(field, file_handle, bits_per_value=16):
+        with lock:
+            started.append(field)
+            # Fields are never encoded further ahead than twice the workers
+            assert len(started) - len(written) <= 4
+        file_handle.write(field.encode())
+
+    class Output(io.BytesIO):
+        def write(self, data):
+            written.append(data)
+            return super().write(data)
+
+    monkeypatch.setattr(encoding_utils.grib_decoder, "save", save)
+    fields = [f"{i:02d}" for i in range(20)]
+    out = Output()
+
+    write_fields(fields, out, max_workers=2)
+
+    assert out.getvalue() == "".join(fields).encode()
+
+
+def test_falls_back_to_one_thread(monkeypatch):
+    monkeypatch.setattr(encoding_utils, "eccodes_thread_safe", lambda: False)
+    monkeypatch.setattr(
+        encoding_utils, "ThreadPoolExecutor", MagicMock(side_effect=AssertionError)
+    )
+    monkeypatch.setattr(encoding_utils.grib_decoder, "save", _save)
+    out = io.BytesIO()
+
+    write_fields(["a", "b"], out, max_workers=4)
+
+    assert out.getvalue() == b"a" * 100 + b"b" * 100
+
+
+@pytest.mark.parametrize("declared", [False, True])
+def test_thread_safety_without_build_features(monkeypatch, caplog, declared):
+    monkeypatch.delattr(eccodes, "codes_get_features", raising=False)
+    monkeypatch.setattr(CONFIG.main.encode, "eccodes_threads", declared)
+    eccodes_thread_safe.cache_clear()
+    try:
+        with caplog.at_level(logging.WARNING):
+            assert eccodes_thread_safe() is declared
+    finally:
+        eccodes_thread_safe.cache_clear()
+
+    assert ("encode.eccodes_threads" in caplog.text) is not declared
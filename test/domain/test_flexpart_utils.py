@@ -1,8 +1,17 @@
 from unittest.mock import MagicMock
 
+import numpy as np
+import pandas as pd
 import pytest
+import xarray as xr
+from meteodatalab import data_source, grib_decoder
 
-from flexprep.domain.flexpart_utils import prepare_output
+from flexprep.domain.flexpart_utils import (
+    combine_lead_times,
+    concat_rows,
+    prepare_output,
+    row_blocks,
+)
 from flexprep.domain.processing import CONSTANTS, INPUT_FIELDS
 
 
@@ -22,3 +31,76 @@ def test_prepare_output_missing_fields(setup_data):
 
     # Check that ds_out now contains input_fields + constants
     assert set(CONSTANTS | INPUT_FIELDS) == set(ds_out.keys())
+
+
+def _field(steps):
+    return xr.DataArray(
+        np.full((len(steps), 2), steps[0], dtype=float),
+        dims=["lead_time", "cell"],
+        coords={"lead_time": pd.to_timedelta(steps, "h")},
+        attrs={"message": f"step-{steps[0]}"},
+    )
+
+
+def test_combine_lead_times():
+    step_zero = {"z": _field([0]), "u": _field([0])}
+    prev = {"u": _field([3])}
+    cur = {"u": _field([6])}
+
+    ds_in = combine_lead_times(step_zero, prev, cur)
+
+    assert ds_in["z"] is step_zero["z"]
+    np.testing.assert_array_equal(
+        ds_in["u"].coords["lead_time"].values, pd.to_timedelta([0, 3, 6], "h").values
+    )
+    np.testing.assert_array_equal(ds_in["u"].values[:, 0], [0, 3, 6])
+    assert ds_in["u"].attrs["message"] == "step-6"
+
+
+def test_combined_metadata_matches_joint_decode(synthetic_ifs):
+    file_objs, paths = synthetic_ifs(4, 3, levels=3, grid=(6, 5))
+    by_step = {}
+    for file_obj in file_objs:
+        by_step.setdefault(file_obj["step"], []).append(paths[file_obj["key"]])
+    request = {"param": list(CONSTANTS | INPUT_FIELDS)}
+
+    def decode(datafiles):
+        source = data_source.FileDataSource(datafiles=datafiles)
+        return grib_decoder.load(source, request)
+
+    # All the files of the step at once, the current step first
+    joint = decode(by_step[4] + by_step[3] + by_step[0])
+    ds_in = combine_lead_times(
+        decode(by_step[0]), decode(by_step[3]), decode(by_step[4])
+    )
+
+    assert ds_in.keys() == joint.keys()
+    for name, field in joint.items():
+        xr.testing.assert_identical(ds_in[name], field)
+
+
+def test_row_blocks_round_trip():
+    ds = {
+        "t": xr.DataArray(
+            np.random.rand(2, 7, 3),
+            dims=["z", "y", "x"],
+            coords={
+                "y": np.arange(7),
+                "lat": (("y", "x"), np.random.rand(7, 3)),
+                "z": [1, 2],
+            },
+            attrs={"message": "t"},
+        ),
+        "ak": xr.DataArray(np.arange(3.0), dims=["z"]),
+    }
+
+    blocks = list(row_blocks(ds, 3))
+
+    assert [block["t"].sizes["y"] for block in blocks] == [3, 3, 1]
+    assert all(block["ak"] is ds["ak"] for block in blocks)
+    combined = concat_rows(iter(blocks), rows=7)
+    xr.testing.assert_identical(combined["t"], ds["t"])
+    assert combined["ak"] is ds["ak"]
+    # The rows are copied, not views of the blocks
+    blocks[0]["t"].values[...] = -1
+    assert (combined["t"].values >= 0).all()
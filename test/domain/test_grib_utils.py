@@ -0,0 +1,195 @@
+import json
+from datetime import datetime
+from unittest.mock import MagicMock
+
+import eccodes
+import numpy as np
+import pytest
+
+from flexprep.domain.grib_utils import (
+    coalesce_ranges,
+    extract_messages,
+    index_file,
+    parse_header,
+    parse_sidecar_index,
+    scan_messages,
+    select_messages,
+    write_index,
+)
+
+REF_TIME = datetime(2024, 10, 1, 6)
+
+
+def _message(sample: str, **keys) -> bytes:
+    handle = eccodes.codes_grib_new_from_samples(sample)
+    try:
+        eccodes.codes_set(handle, "centre", 98)
+        eccodes.codes_set(handle, "dataDate", int(REF_TIME.strftime("%Y%m%d")))
+        eccodes.codes_set(handle, "dataTime", int(REF_TIME.strftime("%H%M")))
+        for key, value in keys.items():
+            eccodes.codes_set(handle, key, value)
+        eccodes.codes_set_values(
+            handle, np.random.rand(eccodes.codes_get(handle, "numberOfValues"))
+        )
+        return eccodes.codes_get_message(handle)
+    finally:
+        eccodes.codes_release(handle)
+
+
+@pytest.fixture
+def grib_data():
+    return b"".join(
+        [
+            _message("GRIB2", shortName="u", step=3),
+            _message("GRIB2", shortName="cp", stepRange="0-3"),
+            _message("GRIB1", shortName="2t", step=3),
+            _message("GRIB2", shortName="10u", step=3),
+            _message("GRIB2", shortName="sp", step=3),
+        ]
+    )
+
+
+def test_parse_header_grib2():
+    message = parse_header(_message("GRIB2", shortName="10u", step=6))
+
+    assert message.short_name == "10u"
+    assert message.level == 10
+    assert message.step == 6
+    assert message.ref_time == REF_TIME
+
+
+def test_scan_messages(grib_data):
+    reads = []
+
+    def read(start, end):
+        reads.append((start, end))
+        return grib_data[start:end]
+
+    messages = scan_messages(read, len(grib_data), block_size=64)
+
+    assert [m.short_name for m in messages] == ["u", "cp", "2t", "10u", "sp"]
+    assert [m.edition for m in messages] == [2, 2, 1, 2, 2]
+    assert all(m.step == 3 for m in messages)
+    assert sum(m.length for m in messages) == len(grib_data)
+    # Only the headers are read
+    assert sum(end - start for start, end in reads) < len(grib_data)
+
+
+@pytest.mark.parametrize("sample", ["GRIB1", "GRIB2"])
+def test_parse_header_grid_size(sample):
+    data = _message(sample, shortName="t", Ni=31, Nj=16)
+
+    assert parse_header(data).n_values == 31 * 16
+
+
+def test_scan_messages_rejects_truncated_file(grib_data):
+    truncated = grib_data[:-10]
+    with pytest.raises(ValueError, match="Truncated GRIB message"):
+        scan_messages(lambda start, end: truncated[start:end], len(truncated))
+
+
+def test_select_and_coalesce(grib_data):
+    messages = scan_messages(lambda start, end: grib_data[start:end], len(grib_data))
+    selected = select_messages(messages, {"u", "cp", "10u", "sp"})
+
+    ranges = coalesce_ranges(selected)
+
+    assert ranges == [
+        (messages[0].offset, messages[2].offset),
+        (messages[3].offset, len(grib_data)),
+    ]
+
+
+def test_parse_sidecar_index():
+    lines = [
+        json.dumps(
+            {
+                "date": "20241001",
+                "time": "0600",
+                "step": "3",
+                "levelist": "137",
+                "param": "u",
+                "_offset": 0,
+                "_length": 100,
+            }
+        ),
+        json.dumps(
+            {
+                "date": "20241001",
+                "time": "0600",
+                "step": "3",
+                "param": "134",
+                "_offset": 100,
+                "_length": 50,
+            }
+        ),
+    ]
+
+    messages = parse_sidecar_index(lines)
+
+    assert [m.short_name for m in messages] == ["u", "sp"]
+    assert messages[0].level == 137
+    assert messages[1].offset == 100
+    assert all(m.ref_time == REF_TIME for m in messages)
+
+
+@pytest.mark.parametrize(
+    "param, short_name", [("130.128", "t"), ("143.228", "cp"), ("sp", "sp")]
+)
+def test_parse_sidecar_index_param_notations(param, short_name):
+    line = {"date": "20241001", "time": "0600", "param": param}
+    line |= {"_offset": 0, "_length": 100}
+
+    [message] = parse_sidecar_index([json.dumps(line)])
+
+    assert message.short_name == short_name
+
+
+def test_parse_sidecar_index_unknown_param():
+    line = {"date": "20241001", "time": "0600", "param": "999.999"}
+    line |= {"_offset": 0, "_length": 100}
+
+    with pytest.raises(ValueError, match="999.999"):
+        parse_sidecar_index([json.dumps(line)])
+
+
+def test_index_file_is_persisted(grib_data, tmp_path):
+    path = tmp_path / "input.grib"
+    path.write_bytes(grib_data)
+
+    messages = index_file(str(path))
+
+    assert (tmp_path / "input.grib.idx").exists()
+    assert index_file(str(path)) == messages
+
+
+def test_failed_index_write_leaves_no_file(grib_data, tmp_path):
+    path = tmp_path / "input.grib"
+    path.write_bytes(grib_data)
+    messages = index_file(str(path))
+    broken = MagicMock()
+    broken.to_dict.side_effect = RuntimeError("broken")
+
+    with pytest.raises(RuntimeError):
+        write_index(str(tmp_path / "other.grib.idx"), [*messages, broken])
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "input.grib",
+        "input.grib.idx",
+    ]
+
+
+def test_extract_messages(grib_data, tmp_path):
+    path = tmp_path / "input.grib"
+    path.write_bytes(grib_data)
+    messages = index_file(str(path))
+
+    out = tmp_path / "extracted.grib"
+    with open(out, "wb") as f:
+        extract_messages(str(path), select_messages(messages, {"cp", "sp"}), f)
+
+    extracted = out.read_bytes()
+    assert [
+        m.short_name
+        for m in scan_messages(lambda start, end: extracted[start:end], len(extracted))
+    ] == ["cp", "sp"]
@@ -0,0 +1,31 @@
+import eccodes
+from meteodatalab import config
+
+from flexprep.domain.memory_utils import MemoryDataSource
+
+
+def _message(short_name: str) -> bytes:
+    handle = eccodes.codes_grib_new_from_samples("GRIB2")
+    try:
+        eccodes.codes_set(handle, "shortName", short_name)
+        return eccodes.codes_get_message(handle)
+    finally:
+        eccodes.codes_release(handle)
+
+
+def test_retrieve_from_files_parts_and_buffers(tmp_path):
+    t, u, v = _message("t"), _message("u"), _message("v")
+    whole = tmp_path / "whole.grib"
+    whole.write_bytes(t)
+    partial = tmp_path / "partial.grib"
+    partial.write_bytes(t + u + v)
+    source = MemoryDataSource(
+        datafiles=[str(whole)],
+        parts={str(partial): [(len(t), len(u))]},
+        buffers=[v],
+    )
+
+    with config.set_values(data_scope="ifs"):
+        fields = list(source.retrieve({"param": ["t", "u", "v"]}))
+
+    assert [field.metadata("shortName") for field in fields] == ["t", "u", "v"]
@@ -0,0 +1,135 @@
+from datetime import datetime
+from unittest.mock import MagicMock
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from flexprep.domain import metadata_utils
+from flexprep.domain.metadata_utils import MetadataCache
+
+
+@pytest.fixture
+def metadata(monkeypatch):
+    mock = MagicMock()
+    mock.extract_keys.side_effect = lambda message, keys: (
+        (2, 0) if message.startswith("ref") else (1, 0)
+    )
+    mock.override.side_effect = _override
+    monkeypatch.setattr(metadata_utils, "metadata", mock)
+    return mock
+
+
+def _override(message, **kwargs):
+    template = {"from": message.partition("@")[0]} | kwargs
+    if kwargs.get("productDefinitionTemplateNumber") == 8:
+        # The end of the overall time interval is taken from the message,
+        # the keys of the other templates are set by the encoder
+        template["hourOfEndOfOverallTimeInterval"] = int(message.partition("@")[2])
+    return template
+
+
+def _field(message: str, step: int) -> xr.DataArray:
+    return xr.DataArray(
+        np.zeros((1, 2)),
+        dims=["lead_time", "cell"],
+        coords={"lead_time": [np.timedelta64(step, "h")]},
+        attrs={"message": message},
+    )
+
+
+def _ds_out(step: int = 3):
+    return {
+        "z": _field("ed1", 0),
+        "lsp": _field("ed1", step),
+        "u": _field(f"ref@{step}", step),
+    }
+
+
+def test_templates_are_reused_within_a_forecast(metadata):
+    cache = MetadataCache()
+    cache.set_forecast(datetime(2024, 10, 1))
+
+    for _ in range(3):
+        template = cache.template(_ds_out(), "lsp", 8)
+
+    assert template == {
+        "from": "ref",
+        "productDefinitionTemplateNumber": 8,
+        "shortName": "lsp",
+        "hourOfEndOfOverallTimeInterval": 3,
+    }
+    assert list(template)[:3] == [
+        "from",
+        "productDefinitionTemplateNumber",
+        "shortName",
+    ]
+    assert metadata.override.call_count == 1
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_templates_match_uncached_across_steps(metadata):
+    cache = MetadataCache()
+    cache.set_forecast(datetime(2024, 10, 1))
+
+    for step in (3, 6, 3):
+        for name, template_number in [("lsp", 8), ("2t", None)]:
+            uncached = MetadataCache()
+            uncached.set_forecast(datetime(2024, 10, 1))
+            assert cache.template(_ds_out(step), name, template_number) == (
+                uncached.template(_ds_out(step), name, template_number)
+            )
+
+    # Templates without statistical processing are shared by all steps
+    assert cache.misses == 3 + 1
+
+
+def test_new_forecast_invalidates(metadata):
+    cache = MetadataCache()
+    cache.set_forecast(datetime(2024, 10, 1))
+    cache.template(_ds_out(), "lsp")
+    cache.pv("ref")
+    cache.pv("ref")
+    assert metadata.extract_pv.call_count == 1
+
+    cache.set_forecast(datetime(2024, 10, 1, 6))
+    cache.template(_ds_out(), "lsp")
+    cache.pv("ref")
+
+    assert metadata.override.call_count == 2
+    assert metadata.extract_pv.call_count == 2
+
+
+def _constant(step: int) -> xr.DataArray:
+    return xr.DataArray(
+        np.zeros((1, 2)),
+        dims=["lead_time", "cell"],
+        coords={"lead_time": [np.timedelta64(step, "h")]},
+    )
+
+
+def test_pv_is_extracted_in_the_ifs_data_scope(metadata, monkeypatch):
+    scopes = []
+    config = MagicMock()
+    config.set_values.return_value.__enter__.side_effect = lambda: scopes.append(
+        config.set_values.call_args.kwargs["data_scope"]
+    )
+    config.set_values.return_value.__exit__.side_effect = lambda *_: scopes.clear()
+    metadata.extract_pv.side_effect = lambda message: {"scope": list(scopes)}
+    monkeypatch.setattr(metadata_utils, "config", config)
+    cache = MetadataCache()
+    cache.set_forecast(datetime(2024, 10, 1))
+
+    assert cache.pv("ref") == {"scope": ["ifs"]}
+
+
+def test_constant_fields_are_encoded_once(monkeypatch):
+    encode_field = MagicMock(return_value=b"GRIB z")
+    monkeypatch.setattr(metadata_utils, "encode_field", encode_field)
+    cache = MetadataCache()
+    cache.set_forecast(datetime(2024, 10, 1))
+
+    for _ in range(3):
+        assert cache.encoded_constant("z", _constant(0)) == b"GRIB z"
+
+    encode_field.assert_called_once()
@@ -0,0 +1,142 @@
+import json
+import logging
+import os
+import time
+import tracemalloc
+
+import pytest
+
+from flexprep.domain.metrics_utils import Metrics, claim_slot, slot_textfile
+
+
+def test_span_records_stage(caplog):
+    metrics = Metrics(enabled=True)
+    metrics.start_step(6)
+
+    with caplog.at_level(logging.INFO), metrics.span("encode") as span:
+        span["bytes"] = 1024
+
+    record = json.loads(caplog.records[-1].getMessage())
+    assert record["span"] == "encode"
+    assert record["step"] == 6
+    assert record["bytes"] == 1024
+    assert record["seconds"] >= 0
+    assert "failed" not in record
+
+
+def test_span_marks_failure():
+    metrics = Metrics(enabled=True)
+    metrics.start_step(6)
+
+    with pytest.raises(RuntimeError):
+        with metrics.span("download"):
+            raise RuntimeError("download failed")
+
+    assert metrics.spans[0]["failed"] is True
+
+
+def test_disabled_metrics_write_nothing(tmp_path):
+    textfile = tmp_path / "flexprep.prom"
+    metrics = Metrics(enabled=False, textfile=str(textfile))
+    metrics.start_step(6)
+
+    with metrics.span("encode") as span:
+        span["bytes"] = 1024
+    metrics.finish_step(True)
+
+    assert metrics.spans == []
+    assert not textfile.exists()
+
+
+def test_textfile_aggregates_stages(tmp_path):
+    textfile = tmp_path / "metrics" / "flexprep.prom"
+    metrics = Metrics(enabled=True, textfile=str(textfile))
+    metrics.start_step(6)
+
+    for size in (100, 200):
+        with metrics.span("download") as span:
+            span["bytes"] = size
+    with metrics.span("flexpart") as span:
+        span["fields"] = 24
+    metrics.finish_step(False)
+
+    written = textfile.parent / "flexprep.0.prom"
+    lines = written.read_text().splitlines()
+    slot = 'slot="0"'
+    assert f'flexprep_stage_bytes{{{slot},stage="download"}} 300' in lines
+    assert f'flexprep_stage_fields{{{slot},stage="flexpart"}} 24' in lines
+    assert (
+        sum(line.startswith("flexprep_stage_duration_seconds{") for line in lines) == 2
+    )
+    assert f"flexprep_last_step{{{slot}}} 6" in lines
+    assert f"flexprep_last_step_success{{{slot}}} 0" in lines
+    assert sorted(textfile.parent.glob("*.prom")) == [written]
+
+
+def test_span_records_memory():
+    metrics = Metrics(enabled=True, trace_allocations=True)
+    metrics.start_step(6)
+
+    try:
+        with metrics.span("decode"):
+            data = bytearray(10 * 1024**2)
+        del data
+    finally:
+        tracemalloc.stop()
+
+    record = metrics.spans[0]
+    assert record["rss_bytes"] > 0
+    assert record["peak_rss_bytes"] > 0
+    assert record["traced_peak_bytes"] >= 10 * 1024**2
+
+
+def test_textfile_keeps_memory_maximum(tmp_path):
+    textfile = tmp_path / "flexprep.prom"
+    metrics = Metrics(enabled=True, textfile=str(textfile))
+    metrics.start_step(6)
+    metrics.spans = [
+        {"span": "decode", "seconds": 1.0, "rss_bytes": 300},
+        {"span": "decode", "seconds": 2.0, "rss_bytes": 100},
+    ]
+    metrics.finish_step(True)
+
+    lines = open(slot_textfile(str(textfile), 0)).read().splitlines()
+    slot = 'slot="0"'
+    assert f'flexprep_stage_rss_bytes{{{slot},stage="decode"}} 300' in lines
+    assert f'flexprep_stage_duration_seconds{{{slot},stage="decode"}} 3.0' in lines
+
+
+def test_processes_write_to_free_slots(tmp_path):
+    textfile = str(tmp_path / "flexprep.prom")
+    # Another running process holds the first slot
+    slot, lock = claim_slot(textfile)
+    assert slot == 0
+
+    metrics = Metrics(enabled=True, textfile=textfile)
+    metrics.start_step(6)
+    metrics.finish_step(True)
+    lines = open(slot_textfile(textfile, 1)).read().splitlines()
+    assert 'flexprep_last_step{slot="1"} 6' in lines
+    assert not os.path.exists(slot_textfile(textfile, 0))
+
+    # A later process reuses the released slot instead of adding a series
+    lock.close()
+    metrics = Metrics(enabled=True, textfile=textfile)
+    metrics.start_step(9)
+    metrics.finish_step(True)
+    lines = open(slot_textfile(textfile, 0)).read().splitlines()
+    assert 'flexprep_last_step{slot="0"} 9' in lines
+    assert sorted(path.name for path in tmp_path.glob("*.prom")) == [
+        "flexprep.0.prom",
+        "flexprep.1.prom",
+    ]
+
+
+def test_span_starts_at_given_time():
+    metrics = Metrics(enabled=True)
+    metrics.start_step(6)
+
+    with metrics.span("upload", time.perf_counter() - 5):
+        pass
+
+    assert metrics.spans[0]["seconds"] >= 5
@@ -1,9 +1,20 @@
 import logging
+from datetime import datetime
 from io import StringIO
+from unittest.mock import MagicMock
 
+import eccodes
+import numpy as np
+import pandas as pd
 import pytest
+import xarray as xr
 
+from flexprep import CONFIG
+from flexprep.domain import processing
+from flexprep.domain.flexpart_utils import CONSTANTS, INPUT_FIELDS, combine_lead_times
+from flexprep.domain.grib_utils import GribMessage
 from flexprep.domain.processing import Processing
+from flexprep.domain.validation_utils import validate_dataset
 
 
 @pytest.fixture
@@ -20,14 +31,21 @@ def log_capture():
 
 def test_sorted_files_length_less_than_3(log_capture):
 
-    processing_obj = Processing()
+    processing_obj = Processing(db=MagicMock())
     # Create file objects with length less than 3
     file_objs = [
-        processing_obj.FileObject(step="1", filename="file1"),
-        processing_obj.FileObject(step="2", filename="file2"),
+        Processing.FileObject(
+            step="1", filename="file1", forecast_ref_time=datetime(2024, 10, 1)
+        ),
+        Processing.FileObject(
+            step="2",
+            filename="file2",
+            forecast_ref_time=datetime(2024, 10, 1),
+            row_id=2,
+        ),
     ]
 
-    processing_obj._sort_and_download_files(file_objs)
+    assert processing_obj.process_window([file_objs]) == [2]
 
     # Check the captured log output
     log_capture.flush()
@@ -35,6 +53,307 @@ def test_sorted_files_length_less_than_3(log_capture):
 
     # Verify the logged message
     assert (
-        "Sorting and validation failed: Not enough files for pre-processing"
+        "Processing of timestep 2 failed: Not enough files for pre-processing"
         in log_contents
     )
+    processing_obj.db.release_item.assert_called_once_with(2)
+
+
+def test_download_files_releases_files_on_failure(tmp_path):
+    processing_obj = Processing()
+    processing_obj.s3_client = MagicMock()
+
+    def download_file(file_obj, params=None):
+        if file_obj["key"] == "broken":
+            raise RuntimeError("download failed")
+        temp_file = tmp_path / file_obj["key"]
+        temp_file.write_bytes(b"GRIB")
+        return str(temp_file)
+
+    processing_obj.s3_client.download_file.side_effect = download_file
+    file_objs = [{"key": "file1"}, {"key": "broken"}, {"key": "file2"}]
+
+    with pytest.raises(RuntimeError, match="An error occurred while downloading"):
+        processing_obj._download_files(file_objs)
+
+    released = {c.args[0] for c in processing_obj.s3_client.release_file.mock_calls}
+    assert released == {str(tmp_path / "file1"), str(tmp_path / "file2")}
+
+
+def test_download_file_falls_back_to_disk(tmp_path, monkeypatch):
+    monkeypatch.setattr(CONFIG.main.input, "mode", "memory")
+    processing_obj = Processing()
+    processing_obj.s3_client = MagicMock()
+    temp_file = tmp_path / "large"
+    temp_file.write_bytes(b"GRIB")
+    processing_obj.s3_client.download_to_memory.side_effect = [b"GRIB", None]
+    processing_obj.s3_client.download_file.return_value = str(temp_file)
+
+    assert processing_obj._download_file({"key": "small"}) == b"GRIB"
+    assert processing_obj._download_file({"key": "large"}) == str(temp_file)
+    processing_obj.s3_client.download_file.assert_called_once()
+
+
+def _fake_fflexpart(ds):
+    # Pointwise in the horizontal, like the pre-processing of flexpart
+    ds_out = {name: ds[name] * 2 for name in INPUT_FIELDS - {"etadot"}}
+    ds_out["omega"] = (ds["etadot"] * ds["ak"]).cumsum("z")
+    return ds_out
+
+
+@pytest.mark.parametrize("rows_per_block", [1, 3, 100])
+def test_apply_flexpart_by_row_blocks(monkeypatch, rows_per_block):
+    monkeypatch.setattr(processing.flx, "fflexpart", _fake_fflexpart)
+    lead_time = pd.to_timedelta([0, 3, 6], "h")
+    ds_in = {
+        name: xr.DataArray(
+            np.random.rand(3, 4, 7, 5),
+            dims=["lead_time", "z", "y", "x"],
+            coords={"lead_time": lead_time},
+            attrs={"message": name},
+        )
+        for name in INPUT_FIELDS
+    }
+    ds_in |= {
+        name: xr.DataArray(np.random.rand(7, 5), dims=["y", "x"]) for name in CONSTANTS
+    }
+    ds_in["ak"] = xr.DataArray(np.arange(4.0), dims=["z"])
+    processing_obj = Processing()
+
+    monkeypatch.setattr(CONFIG.main.flexpart, "rows_per_block", None)
+    expected = processing_obj._apply_flexpart(ds_in)
+    monkeypatch.setattr(CONFIG.main.flexpart, "rows_per_block", rows_per_block)
+    ds_out = processing_obj._apply_flexpart(ds_in)
+
+    assert ds_out.keys() == expected.keys()
+    for name, field in expected.items():
+        xr.testing.assert_identical(ds_out[name], field)
+
+
+def test_model_level_fields_are_decoded_one_at_a_time(monkeypatch, synthetic_ifs):
+    _, paths = synthetic_ifs(4, 3, levels=3, grid=(6, 5))
+    processing_obj = Processing()
+    load = MagicMock(side_effect=processing.grib_decoder.load)
+    monkeypatch.setattr(processing.grib_decoder, "load", load)
+    request = {"param": list(CONSTANTS | INPUT_FIELDS)}
+
+    monkeypatch.setattr(CONFIG.main.flexpart, "rows_per_block", None)
+    expected = processing_obj._load(list(paths.values()), request)
+    monkeypatch.setattr(CONFIG.main.flexpart, "rows_per_block", 2)
+    ds = processing_obj._load(list(paths.values()), request)
+
+    groups = [c.args[1]["param"] for c in load.mock_calls]
+    assert groups[0] == request["param"]
+    assert sorted(map(tuple, groups[1:6])) == [
+        ("etadot",),
+        ("q",),
+        ("t",),
+        ("u",),
+        ("v",),
+    ]
+    assert ds.keys() == expected.keys()
+    for name, field in expected.items():
+        xr.testing.assert_identical(ds[name], field)
+
+
+def test_row_blocks_match_the_operator(monkeypatch, synthetic_ifs):
+    pytest.importorskip("meteodatalab.operators.flexpart")
+    # The operator outputs the model levels from 40 to 137
+    file_objs, paths = synthetic_ifs(4, 3, levels=137, grid=(6, 5))
+    processing_obj = Processing()
+    processing_obj.metadata_cache.set_forecast(file_objs[0]["forecast_ref_time"])
+    params = list(CONSTANTS | INPUT_FIELDS)
+    ds_in = processing_obj._load(list(paths.values()), {"param": params})
+    ds_in |= processing_obj.metadata_cache.pv(ds_in["u"].message)
+
+    monkeypatch.setattr(CONFIG.main.flexpart, "rows_per_block", None)
+    expected = processing_obj._apply_flexpart(ds_in)
+    monkeypatch.setattr(CONFIG.main.flexpart, "rows_per_block", 2)
+    ds_out = processing_obj._apply_flexpart(ds_in)
+
+    assert ds_out.keys() == expected.keys()
+    for name, field in expected.items():
+        xr.testing.assert_identical(ds_out[name], field)
+
+
+def test_decode_files_shares_step_zero(tmp_path, monkeypatch):
+    monkeypatch.setattr(CONFIG.main.field_store, "enabled", True)
+    monkeypatch.setattr(CONFIG.main.field_store, "path", str(tmp_path))
+    processing_obj = Processing()
+    processing_obj.s3_client = MagicMock()
+    processing_obj.s3_client.etag.return_value = '"etag"'
+    ds = {
+        name: xr.DataArray(np.random.rand(2, 3), dims=["y", "x"])
+        for name in CONSTANTS | INPUT_FIELDS
+    }
+    monkeypatch.setattr(processing_obj, "_download_files", MagicMock(return_value=[]))
+    monkeypatch.setattr(processing_obj, "_load", MagicMock(return_value=ds))
+    file_objs = [{"key": "0", "step": 0, "forecast_ref_time": datetime(2024, 10, 1)}]
+
+    processing_obj._decode_files(file_objs)
+    # Another process finds the decoded fields in the store
+    other = Processing()
+    other.s3_client = processing_obj.s3_client
+    other._download_files = MagicMock()
+    loaded = other._decode_files(file_objs)
+
+    other._download_files.assert_not_called()
+    for name, field in ds.items():
+        np.testing.assert_array_equal(loaded[name].values, field.values)
+
+    # The input is replaced
+    processing_obj.s3_client.etag.return_value = '"other"'
+    other._load = MagicMock(return_value=ds)
+    other._decode_files(file_objs)
+
+    other._download_files.assert_called_once()
+
+
+def test_flexpart_on_stored_step_zero(tmp_path, monkeypatch, synthetic_ifs):
+    pytest.importorskip("meteodatalab.operators.flexpart")
+    monkeypatch.setattr(CONFIG.main.field_store, "enabled", True)
+    monkeypatch.setattr(CONFIG.main.field_store, "path", str(tmp_path / "fields"))
+    monkeypatch.setattr(CONFIG.main.flexpart, "rows_per_block", None)
+    # The operator outputs the model levels from 40 to 137
+    file_objs, paths = synthetic_ifs(4, 3, levels=137, grid=(6, 5))
+    step_zero = [obj for obj in file_objs if obj["step"] == 0]
+    steps = [obj for obj in file_objs if obj["step"] != 0]
+
+    def run(processing_obj):
+        processing_obj.s3_client = MagicMock()
+        processing_obj.s3_client.etag.return_value = '"etag"'
+        processing_obj._download_files = MagicMock(
+            side_effect=lambda objs: [paths[obj["key"]] for obj in objs]
+        )
+        ref_time = step_zero[0]["forecast_ref_time"]
+        processing_obj.metadata_cache.set_forecast(ref_time)
+        ds_in = combine_lead_times(
+            processing_obj._decode_files(step_zero),
+            *(processing_obj._decode_files([obj]) for obj in steps),
+        )
+        validate_dataset(ds_in, list(CONSTANTS | INPUT_FIELDS), ref_time, 4, 3)
+        ds_in |= processing_obj.metadata_cache.pv(ds_in["u"].message)
+        return processing_obj._apply_flexpart(ds_in)
+
+    # Decodes step 0 and publishes it
+    expected = run(Processing())
+    other = Processing()
+    ds_out = run(other)
+    assert len(other._download_files.mock_calls) == len(steps)
+    # Once more, on fields the operator did not alter in the store
+    ds_again = run(Processing())
+
+    assert ds_out.keys() == expected.keys()
+    for name, field in expected.items():
+        xr.testing.assert_identical(ds_out[name], field)
+        xr.testing.assert_identical(ds_again[name], field)
+
+
+def test_select_from_index_reads_messages_in_place(monkeypatch):
+    monkeypatch.setattr(CONFIG.main.grib_index, "enabled", True)
+    messages = [
+        GribMessage(offset, length, 2, name, None, 3, datetime(2024, 10, 1))
+        for offset, length, name in [
+            (0, 10, "u"),
+            (10, 10, "v"),
+            (20, 10, "w"),
+            (30, 5, "sp"),
+        ]
+    ]
+    indexes = {
+        "partial": messages,
+        "whole": messages[:2],
+        "broken": KeyError(3),
+    }
+
+    def index_file(path):
+        index = indexes[path]
+        if isinstance(index, Exception):
+            raise index
+        return index
+
+    monkeypatch.setattr(processing, "index_file", index_file)
+
+    datafiles, parts = Processing()._select_from_index(
+        ["partial", "whole", "broken"], ["u", "v", "sp"]
+    )
+
+    assert datafiles == ["whole", "broken"]
+    assert parts == {"partial": [(0, 20), (30, 5)]}
+
+
+def _window_processing(monkeypatch):
+    """Processing of a step 6 after step 3, with everything but the flow mocked."""
+    ref_time = datetime(2024, 10, 1)
+    monkeypatch.setattr(CONFIG.main.validation, "headers", True)
+    processing_obj = Processing(db=MagicMock())
+    processing_obj.s3_client = MagicMock()
+    processing_obj.s3_client.message_index.side_effect = lambda key: [
+        GribMessage(0, 1, 2, name, None, step, ref_time)
+        for name in (CONSTANTS if key == "constants" else INPUT_FIELDS)
+        for step in {0, int(key) if key.isdigit() else 0}
+    ]
+    processing_obj.accumulation_state = MagicMock()
+    for method in ("_decode_files", "_apply_flexpart", "_save_output"):
+        monkeypatch.setattr(processing_obj, method, MagicMock())
+    processing_obj.metadata_cache = MagicMock()
+    monkeypatch.setattr(processing, "combine_lead_times", MagicMock())
+    file_objs = [
+        {"key": key, "step": int(step), "forecast_ref_time": ref_time, "row_id": i}
+        for i, (key, step) in enumerate(
+            [("constants", 0), ("0", 0), ("3", 3), ("6", 6)]
+        )
+    ]
+    return processing_obj, file_objs
+
+
+def test_rebuilt_previous_step_skips_its_headers(monkeypatch):
+    processing_obj, file_objs = _window_processing(monkeypatch)
+    processing_obj.accumulation_state.has_step.return_value = True
+    monkeypatch.setattr(processing, "validate_dataset", MagicMock())
+
+    assert processing_obj.process_window([file_objs]) == []
+
+    keys = [c.args[0] for c in processing_obj.s3_client.message_index.mock_calls]
+    assert sorted(keys) == ["0", "6", "constants"]
+    decoded = [c.args[0] for c in processing_obj._decode_files.mock_calls]
+    assert file_objs[2] not in [obj for objs in decoded for obj in objs]
+
+
+@pytest.mark.parametrize(
+    "error", [ValueError("truncated"), KeyError(255), eccodes.GribInternalError(-10)]
+)
+def test_unscannable_headers_do_not_fail_the_step(monkeypatch, error):
+    processing_obj, file_objs = _window_processing(monkeypatch)
+    processing_obj.accumulation_state.has_step.return_value = False
+    processing_obj.s3_client.message_index.side_effect = error
+    monkeypatch.setattr(processing, "validate_dataset", MagicMock())
+
+    assert processing_obj.process_window([file_objs]) == []
+
+
+def test_invalid_headers_skip_download(monkeypatch):
+    processing_obj, file_objs = _window_processing(monkeypatch)
+    processing_obj.accumulation_state.has_step.return_value = False
+    # The inputs belong to another forecast
+    processing_obj.s3_client.message_index.side_effect = lambda key: [
+        GribMessage(0, 1, 2, name, None, 0, datetime(2024, 10, 1, 6))
+        for name in CONSTANTS | INPUT_FIELDS
+    ]
+
+    assert processing_obj.process_window([file_objs]) == [6]
+
+    processing_obj._decode_files.assert_not_called()
+
+
+def test_state_is_saved_after_validation(monkeypatch):
+    processing_obj, file_objs = _window_processing(monkeypatch)
+    processing_obj.accumulation_state.has_step.return_value = False
+    monkeypatch.setattr(
+        processing, "validate_dataset", MagicMock(side_effect=ValueError("invalid"))
+    )
+
+    assert processing_obj.process_window([file_objs]) == [6]
+
+    processing_obj.accumulation_state.save.assert_not_called()
+    processing_obj.db.release_item.assert_called_once_with(3)
@@ -0,0 +1,171 @@
+import io
+import os
+
+import boto3
+import eccodes
+import pytest
+from meteodatalab import data_source, grib_decoder
+from moto import mock_aws
+
+from flexprep import CONFIG
+from flexprep.domain import s3_utils
+from flexprep.domain.s3_utils import S3client, S3MultipartWriter
+
+BUCKET = "flexprep-output"
+PART_SIZE = 5 * 1024**2
+
+
+@pytest.fixture
+def s3_client():
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def _writer(s3_client, key="dispf2024100101"):
+    return S3MultipartWriter(
+        s3_client, BUCKET, key, part_size=PART_SIZE, max_in_flight=2
+    )
+
+
+def _read(s3_client, key="dispf2024100101"):
+    return s3_client.get_object(Bucket=BUCKET, Key=key)["Body"].read()
+
+
+def test_streams_parts(s3_client):
+    chunks = [os.urandom(1024**2) for _ in range(12)]
+
+    with _writer(s3_client) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+
+    assert len(writer._parts) == 3
+    assert _read(s3_client) == b"".join(chunks)
+
+
+def test_small_output_uses_single_put(s3_client):
+    with _writer(s3_client) as writer:
+        writer.write(b"GRIB")
+
+    assert writer._upload_id is None
+    assert _read(s3_client) == b"GRIB"
+
+
+def test_grib_decoder_saves_into_writer(s3_client, synthetic_grib):
+    path = synthetic_grib("fields", [], ["sp"], levels=1, step=0)
+    source = data_source.FileDataSource(datafiles=[path])
+    field = grib_decoder.load(source, {"param": ["sp"]})["sp"]
+    expected = io.BytesIO()
+    grib_decoder.save(field, expected)
+
+    with _writer(s3_client) as writer:
+        grib_decoder.save(field, writer)
+
+    assert _read(s3_client) == expected.getvalue()
+
+
+def test_failure_aborts_upload(s3_client):
+    with pytest.raises(RuntimeError):
+        with _writer(s3_client) as writer:
+            writer.write(os.urandom(PART_SIZE + 1))
+            raise RuntimeError("encoding failed")
+
+    assert "Uploads" not in s3_client.list_multipart_uploads(Bucket=BUCKET)
+    assert "Contents" not in s3_client.list_objects_v2(Bucket=BUCKET)
+
+
+@pytest.fixture
+def input_client(monkeypatch):
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=CONFIG.main.s3_buckets.input.name)
+        client.put_object(
+            Bucket=CONFIG.main.s3_buckets.input.name,
+            Key="P1D10010000100100011",
+            Body=b"GRIB" * 1024,
+        )
+        monkeypatch.setattr(CONFIG.main.selective_download, "enabled", False)
+        s3 = S3client.__new__(S3client)
+        s3.s3_client_input = client
+        yield s3
+
+
+def test_download_to_memory(input_client):
+    data = input_client.download_to_memory({"key": "P1D10010000100100011"})
+
+    assert data == b"GRIB" * 1024
+
+
+def test_download_to_memory_size_limit(input_client, monkeypatch):
+    monkeypatch.setattr(CONFIG.main.input, "max_memory_mb", 0)
+
+    assert input_client.download_to_memory({"key": "P1D10010000100100011"}) is None
+
+
+def test_download_to_shm(input_client, monkeypatch, tmp_path):
+    monkeypatch.setattr(CONFIG.main.input, "shm_dir", str(tmp_path))
+    input_client.cache = None
+
+    path = input_client.download_to_memory({"key": "P1D10010000100100011"})
+
+    assert os.path.dirname(path) == str(tmp_path)
+    with open(path, "rb") as f:
+        assert f.read() == b"GRIB" * 1024
+    input_client.release_file(path)
+    assert not os.listdir(tmp_path)
+
+
+def _grib_message(short_name):
+    handle = eccodes.codes_grib_new_from_samples("GRIB2")
+    try:
+        eccodes.codes_set(handle, "shortName", short_name)
+        return eccodes.codes_get_message(handle)
+    finally:
+        eccodes.codes_release(handle)
+
+
+def test_message_index_is_reused(input_client, monkeypatch):
+    monkeypatch.setattr(s3_utils, "MESSAGE_INDEX_CACHE_SIZE", 1)
+    bucket, key = CONFIG.main.s3_buckets.input.name, "P1D10010000100100011"
+    input_client._indexes = {}
+    input_client._indexes_lock = s3_utils.threading.Lock()
+    ranges = []
+    read_range = input_client._read_range
+
+    def count_ranges(*args):
+        ranges.append(args)
+        return read_range(*args)
+
+    monkeypatch.setattr(input_client, "_read_range", count_ranges)
+
+    def put(*names):
+        body = b"".join(_grib_message(name) for name in names)
+        input_client.s3_client_input.put_object(Bucket=bucket, Key=key, Body=body)
+
+    put("t", "u")
+    assert [m.short_name for m in input_client.message_index(key)] == ["t", "u"]
+    reads = len(ranges)
+    assert [m.short_name for m in input_client.message_index(key)] == ["t", "u"]
+    assert len(ranges) == reads
+
+    # A new version of the object is scanned again
+    put("v")
+    assert [m.short_name for m in input_client.message_index(key)] == ["v"]
+    assert len(input_client._indexes) == 1
+
+
+def test_download_without_requested_messages_fetches_whole_file(
+    input_client, monkeypatch, tmp_path
+):
+    monkeypatch.setattr(CONFIG.main.selective_download, "enabled", True)
+    bucket, key = CONFIG.main.s3_buckets.input.name, "P1D10010000100100011"
+    body = _grib_message("t") + _grib_message("u")
+    input_client.s3_client_input.put_object(Bucket=bucket, Key=key, Body=body)
+    input_client._indexes = {}
+    input_client._indexes_lock = s3_utils.threading.Lock()
+    path = tmp_path / "input.grib"
+
+    input_client._fetch(key, str(path), {"sp"})
+
+    assert path.read_bytes() == body
@@ -0,0 +1,88 @@
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from flexprep.domain.state_utils import AccumulationState
+
+REF_TIME = datetime(2024, 10, 1)
+
+
+def _field(step, values):
+    lead_time = pd.to_timedelta([step], "h")
+    return xr.DataArray(
+        values,
+        dims=["lead_time", "y", "x"],
+        coords={
+            "lead_time": lead_time,
+            "valid_time": ("lead_time", pd.Timestamp(REF_TIME) + lead_time),
+        },
+        attrs={"message": f"step-{step}"},
+    )
+
+
+def _dataset(step):
+    return {name: _field(step, np.random.rand(1, 4, 3)) for name in ("cp", "ssr", "t")}
+
+
+@pytest.fixture
+def state(tmp_path):
+    return AccumulationState(str(tmp_path))
+
+
+def test_load_rebuilds_previous_step(state):
+    prev_ds, cur_ds = _dataset(3), _dataset(6)
+    state.save(REF_TIME, 3, prev_ds)
+
+    rebuilt = state.load(REF_TIME, 3, cur_ds, 6)
+
+    # The attributes are those of the current step, combine_lead_times keeps
+    # the attributes of step 0
+    for name in ("cp", "ssr"):
+        xr.testing.assert_equal(rebuilt[name], prev_ds[name])
+    # Non-accumulated fields keep the values of the current step
+    np.testing.assert_array_equal(rebuilt["t"].values, cur_ds["t"].values)
+    xr.testing.assert_identical(
+        rebuilt["t"].coords["valid_time"], prev_ds["t"].valid_time
+    )
+
+
+def test_load_without_state(state):
+    assert state.load(REF_TIME, 3, _dataset(6), 6) is None
+
+
+def test_load_with_other_grid(state):
+    state.save(REF_TIME, 3, _dataset(3))
+    cur_ds = {name: _field(6, np.random.rand(1, 5, 3)) for name in ("cp", "ssr")}
+
+    assert state.load(REF_TIME, 3, cur_ds, 6) is None
+
+
+def test_float32_state(tmp_path):
+    state = AccumulationState(str(tmp_path), dtype="float32")
+    prev_ds = _dataset(3)
+    state.save(REF_TIME, 3, prev_ds)
+
+    rebuilt = state.load(REF_TIME, 3, _dataset(6), 6)
+
+    assert rebuilt["cp"].dtype == np.float64
+    np.testing.assert_allclose(rebuilt["cp"].values, prev_ds["cp"].values, rtol=1e-7)
+
+
+def test_save_keeps_recent_forecasts(state, tmp_path):
+    for hour in (0, 6, 12):
+        state.save(datetime(2024, 10, 1, hour), 3, _dataset(3))
+
+    assert sorted(os.listdir(tmp_path)) == ["2024100106", "2024100112"]
+
+
+def test_save_keeps_the_latest_step(state):
+    for step in (3, 6, 4):
+        state.save(REF_TIME, step, _dataset(step))
+
+    assert not state.has_step(REF_TIME, 3)
+    assert not state.has_step(REF_TIME, 4)
+    assert state.has_step(REF_TIME, 6)
@@ -0,0 +1,134 @@
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+from meteodatalab import data_source, grib_decoder
+
+from flexprep.domain.store_utils import METADATA_FILE, FieldStore
+
+REF_TIME = datetime(2024, 10, 1)
+VERSION = FieldStore.input_version([("P1D10010000100100001", '"etag"')])
+
+
+def _field(name, shape=(1, 4, 3)):
+    return xr.DataArray(
+        np.random.rand(*shape),
+        dims=["lead_time", "y", "x"],
+        coords={
+            "lead_time": pd.to_timedelta([0], "h"),
+            "ref_time": np.datetime64(REF_TIME, "ns"),
+            "lat": (("y", "x"), np.random.rand(*shape[1:])),
+        },
+        attrs={"message": b"GRIB", "parameter": {"shortName": name}},
+        name=name,
+    )
+
+
+@pytest.fixture
+def store(tmp_path):
+    return FieldStore(str(tmp_path), max_size_bytes=1024**2)
+
+
+def test_round_trip(store):
+    ds = {name: _field(name) for name in ("z", "sp")}
+    store.save(REF_TIME, 0, VERSION, ds)
+
+    loaded = store.load(REF_TIME, 0, VERSION, ["z", "sp"])
+
+    for name, field in ds.items():
+        xr.testing.assert_identical(loaded[name], field)
+    # Mapped from the store, not copied
+    assert isinstance(loaded["z"].data, np.memmap)
+
+
+def test_writes_do_not_reach_the_store(store):
+    field = _field("z")
+    store.save(REF_TIME, 0, VERSION, {"z": field})
+
+    store.load(REF_TIME, 0, VERSION, ["z"])["z"].data[:] = 0
+
+    loaded = store.load(REF_TIME, 0, VERSION, ["z"])["z"]
+    np.testing.assert_array_equal(loaded.values, field.values)
+
+
+def test_metadata_is_json(store, tmp_path):
+    store.save(REF_TIME, 0, VERSION, {"z": _field("z")})
+    entry_dir = os.path.join(tmp_path, "2024100100", "0", VERSION, "z")
+
+    with open(os.path.join(entry_dir, METADATA_FILE)) as f:
+        metadata = json.load(f)
+
+    assert metadata["attrs"]["parameter"] == {"shortName": "z"}
+
+
+def test_unsupported_attributes_are_not_stored(store):
+    field = _field("z")
+    field.attrs["grid"] = object()
+
+    store.save(REF_TIME, 0, VERSION, {"z": field})
+
+    assert store.load(REF_TIME, 0, VERSION, ["z"]) is None
+
+
+def test_replaced_inputs_are_not_loaded(store):
+    store.save(REF_TIME, 0, VERSION, {"z": _field("z")})
+    version = FieldStore.input_version([("P1D10010000100100001", '"other"')])
+
+    assert store.load(REF_TIME, 0, version, ["z"]) is None
+
+
+def test_round_trip_of_decoded_fields(store, synthetic_grib):
+    path = synthetic_grib("fields", ["u"], ["sp"], levels=3, step=0)
+    source = data_source.FileDataSource(datafiles=[path])
+    ds = grib_decoder.load(source, {"param": ["u", "sp"]})
+    store.save(REF_TIME, 0, VERSION, ds)
+
+    loaded = store.load(REF_TIME, 0, VERSION, ["u", "sp"])
+
+    for name, field in ds.items():
+        xr.testing.assert_identical(loaded[name], field)
+
+
+def test_load_missing_field(store):
+    store.save(REF_TIME, 0, VERSION, {"z": _field("z")})
+
+    assert store.load(REF_TIME, 0, VERSION, ["z", "sp"]) is None
+    assert store.load(REF_TIME, 6, VERSION, ["z"]) is None
+
+
+def test_published_fields_are_kept(store):
+    first = _field("z")
+    store.save(REF_TIME, 0, VERSION, {"z": first})
+    store.save(REF_TIME, 0, VERSION, {"z": _field("z")})
+
+    xr.testing.assert_identical(store.load(REF_TIME, 0, VERSION, ["z"])["z"], first)
+
+
+def test_evicts_least_recently_used(tmp_path):
+    store = FieldStore(str(tmp_path), max_size_bytes=1024**3)
+    for name in ("z", "lsm"):
+        store.save(REF_TIME, 0, VERSION, {name: _field(name, (1, 100, 100))})
+        os.utime(os.path.join(tmp_path, "2024100100", "0", VERSION, name), (0, 0))
+    # Room for two fields
+    entry_dir = os.path.join(tmp_path, "2024100100", "0", VERSION, "z")
+    entry_size = sum(
+        os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir)
+    )
+    store.max_size_bytes = int(2.5 * entry_size)
+    store.load(REF_TIME, 0, VERSION, ["z"])
+
+    store.save(REF_TIME, 0, VERSION, {"sdor": _field("sdor", (1, 100, 100))})
+
+    assert store.load(REF_TIME, 0, VERSION, ["lsm"]) is None
+    assert store.load(REF_TIME, 0, VERSION, ["z", "sdor"]) is not None
+
+
+def test_removes_old_forecasts(store, tmp_path):
+    for hour in (0, 6, 12):
+        store.save(datetime(2024, 10, 1, hour), 0, VERSION, {"z": _field("z")})
+
+    assert sorted(os.listdir(tmp_path)) == ["2024100106", "2024100112"]
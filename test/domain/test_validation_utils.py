@@ -5,7 +5,8 @@ import pandas as pd
 import pytest
 import xarray as xr
 
-from flexprep.domain.validation_utils import validate_dataset
+from flexprep.domain.grib_utils import GribMessage
+from flexprep.domain.validation_utils import validate_dataset, validate_headers
 
 
 @pytest.fixture
@@ -85,3 +86,38 @@ def test_incorrect_ref_time(setup_data):
 
     with pytest.raises(ValueError, match="The forecast reference time is incorrect"):
         validate_dataset(ds, params, ref_time, step, prev_step)
+
+
+def _headers(ref_time, steps_by_param):
+    return [
+        GribMessage(0, 1, 2, name, None, step, ref_time)
+        for name, steps in steps_by_param.items()
+        for step in steps
+    ]
+
+
+@pytest.mark.parametrize(
+    "steps_by_param, ref_time, error",
+    [
+        ({"t": [0, 3, 6], "z": [0], "other": [5]}, datetime(2023, 7, 18), None),
+        ({"t": [0, 3, 6]}, datetime(2023, 7, 18), "Not all requested parameters"),
+        ({"t": [0, 6], "z": [0]}, datetime(2023, 7, 18), "steps are incorrect"),
+        ({"t": [0, 3, 6], "z": [0]}, datetime(2023, 7, 19), "reference time"),
+    ],
+)
+def test_validate_headers(steps_by_param, ref_time, error):
+    messages = _headers(ref_time, steps_by_param)
+
+    if error is None:
+        validate_headers(messages, ["t", "z"], datetime(2023, 7, 18), 6, 3)
+    else:
+        with pytest.raises(ValueError, match=error):
+            validate_headers(messages, ["t", "z"], datetime(2023, 7, 18), 6, 3)
+
+
+def test_validate_headers_without_previous_step():
+    messages = _headers(datetime(2023, 7, 18), {"t": [0, 6], "z": [0]})
+
+    validate_headers(messages, ["t", "z"], datetime(2023, 7, 18), 6, None)
+    with pytest.raises(ValueError, match="steps are incorrect"):
+        validate_headers(messages, ["t", "z"], datetime(2023, 7, 18), 6, 3)
@@ -0,0 +1,119 @@
+"""Synthetic IFS inputs in GRIB, shared by the tests and the benchmarks."""
+
+import typing
+from datetime import datetime
+
+import eccodes
+import numpy as np
+
+REF_TIME = datetime(2024, 10, 1, 0)
+
+# Input fields as in flexprep.domain.flexpart_utils, which is not imported
+# here so that the fixtures do not depend on the processing stack
+CONSTANTS = {"z", "lsm", "sdor"}
+FIELDS_3D = {"u", "v", "etadot", "t", "q"}
+ACCUMULATED = {"cp", "lsp", "ssr", "sshf", "ewss", "nsss"}
+INPUT_FIELDS = FIELDS_3D | ACCUMULATED | {"sp", "10u", "10v", "2t", "2d", "tcc", "sd"}
+
+
+def write_field(
+    f: typing.BinaryIO,
+    short_name: str,
+    step: int,
+    level: int | None = None,
+    ref_time: datetime = REF_TIME,
+    grid: tuple[int, int] = (31, 16),
+    edition: int = 2,
+    pv: np.ndarray | None = None,
+    accumulated: bool = False,
+) -> None:
+    """Append a synthetic GRIB message with random values on a regular grid."""
+    ni, nj = grid
+    handle = eccodes.codes_grib_new_from_samples(f"GRIB{edition}")
+    try:
+        eccodes.codes_set(handle, "centre", 98)
+        eccodes.codes_set(handle, "Ni", ni)
+        eccodes.codes_set(handle, "Nj", nj)
+        eccodes.codes_set(handle, "latitudeOfFirstGridPointInDegrees", 60.0)
+        eccodes.codes_set(handle, "latitudeOfLastGridPointInDegrees", 60.0 - nj + 1)
+        eccodes.codes_set(handle, "longitudeOfFirstGridPointInDegrees", 0.0)
+        eccodes.codes_set(handle, "longitudeOfLastGridPointInDegrees", ni - 1.0)
+        eccodes.codes_set(handle, "iDirectionIncrementInDegrees", 1.0)
+        eccodes.codes_set(handle, "jDirectionIncrementInDegrees", 1.0)
+        eccodes.codes_set(handle, "dataDate", int(ref_time.strftime("%Y%m%d")))
+        eccodes.codes_set(handle, "dataTime", int(ref_time.strftime("%H%M")))
+        eccodes.codes_set(handle, "shortName", short_name)
+        if accumulated:
+            eccodes.codes_set(handle, "stepType", "accum")
+            eccodes.codes_set(handle, "stepRange", f"0-{step}")
+        else:
+            eccodes.codes_set(handle, "step", step)
+        if level is not None:
+            eccodes.codes_set(handle, "typeOfLevel", "hybrid")
+            eccodes.codes_set(handle, "level", level)
+        if pv is not None:
+            eccodes.codes_set(handle, "PVPresent", 1)
+            eccodes.codes_set_array(handle, "pv", pv)
+        eccodes.codes_set_values(handle, np.random.rand(ni * nj))
+        eccodes.codes_write(handle, f)
+    finally:
+        eccodes.codes_release(handle)
+
+
+def hybrid_coefficients(levels: int) -> np.ndarray:
+    """Coefficients a (Pa) and b of the half levels, from the top to the surface."""
+    b = np.linspace(0, 1, levels + 1) ** 2
+    a = 20000 * np.sin(np.linspace(0, np.pi, levels + 1))
+    return np.concatenate([a, b])
+
+
+def write_grib_file(
+    path: str,
+    fields_3d: typing.Iterable[str],
+    fields_2d: typing.Iterable[str],
+    step: int,
+    levels: int,
+    grid: tuple[int, int],
+    pv: np.ndarray | None = None,
+    edition_2d: int = 2,
+) -> None:
+    """
+    Write the model level fields on ``levels`` levels in GRIB2, then the
+    surface fields in GRIB ``edition_2d``.
+    """
+    with open(path, "wb") as f:
+        for short_name in fields_3d:
+            for level in range(1, levels + 1):
+                write_field(f, short_name, step, level, grid=grid, pv=pv)
+        for short_name in fields_2d:
+            write_field(
+                f,
+                short_name,
+                step,
+                grid=grid,
+                edition=edition_2d,
+                accumulated=short_name in ACCUMULATED,
+            )
+
+
+def write_ifs_file(
+    path: str,
+    fields: typing.Iterable[str],
+    step: int,
+    levels: int,
+    grid: tuple[int, int],
+) -> None:
+    """
+    Write an IFS-like input file: model level fields in GRIB2 with their
+    hybrid coefficients, surface fields in GRIB1.
+    """
+    write_grib_file(
+        path,
+        [name for name in fields if name in FIELDS_3D],
+        [name for name in fields if name not in FIELDS_3D],
+        step,
+        levels,
+        grid,
+        pv=hybrid_coefficients(levels),
+        edition_2d=1,
+    )
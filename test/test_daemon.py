@@ -0,0 +1,95 @@
+import fcntl
+import json
+import os
+from datetime import datetime
+from unittest.mock import MagicMock
+
+import pytest
+
+from flexprep import CONFIG, daemon
+
+
+@pytest.fixture
+def spool_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(CONFIG.main.daemon, "spool_dir", str(tmp_path))
+    (tmp_path / daemon.FAILED_DIR).mkdir()
+    return tmp_path
+
+
+def _notification(step):
+    return {"step": str(step), "date": "20241001", "time": "0", "location": "a/b"}
+
+
+def test_enqueue_keeps_arrival_order(spool_dir):
+    paths = [daemon.enqueue(_notification(step)) for step in range(3)]
+
+    assert daemon.pending_notifications() == paths
+    with open(paths[0]) as f:
+        assert json.load(f)["step"] == "0"
+
+
+def test_is_running(spool_dir):
+    assert not daemon.is_running()
+
+    # A stale pid file, even with the pid of a live process, is not a daemon
+    (spool_dir / daemon.PID_FILE).write_text(str(os.getpid()))
+    assert not daemon.is_running()
+
+    with open(spool_dir / daemon.PID_FILE) as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        assert daemon.is_running()
+
+
+def test_handle_inserts_and_processes(spool_dir):
+    worker = daemon.Daemon.__new__(daemon.Daemon)
+    worker.db = MagicMock()
+    worker.db.claim_steps.return_value = []
+    worker.processing = MagicMock()
+    worker.process_steps = MagicMock(return_value=[])
+
+    worker.handle(daemon.enqueue(_notification(3)))
+
+    inserted = worker.db.insert_item.call_args.args[0]
+    assert inserted.forecast_ref_time == datetime(2024, 10, 1)
+    assert inserted.step == 3
+    assert inserted.key == "b"
+
+
+def test_failed_notification_is_retried(spool_dir, monkeypatch):
+    monkeypatch.setattr(CONFIG.main.daemon, "max_attempts", 2)
+    monkeypatch.setattr(CONFIG.main.daemon, "retry_interval", 0)
+    worker = daemon.Daemon.__new__(daemon.Daemon)
+    worker.stopped = False
+    worker.db = MagicMock()
+    worker.db.claim_steps.return_value = [[{"step": 3}]]
+    worker.processing = MagicMock()
+    results = iter([[3], []])
+
+    def process_steps(steps, processing):
+        result = next(results)
+        worker.stopped = not result
+        return result
+
+    worker.process_steps = process_steps
+    path = daemon.enqueue(_notification(3))
+
+    worker._serve()
+
+    # Inserted once, processed twice, then removed from the spool
+    assert worker.db.insert_item.call_count == 1
+    assert not os.path.exists(path)
+    assert not os.listdir(spool_dir / daemon.FAILED_DIR)
+
+
+def test_notification_fails_after_max_attempts(spool_dir, monkeypatch):
+    monkeypatch.setattr(CONFIG.main.daemon, "max_attempts", 2)
+    worker = daemon.Daemon.__new__(daemon.Daemon)
+    path = daemon.enqueue(_notification(3))
+
+    worker.retry_later(path)
+    with open(path) as f:
+        assert json.load(f)["attempts"] == 1
+
+    worker.retry_later(path)
+    assert not os.path.exists(path)
+    assert os.listdir(spool_dir / daemon.FAILED_DIR) == [os.path.basename(path)]
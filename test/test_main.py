@@ -0,0 +1,38 @@
+import subprocess
+import sys
+
+HEAVY_MODULES = ("meteodatalab", "eccodes", "xarray", "pandas", "boto3")
+
+
+def test_entry_point_defers_heavy_imports():
+    # Run in a fresh interpreter, the test session has imported them already
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, flexprep.__main__; "
+            f"print([m for m in {HEAVY_MODULES!r} if m in sys.modules])",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    assert result.stdout.strip() == "[]"
+
+
+def test_forwarding_skips_database_and_dispatch():
+    # Forwarded notifications only need the spool functions of the daemon
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, flexprep.__main__; print([m for m in sys.modules "
+            "if m in ('sqlite3', 'flexprep.domain.dispatch_utils')])",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    assert result.stdout.strip() == "[]"
@@ -0,0 +1,78 @@
+from datetime import datetime, timedelta
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from flexprep import CONFIG
+from flexprep.domain.data_model import IFSForecast
+from flexprep.domain.db_utils import DB
+from flexprep.domain.s3_utils import S3client
+from flexprep.reconcile import forecast_ref_times, reconcile
+
+FORECAST_REF_TIME = datetime(2024, 12, 31, 18)
+N_STEPS = 1500
+
+
+def _key(step: int) -> str:
+    valid_time = FORECAST_REF_TIME + timedelta(hours=step)
+    return f"P1D{FORECAST_REF_TIME:%m%d%H%M}{valid_time:%m%d%H}001"
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        bucket = CONFIG.main.s3_buckets.input.name
+        client.create_bucket(Bucket=bucket)
+        keys = [f"P1D{FORECAST_REF_TIME:%m%d%H%M}{FORECAST_REF_TIME:%m%d%H}011"]
+        keys += [_key(step) for step in range(N_STEPS + 1)]
+        keys += [_key(1) + ".index"]
+        for key in keys:
+            client.put_object(Bucket=bucket, Key=key, Body=b"")
+
+        s3 = S3client.__new__(S3client)
+        s3.s3_client_input = client
+        yield s3
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(CONFIG.main, "db_path", str(tmp_path / "sqlite3-db"))
+    return DB()
+
+
+def test_from_key_crosses_year():
+    forecast = IFSForecast.from_key(_key(12), FORECAST_REF_TIME)
+
+    assert forecast.step == 12
+    assert not forecast.is_constants
+    with pytest.raises(ValueError):
+        IFSForecast.from_key(_key(12), datetime(2024, 12, 31, 12))
+
+    # Into a leap year, 29 February does not exist in the forecast's year
+    forecast_ref_time = datetime(2027, 12, 31, 18)
+    key = f"P1D{forecast_ref_time:%m%d%H%M}022900001"
+    assert IFSForecast.from_key(key, forecast_ref_time).step == 24 * 59 + 6
+
+
+def test_forecast_ref_times():
+    start = datetime(2024, 10, 1)
+    times = forecast_ref_times(start, datetime(2024, 10, 2), timedelta(hours=6))
+
+    assert times == [start + timedelta(hours=6 * i) for i in range(5)]
+
+
+def test_reconcile_records_lost_notifications(db, s3_client):
+    # Only the step-0 files and step 1 were notified
+    for step in (0, 1):
+        db.insert_item(IFSForecast.from_key(_key(step), FORECAST_REF_TIME))
+
+    processable_steps = reconcile(db, s3_client, FORECAST_REF_TIME)
+
+    assert [objs[-1]["step"] for objs in processable_steps] == list(
+        range(1, N_STEPS + 1)
+    )
+    assert len(db.get_keys(FORECAST_REF_TIME)) == N_STEPS + 2
+    # Nothing is left to record or claim
+    assert reconcile(db, s3_client, FORECAST_REF_TIME) == []